@@ -453,6 +453,16 @@ class ConfigSpecification:
             action='store_true',
             help='Set to use layer normalization in encoder and decoder'))
 
+        group.append(ParameterSpecification(
+            name='rnn_fused_gru', default=False,
+            visible_arg_names=['--rnn_fused_gru'],
+            action='store_true',
+            help='use a fused GRU implementation that computes the gates and '
+                 'proposal with a single matrix multiply per timestep (the '
+                 'model parameters are unchanged). Not compatible with layer '
+                 'normalization; ignored for GRU inputs / states that use '
+                 'dropout'))
+
         group.append(ParameterSpecification(
             name='rnn_lexical_model', default=False,
             legacy_names=['lexical_model'],
@@ -566,6 +576,16 @@ class ConfigSpecification:
             type=float, metavar='FLOAT',
             help='label smoothing (default: %(default)s)'))
 
+        group.append(ParameterSpecification(
+            name='sampled_softmax_size', default=0,
+            visible_arg_names=['--sampled_softmax_size'],
+            type=int, metavar='INT',
+            help='number of negative target words to sample per minibatch '
+                 'for a sampled softmax training loss; the full softmax is '
+                 'still used for validation and translation. If 0, use the '
+                 'full softmax (default: %(default)s) - CURRENTLY ONLY WORKS '
+                 'FOR \'rnn\' MODEL'))
+
         group.append(ParameterSpecification(
             name='optimizer', default='adam',
             visible_arg_names=['--optimizer'],
@@ -636,6 +656,15 @@ class ConfigSpecification:
                  'this is enabled, batch_size only affects sorting by '
                  'length. (default: %(default)s)'))
 
+        group.append(ParameterSpecification(
+            name='pack_sequences', default=False,
+            visible_arg_names=['--pack_sequences'],
+            action='store_true',
+            help='pack multiple short sentence pairs into each row of a '
+                 'training minibatch to reduce padding; if token_batch_size '
+                 'is set, it counts actual (unpadded) tokens - CURRENTLY ONLY '
+                 'WORKS FOR \'transformer\' MODEL'))
+
         group.append(ParameterSpecification(
             name='max_sentences_per_device', default=0,
             visible_arg_names=['--max_sentences_per_device'],
@@ -660,6 +689,18 @@ class ConfigSpecification:
                  'adding more steps allows larger minibatches to be used '
                  '(default: %(default)s)'))
 
+        group.append(ParameterSpecification(
+            name='autotune_batch', default=False,
+            visible_arg_names=['--autotune_batch'],
+            action='store_true',
+            help='before training, run timed updates on synthetic minibatches '
+                 'of increasing size (with sentences of length maxlen, up to '
+                 'the number of sentences in a maxibatch) and '
+                 'set max_tokens_per_device to the size with the highest '
+                 'throughput that fits in memory; token_batch_size is set to '
+                 'the same size (per device) unless given. The chosen values '
+                 'are written to the model\'s JSON config file'))
+
         group.append(ParameterSpecification(
             name='maxibatch_size', default=20,
             visible_arg_names=['--maxibatch_size'],
@@ -685,6 +726,21 @@ class ConfigSpecification:
             action='store_true',
             help='Keep training dataset lines stores in RAM during training'))
 
+        group.append(ParameterSpecification(
+            name='xla_jit', default=False,
+            visible_arg_names=['--xla_jit'],
+            action='store_true',
+            help='compile the graph with XLA (just-in-time); sequence '
+                 'lengths are padded to a multiple of xla_length_bucket to '
+                 'limit the number of recompilations'))
+
+        group.append(ParameterSpecification(
+            name='xla_length_bucket', default=8,
+            visible_arg_names=['--xla_length_bucket'],
+            type=int, metavar='INT',
+            help='if using --xla_jit, pad source and target sequence '
+                 'lengths to a multiple of INT (default: %(default)s)'))
+
         group.append(ParameterSpecification(
             name='max_epochs', default=5000,
             visible_arg_names=['--max_epochs'],
@@ -825,6 +881,40 @@ class ConfigSpecification:
             type=str, choices=['beam_search', 'sampling'],
             help='translation_strategy, either beam_search or sampling (default: %(default)s)'))
 
+        group.append(ParameterSpecification(
+            name='fixed_kv_cache', default=False,
+            visible_arg_names=['--fixed_kv_cache'],
+            action='store_true',
+            help='Transformer only: store decoder self-attention keys and '
+                 'values in buffers of size translation_maxlen that are '
+                 'allocated once and written to one position per step, '
+                 'instead of concatenating them at every step (beam '
+                 'search still reorders the whole buffers)'))
+
+        group.append(ParameterSpecification(
+            name='max_len_a', type=float, default=0.0,
+            visible_arg_names=['--max_len_a'],
+            metavar='FLOAT',
+            help='limit the length of each translation to FLOAT * source '
+                 'length + max_len_b (capped at translation_maxlen); if '
+                 'max_len_a and max_len_b are both 0, only '
+                 'translation_maxlen is used (default: %(default)s)'))
+
+        group.append(ParameterSpecification(
+            name='max_len_b', type=int, default=0,
+            visible_arg_names=['--max_len_b'],
+            metavar='INT',
+            help='see max_len_a (default: %(default)s)'))
+
+        group.append(ParameterSpecification(
+            name='two_stage_top_k', default=False,
+            visible_arg_names=['--two_stage_top_k'],
+            action='store_true',
+            help='in beam search, select the top k words for each '
+                 'hypothesis before selecting the top k of all '
+                 'candidates (gives identical results; may be faster for '
+                 'large vocabularies)'))
+
         # Add command-line parameters for 'sampling' group.
 
         group = param_specs['sampling']
@@ -1102,6 +1192,15 @@ def _check_config_consistency(spec, config, set_by_user):
             msg = 'softmax mixtures are not yet supported for the ' \
                   '\'transformer\' model type'
             error_messages.append(msg)
+        if config.sampled_softmax_size > 0:
+            msg = 'sampled softmax is not yet supported for the ' \
+                  '\'transformer\' model type'
+            error_messages.append(msg)
+
+    if config.pack_sequences and config.model_type != 'transformer':
+        msg = '--pack_sequences is only supported for the \'transformer\' ' \
+              'model type'
+        error_messages.append(msg)
 
     if config.datasets:
         if config.source_dataset or config.target_dataset:
@@ -1172,6 +1271,34 @@ def _check_config_consistency(spec, config, set_by_user):
             arg_names_string(max_tokens_param))
         error_messages.append(msg)
 
+    autotune_param = spec.lookup('autotune_batch')
+
+    if (config.autotune_batch
+        and (max_sents_param.name in set_by_user
+             or max_tokens_param.name in set_by_user
+             or aggregation_param.name in set_by_user)):
+        msg = '{} is mutually exclusive with {} / {} / {}'.format(
+            arg_names_string(autotune_param),
+            arg_names_string(max_sents_param),
+            arg_names_string(max_tokens_param),
+            arg_names_string(aggregation_param))
+        error_messages.append(msg)
+
+    if config.xla_length_bucket < 1:
+        error_messages.append('--xla_length_bucket must be at least 1')
+
+    if config.sampled_softmax_size > 0:
+        if config.softmax_mixture_size > 1:
+            error_messages.append('--sampled_softmax_size cannot be used if '
+                                  'softmax_mixture_size > 1')
+        if config.label_smoothing > 0.0:
+            error_messages.append('--sampled_softmax_size cannot be used with '
+                                  '--label_smoothing')
+
+    if config.rnn_fused_gru and config.rnn_layer_normalization:
+        error_messages.append('--rnn_fused_gru cannot be used with '
+                              '--rnn_layer_normalisation')
+
     # softmax_mixture_size and lexical_model are currently mutually exclusive:
     if config.softmax_mixture_size > 1 and config.rnn_lexical_model:
        error_messages.append('behavior of --rnn_lexical_model is undefined if softmax_mixture_size > 1')
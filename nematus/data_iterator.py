@@ -51,7 +51,8 @@ class TextIterator:
                  use_factor=False,
                  maxibatch_size=20,
                  token_batch_size=0,
-                 keep_data_in_memory=False):
+                 keep_data_in_memory=False,
+                 pack_sequences=False):
         if keep_data_in_memory:
             self.source, self.target = FileWrapper(source), FileWrapper(target)
             if shuffle_each_epoch:
@@ -93,6 +94,9 @@ class TextIterator:
         self.target_vocab_size = target_vocab_size
 
         self.token_batch_size = token_batch_size
+        # If sentences will be packed (see util.prepare_packed_data) then the
+        # token budget applies to actual tokens, not the padded batch size.
+        self.pack_sequences = pack_sequences
 
         if self.source_vocab_sizes != None:
             assert len(self.source_vocab_sizes) == len(self.source_dicts)
@@ -143,6 +147,8 @@ class TextIterator:
 
         longest_source = 0
         longest_target = 0
+        total_source = 0
+        total_target = 0
 
         # fill buffer, if it's empty
         assert len(self.source_buffer) == len(self.target_buffer), 'Buffer size mismatch!'
@@ -219,10 +225,17 @@ class TextIterator:
                 target.append(tt_indices)
                 longest_source = max(longest_source, len(ss_indices))
                 longest_target = max(longest_target, len(tt_indices))
+                total_source += len(ss_indices)
+                total_target += len(tt_indices)
 
                 if self.token_batch_size:
-                    if len(source)*longest_source > self.token_batch_size or \
-                        len(target)*longest_target > self.token_batch_size:
+                    if self.pack_sequences:
+                        source_size, target_size = total_source, total_target
+                    else:
+                        source_size = len(source)*longest_source
+                        target_size = len(target)*longest_target
+                    if source_size > self.token_batch_size or \
+                        target_size > self.token_batch_size:
                         # remove last sentence pair (that made batch over-long)
                         source.pop()
                         target.pop()
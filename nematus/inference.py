@@ -1,5 +1,10 @@
+import collections
+import json
 import logging
+import os
+import queue
 import sys
+import threading
 import time
 
 import numpy
@@ -14,23 +19,20 @@ import util
 """Represents a collection of models that can be used jointly for inference.
 
 RNN and Transformer models are both supported, though they can't be mixed.
-For RNNs, search can use multiple models (i.e. an ensemble) but sampling is
-limited to a single model. For Transformers, only single models are supported.
-Multi-GPU inference is not yet supported.
+Search can use multiple models (i.e. an ensemble) but sampling is limited to
+a single model. Multi-GPU inference is not yet supported.
 
 TODO Multi-GPU inference (i.e. multiple replicas of the same model).
-TODO Beam search for Transformer ensembles.
 TODO Mixed RNN/Tranformer inference.
 TODO Ensemble sampling (is this useful?).
 """
 class InferenceModelSet(object):
-    def __init__(self, models, configs):
+    def __init__(self, models, configs, max_cached_graphs=8):
         self._models = models
         self._model_types = [config.model_type for config in configs]
-        # Currently only supports RNN ensembles or single Transformer models
+        # Ensembles must consist of a single model type
         assert len(set(self._model_types)) == 1
         if self._model_types[0] == "transformer":
-            assert len(models) == 1
             self._sample_func = transformer_inference.sample
             self._sample_graph_type = transformer_inference.SampleGraph
             self._beam_search_func = transformer_inference.beam_search
@@ -41,20 +43,40 @@ class InferenceModelSet(object):
             self._sample_graph_type = rnn_inference.SampleGraph
             self._beam_search_func = rnn_inference.beam_search
             self._beam_search_graph_type = rnn_inference.BeamSearchGraph
-        self._cached_sample_graph = None
-        self._cached_beam_search_graph = None
+        # Search graphs are cached by structure (i.e. strategy, beam size and
+        # whether a shortlist is used), with the least recently used graph
+        # being dropped once there are more than max_cached_graphs. Settings
+        # such as normalization_alpha are fed at run time, so they don't need
+        # their own graphs. Note that TensorFlow can't remove the ops of a
+        # dropped graph, so the limit should be larger than the number of
+        # variations that are used in practice.
+        self._cached_graphs = collections.OrderedDict()
+        self._max_cached_graphs = max_cached_graphs
 
-    def sample(self, session, x, x_mask):
+    def _get_graph(self, key, build_graph):
+        """Returns the cached graph for key, building it if necessary."""
+        graph = self._cached_graphs.pop(key, None)
+        if graph is None:
+            logging.debug('Building search graph {}'.format(key))
+            graph = build_graph()
+            if len(self._cached_graphs) >= self._max_cached_graphs:
+                self._cached_graphs.popitem(last=False)
+        self._cached_graphs[key] = graph
+        return graph
+
+    def sample(self, session, x, x_mask, num_samples=1):
         # Sampling is not implemented for ensembles, so just use the first
         # model.
         model = self._models[0]
-        if self._cached_sample_graph is None:
-            self._cached_sample_graph = self._sample_graph_type(model)
-        return self._sample_func(session, model, x, x_mask,
-                                 self._cached_sample_graph)
+        graph = self._get_graph(('sampling',),
+                                lambda: self._sample_graph_type(model))
+        return self._sample_func(session, model, x, x_mask, graph,
+                                 num_samples=num_samples)
 
     def beam_search(self, session, x, x_mask, beam_size,
-                    normalization_alpha=0.0):
+                    normalization_alpha=0.0, prune_relative=0.0,
+                    prune_absolute=0.0, early_stopping=False, shortlist=None,
+                    extra_outputs=False):
         """Beam search using all models contained in this model set.
 
         If using an ensemble (i.e. more than one model), then at each timestep
@@ -67,31 +89,55 @@ class InferenceModelSet(object):
             x_mask: Numpy array with shape (max_seq_len, batch_size).
             beam_size: beam width.
             normalization_alpha: length normalization hyperparamter.
+            prune_relative: relative score threshold for pruning (RNN only).
+            prune_absolute: absolute score threshold for pruning (RNN only).
+            early_stopping: stop once no unfinished hypothesis can beat the
+                best finished one (RNN only; Transformers always do this).
+            shortlist: optional NumPy array of candidate target IDs, to which
+                the output layer is restricted (see util.get_shortlist_ids).
+            extra_outputs: also return the alignment (i.e. attention weights)
+                and word probabilities of each translation (RNN only).
 
         Returns:
             A list of lists of (translation, score) pairs. The outer list
             contains one list for each input sentence in the batch. The inner
             lists contain k elements (where k is the beam size), sorted by
             score in ascending order (i.e. best first, assuming lower scores
-            are better).
+            are better). With extra_outputs, the pairs are replaced by
+            (translation, score, alignment, word_probs) tuples (see
+            rnn_inference.beam_search).
         """
-        def cached_graph_is_usable():
-            cached_graph = self._cached_beam_search_graph
-            if cached_graph is None:
-                return False
-            return (cached_graph.beam_size == beam_size
-                    and cached_graph.normalization_alpha == normalization_alpha)
-
-        if not cached_graph_is_usable():
-            self._cached_beam_search_graph = \
-                self._beam_search_graph_type(self._models, beam_size,
-                                             normalization_alpha)
+        use_shortlist = (shortlist is not None)
+        if self._model_types[0] == "rnn":
+            graph = self._get_graph(
+                ('beam_search', beam_size, use_shortlist, extra_outputs),
+                lambda: self._beam_search_graph_type(
+                    self._models, beam_size, use_shortlist=use_shortlist,
+                    extra_outputs=extra_outputs))
+            return self._beam_search_func(
+                session, self._models, x, x_mask, beam_size,
+                normalization_alpha, graph,
+                prune_relative=prune_relative, prune_absolute=prune_absolute,
+                early_stopping=early_stopping, shortlist=shortlist,
+                extra_outputs=extra_outputs)
+        if extra_outputs:
+            raise exception.Error('alignments and word probabilities are '
+                                  'only supported for RNN models')
+        graph = self._get_graph(
+            ('beam_search', beam_size, use_shortlist),
+            lambda: self._beam_search_graph_type(
+                self._models, beam_size, use_shortlist=use_shortlist))
+        if prune_relative > 0.0 or prune_absolute > 0.0:
+            logging.warning('beam pruning is only supported for RNN models; '
+                            'ignoring pruning thresholds')
         return self._beam_search_func(session, self._models, x, x_mask,
-                                      beam_size, normalization_alpha,
-                                      self._cached_beam_search_graph)
+                                      beam_size, normalization_alpha, graph,
+                                      shortlist=shortlist)
 
     def decode(self, session, x, x_mask, beam_size,
-               normalization_alpha=0.0):
+               normalization_alpha=0.0, prune_relative=0.0,
+               prune_absolute=0.0, early_stopping=False, shortlist=None,
+               num_samples=1, extra_outputs=False):
         """Decode using either beam search or sampling, depending on the translation strategy set in the first model
 
         Args:
@@ -100,27 +146,388 @@ class InferenceModelSet(object):
             x_mask: Numpy array with shape (max_seq_len, batch_size).
             beam_size: beam width (only for beam search).
             normalization_alpha: length normalization hyperparamter (only for beam search).
+            prune_relative, prune_absolute, early_stopping: beam pruning
+                options (only for beam search; see beam_search).
+            shortlist: candidate target IDs (only for beam search; see
+                beam_search).
+            num_samples: number of samples per sentence (only for sampling).
+            extra_outputs: return alignments and word probabilities (only for
+                beam search; see beam_search).
 
         Returns:
             A list of lists of (translation, score) pairs. The outer list
             contains one list for each input sentence in the batch. The inner
             lists contain k elements (where k is the beam size), sorted by
             score in ascending order (i.e. best first, assuming lower scores
-            are better). When sampling beam size is always one and score is 0.0
+            are better). When sampling, the inner lists contain num_samples
+            elements and the scores are 0.0
         """
 
         if self._models[0].sampling_utils.translation_strategy == 'beam_search':
-            return self.beam_search(session, x, x_mask, beam_size, normalization_alpha)
+            return self.beam_search(session, x, x_mask, beam_size,
+                                    normalization_alpha, prune_relative,
+                                    prune_absolute, early_stopping, shortlist,
+                                    extra_outputs)
         elif self._models[0].sampling_utils.translation_strategy == 'sampling':
-            samples = self.sample(session, x, x_mask)
-            beams = [[(sample, 0.0)] for sample in samples]
+            samples = self.sample(session, x, x_mask, num_samples)
+            beams = [[(sample, 0.0)
+                      for sample in samples[i:i+num_samples]]
+                     for i in range(0, len(samples), num_samples)]
             return beams
         else:
             assert False
 
+"""Translates maxibatches (lists of source sentences) with fixed options.
+
+The work for each maxibatch is split into three stages (prepare, translate
+and format), so that the callers can overlap them (see translate_file) or
+spread them over processes (see translate.py). Only translate uses the
+TensorFlow session.
+"""
+class MaxibatchTranslator(object):
+    def __init__(self, session, models, configs, beam_size=12, nbest=False,
+                 minibatch_size=80, normalization_alpha=1.0, length_bucket=1,
+                 prune_relative=0.0, prune_absolute=0.0, early_stopping=False,
+                 shortlist=None, shortlist_frequent=100, token_batch_size=0,
+                 cache=None, num_samples=1, alignments=False,
+                 json_alignment=False, word_probabilities=False):
+        """Loads the target dictionary and sets the translation options.
+
+        See translate_file for a description of the arguments. If alignments
+        is True, then the beams also contain the alignments, which can be
+        written with format_alignments.
+        """
+        strategy = models[0].sampling_utils.translation_strategy
+        if (alignments or word_probabilities) and (
+                strategy != 'beam_search' or
+                any(c.model_type != 'rnn' for c in configs)):
+            logging.error('alignments and word probabilities are only '
+                          'supported for beam search with RNN models')
+            sys.exit(1)
+        if shortlist is not None and any(
+                c.model_type == 'rnn' and c.softmax_mixture_size > 1
+                for c in configs):
+            logging.error('a shortlist cannot be used with a mixture of '
+                          'softmaxes')
+            sys.exit(1)
+        self._session = session
+        self._config = configs[0]
+        self._model_set = InferenceModelSet(models, configs)
+        _, _, _, num_to_target = util.load_dictionaries(configs[0])
+        self._target_vocab = util.inverse_vocab_array(num_to_target)
+        self._beam_size = beam_size
+        self._nbest = nbest
+        self._minibatch_size = minibatch_size
+        self._normalization_alpha = normalization_alpha
+        self._length_bucket = length_bucket
+        self._prune_relative = prune_relative
+        self._prune_absolute = prune_absolute
+        self._early_stopping = early_stopping
+        self._shortlist = shortlist
+        self._shortlist_frequent = shortlist_frequent
+        self._token_batch_size = token_batch_size
+        self._num_samples = num_samples
+        self._json_alignment = json_alignment
+        self._word_probabilities = word_probabilities
+        self._extra_outputs = alignments or word_probabilities
+        # Beam search runs the decoder for beam_size copies of each sentence
+        # and sampling for num_samples copies.
+        self._sampling = (strategy == 'sampling')
+        self._beam_multiplier = num_samples if self._sampling else beam_size
+        self._deduplicate = (strategy == 'beam_search')
+        # The cache only stores translations and scores.
+        self._cache = cache if strategy == 'beam_search' and \
+                               not self._extra_outputs else None
+
+    def prepare(self, maxibatch):
+        """Sorts a maxibatch by length and splits it into padded minibatches.
+
+        With beam search, repeated sentences and sentences that are in the
+        translation cache (if any) are only translated once.
+
+        Args:
+            maxibatch: a list of sentences.
+
+        Returns:
+            A _PreparedMaxibatch object.
+
+        Raises:
+            exception.Error: if a sentence has the wrong number of factors.
+        """
+        config = self._config
+        # Map each sentence to its first occurrence (sampled translations
+        # shouldn't be shared, though).
+        if self._deduplicate:
+            first_positions = {}
+            positions = []
+            sentences = []
+            for sent in maxibatch:
+                key = ' '.join(sent.split())
+                if key not in first_positions:
+                    first_positions[key] = len(sentences)
+                    sentences.append(key)
+                positions.append(first_positions[key])
+        else:
+            positions = list(range(len(maxibatch)))
+            sentences = maxibatch
+        if self._cache is not None:
+            beams = self._cache.get(sentences)
+        else:
+            beams = [None] * len(sentences)
+        missing = [i for i, beam in enumerate(beams) if beam is None]
+
+        minibatches, idxs = util.read_all_lines(
+            config, [sentences[i] for i in missing], self._minibatch_size,
+            token_batch_size=self._token_batch_size,
+            beam_size=self._beam_multiplier,
+            length_bucket=self._length_bucket)
+        prepared = []
+        for x in minibatches:
+            y_dummy = numpy.zeros(shape=(len(x),1))
+            x, x_mask, _, _ = util.prepare_data(
+                x, y_dummy, config.factors, maxlen=None,
+                length_bucket=self._length_bucket)
+            shortlist_ids = None
+            if self._shortlist is not None:
+                # Top k is over beam_size hypotheses, so there must be at
+                # least that many candidates.
+                shortlist_ids = util.get_shortlist_ids(
+                    self._shortlist, x,
+                    max(self._shortlist_frequent, self._beam_size),
+                    config.target_vocab_size)
+            prepared.append((x, x_mask, shortlist_ids))
+        return _PreparedMaxibatch(minibatches=prepared, idxs=idxs,
+                                  sentences=sentences, positions=positions,
+                                  beams=beams, missing=missing)
+
+    def translate(self, prepared, num_prev_translated):
+        """Translates a prepared maxibatch.
+
+        Args:
+            prepared: a _PreparedMaxibatch object returned by prepare.
+            num_prev_translated: the number of previously translated sentences.
+
+        Returns:
+            A list containing the beam (i.e. translations and scores) for
+            each sentence, in the same order as the input maxibatch.
+        """
+        beams = []
+        for x, x_mask, shortlist_ids in prepared.minibatches:
+            sample = self._model_set.decode(
+                session=self._session,
+                x=x,
+                x_mask=x_mask,
+                beam_size=self._beam_size,
+                normalization_alpha=self._normalization_alpha,
+                prune_relative=self._prune_relative,
+                prune_absolute=self._prune_absolute,
+                early_stopping=self._early_stopping,
+                shortlist=shortlist_ids,
+                num_samples=self._num_samples,
+                extra_outputs=self._extra_outputs)
+            beams.extend(sample)
+            num_translated = num_prev_translated + len(beams)
+            logging.info('Translated {} sents'.format(num_translated))
+
+        # Put beams into the same order as the (deduplicated) sentences,
+        # then expand them to the input maxibatch.
+        all_beams = list(prepared.beams)
+        for i, beam in zip(prepared.idxs, beams):
+            all_beams[prepared.missing[i]] = beam
+        if self._cache is not None and len(prepared.missing) > 0:
+            self._cache.put([prepared.sentences[i] for i in prepared.missing],
+                            [all_beams[i] for i in prepared.missing])
+        return [all_beams[i] for i in prepared.positions]
+
+    def format(self, ordered_beams, num_prev_translated):
+        """Converts translated beams into output lines.
+
+        Returns:
+            A list of strings (one per line, including the newline), with
+            one line per sentence (or per sample, if sampling) or, for n-best
+            output, per hypothesis. If word_probabilities is set, then each
+            of these lines is followed by one containing the probabilities
+            of the translation's words (including the final <EOS>).
+        """
+        outputs = self._collect_outputs(ordered_beams, num_prev_translated)
+        translations = util.seqs2words([hypo[0] for _, hypo in outputs],
+                                       self._target_vocab)
+        lines = []
+        for (num, hypo), translation in zip(outputs, translations):
+            if self._nbest:
+                lines.append("{} ||| {} ||| {}\n".format(
+                    num, translation, str(hypo[1])))
+            else:
+                lines.append(translation + '\n')
+            if self._word_probabilities:
+                lines.append(' '.join(str(p) for p in hypo[3]) + '\n')
+        return lines
+
+    def format_alignments(self, ordered_beams, num_prev_translated,
+                          maxibatch):
+        """Converts the alignments of translated beams into output lines.
+
+        Args:
+            ordered_beams: the beams returned by translate.
+            num_prev_translated: the number of previously translated
+                sentences.
+            maxibatch: the source sentences of the beams.
+
+        Returns:
+            A list of strings, with the alignment of each translation (or
+            hypothesis, for n-best output) in the format written by
+            util.format_alignment.
+        """
+        outputs = self._collect_outputs(ordered_beams, num_prev_translated)
+        translations = util.seqs2words([hypo[0] for _, hypo in outputs],
+                                       self._target_vocab, join=False)
+        lines = []
+        for (num, hypo), target_words in zip(outputs, translations):
+            source_words = maxibatch[num - num_prev_translated].split()
+            lines.append(util.format_alignment(
+                num, source_words, target_words, hypo[1], hypo[2],
+                as_json=self._json_alignment))
+        return lines
+
+    def _collect_outputs(self, ordered_beams, num_prev_translated):
+        """Returns (sentence number, hypothesis) pairs for the hypotheses to
+        write, so that they can be converted all at once."""
+        outputs = []
+        for i, beam in enumerate(ordered_beams):
+            if self._nbest or self._sampling:
+                hypos = beam
+            else:
+                hypos = beam[:1]
+            for hypo in hypos:
+                outputs.append((num_prev_translated + i, hypo))
+        return outputs
+
+
+"""A maxibatch that is ready for translation (see MaxibatchTranslator.prepare).
+
+Attributes:
+    minibatches: list of (x, x_mask, shortlist_ids) tuples.
+    idxs: position of each sentence of the minibatches in the missing list
+        (see util.read_all_lines).
+    sentences: the distinct sentences of the maxibatch.
+    positions: for each sentence of the maxibatch, its index in sentences.
+    beams: for each of the sentences, its cached beam or None.
+    missing: indices of the sentences that need to be translated.
+"""
+class _PreparedMaxibatch(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def read_maxibatches(input_file, maxibatch_size, with_offsets=False):
+    """Reads a file and yields maxibatches of up to maxibatch_size lines.
+
+    Yields (maxibatch, offset) pairs. If with_offsets is True, then offset is
+    the position in input_file after the maxibatch (this requires input_file
+    to be seekable), otherwise it is None.
+    """
+    def current_offset():
+        return input_file.tell() if with_offsets else None
+
+    maxibatch = []
+    for line in iter(input_file.readline, ""):
+        maxibatch.append(line)
+        if len(maxibatch) == maxibatch_size:
+            yield maxibatch, current_offset()
+            maxibatch = []
+    if len(maxibatch) > 0:
+        yield maxibatch, current_offset()
+
+
+def read_maxibatches_streaming(input_file, maxibatch_size, window):
+    """Yields maxibatches as input arrives, for low-latency translation.
+
+    A maxibatch is started by the first line that arrives and contains all
+    further lines that arrive within window seconds (up to maxibatch_size),
+    so under load the batches are still large. Like read_maxibatches, this
+    yields (maxibatch, offset) pairs, but offset is always None. Errors in
+    reading input_file are re-raised.
+    """
+    lines = queue.Queue()
+
+    def read_lines():
+        try:
+            for line in iter(input_file.readline, ""):
+                lines.put(line)
+        except Exception as e:
+            lines.put(e)
+            return
+        lines.put(None)
+
+    threading.Thread(target=read_lines, daemon=True).start()
+    while True:
+        line = lines.get()
+        if isinstance(line, Exception):
+            raise line
+        if line is None:
+            return
+        maxibatch = [line]
+        deadline = time.time() + window
+        while len(maxibatch) < maxibatch_size:
+            try:
+                line = lines.get(timeout=max(0.0, deadline - time.time()))
+            except queue.Empty:
+                break
+            if isinstance(line, Exception):
+                raise line
+            if line is None:
+                yield maxibatch, None
+                return
+            maxibatch.append(line)
+        yield maxibatch, None
+
+
+def resume_translation(progress_file, input_file, output_file):
+    """Continues from the last position recorded in progress_file, if any.
+
+    The input and output files are moved to the recorded positions (see
+    save_progress), discarding any output beyond that point.
+
+    Returns:
+        The number of sentences that were already translated.
+    """
+    if not os.path.exists(progress_file):
+        return 0
+    with open(progress_file, 'r') as f:
+        progress = json.load(f)
+    input_file.seek(progress['input_offset'])
+    output_file.seek(progress['output_offset'])
+    output_file.truncate()
+    logging.info('Resuming after {} translated sents'.format(
+        progress['num_translated']))
+    return progress['num_translated']
+
+
+def save_progress(progress_file, input_offset, output_file, num_translated):
+    """Records the positions after the last completely written maxibatch.
+
+    The output is flushed first and the progress file is replaced
+    atomically, so that it always describes output that is on disk.
+    """
+    output_file.flush()
+    os.fsync(output_file.fileno())
+    progress = {'input_offset': input_offset,
+                'output_offset': output_file.tell(),
+                'num_translated': num_translated}
+    tmp_file = progress_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(progress, f)
+    os.replace(tmp_file, progress_file)
+
+
 def translate_file(input_file, output_file, session, models, configs,
                    beam_size=12, nbest=False, minibatch_size=80,
-                   maxibatch_size=20, normalization_alpha=1.0):
+                   maxibatch_size=20, normalization_alpha=1.0,
+                   length_bucket=1, prune_relative=0.0, prune_absolute=0.0,
+                   early_stopping=False, shortlist=None, shortlist_frequent=100,
+                   token_batch_size=0, cache=None, num_samples=1,
+                   progress_file=None, stream_window=0.0, alignment_file=None,
+                   json_alignment=False, word_probabilities=False):
     """Translates a source file using a translation model (or ensemble).
 
     Args:
@@ -134,87 +541,147 @@ def translate_file(input_file, output_file, session, models, configs,
         minibatch_size: minibatch size in sentences.
         maxibatch_size: number of minibatches to read and sort, pre-translation.
         normalization_alpha: alpha parameter for length normalization.
+        length_bucket: pad source lengths to a multiple of this (see
+            util.get_length_bucket).
+        prune_relative: relative score threshold for beam pruning.
+        prune_absolute: absolute score threshold for beam pruning.
+        early_stopping: stop beam search for a sentence once no unfinished
+            hypothesis can beat the best finished one.
+        shortlist: optional dictionary returned by util.load_shortlist. If
+            given, the output layer is restricted to the candidate
+            translations of each minibatch's source words.
+        shortlist_frequent: number of most frequent target words that are
+            added to each minibatch's shortlist.
+        token_batch_size: if greater than zero, cut minibatches by their
+            padded number of source tokens times the beam size, rather than
+            by number of sentences (see util.read_all_lines).
+        cache: optional TranslationCache object. Beam search results are
+            looked up in and added to the cache.
+        num_samples: when sampling, the number of samples to write for each
+            sentence (in n-best format if nbest is True).
+        progress_file: optional path of a file in which to record the input
+            and output positions after each maxibatch. If the file exists,
+            translation resumes from the recorded positions. This requires
+            the input and output files to be seekable.
+        stream_window: if greater than zero, translate the input as it
+            arrives, batching the lines that arrive within this many seconds
+            (see read_maxibatches_streaming), and flush the output after each
+            batch. This can't be combined with progress_file.
+        alignment_file: optional file object to which the alignment (i.e.
+            the attention weights) of each translation will be written (RNN
+            beam search only; see util.format_alignment). This can't be
+            combined with progress_file.
+        json_alignment: write the alignments in JSON format.
+        word_probabilities: after each translation, write a line containing
+            the probabilities of its words (RNN beam search only).
     """
 
-    def translate_maxibatch(maxibatch, model_set, num_to_target,
-                            num_prev_translated):
-        """Translates an individual maxibatch.
+    translator = MaxibatchTranslator(
+        session, models, configs, beam_size=beam_size, nbest=nbest,
+        minibatch_size=minibatch_size,
+        normalization_alpha=normalization_alpha, length_bucket=length_bucket,
+        prune_relative=prune_relative, prune_absolute=prune_absolute,
+        early_stopping=early_stopping, shortlist=shortlist,
+        shortlist_frequent=shortlist_frequent,
+        token_batch_size=token_batch_size, cache=cache,
+        num_samples=num_samples, alignments=(alignment_file is not None),
+        json_alignment=json_alignment, word_probabilities=word_probabilities)
 
-        Args:
-            maxibatch: a list of sentences.
-            model_set: an InferenceModelSet object.
-            num_to_target: dictionary mapping target vocabulary IDs to strings.
-            num_prev_translated: the number of previously translated sentences.
-        """
+    # The work is pipelined over three threads: a reader thread that reads
+    # and prepares the next maxibatches, the main thread, which runs the
+    # session, and a writer thread that converts and writes the finished
+    # translations. Maxibatches are passed along in order via FIFO queues,
+    # so the output order is the same as the input order. The reader stays
+    # at most a couple of maxibatches ahead. Errors (and the end of input)
+    # are passed along as queue items.
+    _END = object()
 
-        # Sort the maxibatch by length and split into minibatches.
+    def reader():
         try:
-            minibatches, idxs = util.read_all_lines(configs[0], maxibatch,
-                                                    minibatch_size)
-        except exception.Error as x:
-            logging.error(x.msg)
-            sys.exit(1)
-
-        # Translate the minibatches and store the resulting beam (i.e.
-        # translations and scores) for each sentence.
-        beams = []
-        for x in minibatches:
-            y_dummy = numpy.zeros(shape=(len(x),1))
-            x, x_mask, _, _ = util.prepare_data(x, y_dummy, configs[0].factors,
-                                                maxlen=None)
-            sample = model_set.decode(
-                session=session,
-                x=x,
-                x_mask=x_mask,
-                beam_size=beam_size,
-                normalization_alpha=normalization_alpha)
-            beams.extend(sample)
-            num_translated = num_prev_translated + len(beams)
-            logging.info('Translated {} sents'.format(num_translated))
-
-        # Put beams into the same order as the input maxibatch.
-        tmp = numpy.array(beams, dtype=numpy.object)
-        ordered_beams = tmp[idxs.argsort()]
-
-        # Write the translations to the output file.
-        for i, beam in enumerate(ordered_beams):
-            if nbest:
-                num = num_prev_translated + i
-                for sent, cost in beam:
-                    translation = util.seq2words(sent, num_to_target)
-                    line = "{} ||| {} ||| {}\n".format(num, translation,
-                                                       str(cost))
-                    output_file.write(line)
+            if stream_window > 0.0:
+                maxibatches = read_maxibatches_streaming(
+                    input_file, maxibatch_size * minibatch_size,
+                    stream_window)
             else:
-                best_hypo, cost = beam[0]
-                line = util.seq2words(best_hypo, num_to_target) + '\n'
-                output_file.write(line)
+                maxibatches = read_maxibatches(
+                    input_file, maxibatch_size * minibatch_size,
+                    with_offsets=(progress_file is not None))
+            for maxibatch, offset in maxibatches:
+                prepared_queue.put((translator.prepare(maxibatch), maxibatch,
+                                    offset))
+            prepared_queue.put(_END)
+        except Exception as e:
+            prepared_queue.put(e)
 
-    _, _, _, num_to_target = util.load_dictionaries(configs[0])
-    model_set = InferenceModelSet(models, configs)
+    def writer():
+        while True:
+            item = translated_queue.get()
+            if item is _END:
+                break
+            ordered_beams, num_prev_translated, maxibatch, offset = item
+            try:
+                output_file.writelines(
+                    translator.format(ordered_beams, num_prev_translated))
+                if alignment_file is not None:
+                    alignment_file.writelines(translator.format_alignments(
+                        ordered_beams, num_prev_translated, maxibatch))
+                if progress_file is not None:
+                    save_progress(progress_file, offset, output_file,
+                                  num_prev_translated + len(ordered_beams))
+                elif stream_window > 0.0:
+                    output_file.flush()
+                    if alignment_file is not None:
+                        alignment_file.flush()
+            except Exception as e:
+                writer_errors.append(e)
+                break
 
     logging.info("NOTE: Length of translations is capped to {}".format(
         configs[0].translation_maxlen))
 
-    start_time = time.time()
+    if progress_file is not None and stream_window > 0.0:
+        logging.error('a progress file cannot be used in streaming mode')
+        sys.exit(1)
+    if progress_file is not None and alignment_file is not None:
+        logging.error('a progress file cannot be used with an alignment file')
+        sys.exit(1)
 
     num_translated = 0
-    maxibatch = []
-    while True:
-        line = input_file.readline()
-        if line == "":
-            if len(maxibatch) > 0:
-                translate_maxibatch(maxibatch, model_set, num_to_target,
-                                    num_translated)
-                num_translated += len(maxibatch)
+    if progress_file is not None:
+        num_translated = resume_translation(progress_file, input_file,
+                                            output_file)
+    num_prev_translated = num_translated
+
+    start_time = time.time()
+
+    prepared_queue = queue.Queue(maxsize=2)
+    translated_queue = queue.Queue()
+    writer_errors = []
+    reader_thread = threading.Thread(target=reader, daemon=True)
+    writer_thread = threading.Thread(target=writer, daemon=True)
+    reader_thread.start()
+    writer_thread.start()
+
+    while not writer_errors:
+        item = prepared_queue.get()
+        if item is _END:
             break
-        maxibatch.append(line)
-        if len(maxibatch) == (maxibatch_size * minibatch_size):
-            translate_maxibatch(maxibatch, model_set, num_to_target,
-                                num_translated)
-            num_translated += len(maxibatch)
-            maxibatch = []
+        if isinstance(item, exception.Error):
+            logging.error(item.msg)
+            sys.exit(1)
+        if isinstance(item, Exception):
+            raise item
+        prepared, maxibatch, offset = item
+        ordered_beams = translator.translate(prepared, num_translated)
+        translated_queue.put((ordered_beams, num_translated, maxibatch,
+                              offset))
+        num_translated += len(ordered_beams)
+    translated_queue.put(_END)
+    writer_thread.join()
+    if writer_errors:
+        raise writer_errors[0]
 
     duration = time.time() - start_time
+    num_translated -= num_prev_translated
     logging.info('Translated {} sents in {} sec. Speed {} sents/sec'.format(
         num_translated, duration, num_translated/duration))
@@ -77,12 +77,24 @@ class FeedForwardLayer(object):
             self.dropout_mask = dropout_input(ones)
 
 
-    def forward(self, x, input_is_3d=False):
+    def forward(self, x, input_is_3d=False, output_ids=None):
+        """Applies the layer to x.
+
+        If output_ids is given then only the corresponding output units (i.e.
+        columns of W) are computed. This is used to restrict output layers to
+        a subset of the vocabulary; it can't be combined with layer norm, since
+        that depends on the full output vector.
+        """
         x = apply_dropout_mask(x, self.dropout_mask, input_is_3d)
+        W, b = self.W, self.b
+        if output_ids is not None:
+            assert not self.use_layer_norm
+            W = tf.gather(W, output_ids, axis=1)
+            b = tf.gather(b, output_ids)
         if input_is_3d:
-            y = matmul3d(x, self.W) + self.b
+            y = matmul3d(x, W) + b
         else:
-            y = tf.matmul(x, self.W) + self.b
+            y = tf.matmul(x, W) + b
         if self.use_layer_norm:
             y = self.layer_norm.forward(y)
         y = self.non_linearity(y)
@@ -157,7 +169,8 @@ class GRUStep(object):
                  use_layer_norm=False,
                  legacy_bias_type=LegacyBiasType.NEMATUS_COMPAT_FALSE,
                  dropout_input=None,
-                 dropout_state=None):
+                 dropout_state=None,
+                 fused=False):
         init = tf.concat([initializers.ortho_weight(state_size),
                           initializers.ortho_weight(state_size)],
                          axis=1)
@@ -190,6 +203,7 @@ class GRUStep(object):
             self.proposal_bias = tf.get_variable('proposal_bias', [state_size],
                                              initializer=tf.zeros_initializer)
 
+        self.state_size = state_size
         self.legacy_bias_type = legacy_bias_type
         self.use_layer_norm = use_layer_norm
 
@@ -226,6 +240,60 @@ class GRUStep(object):
             self.dropout_mask_state_to_gates = dropout_state(ones)
             self.dropout_mask_state_to_proposal = dropout_state(ones)
 
+        # The fused implementation computes the gates and proposal
+        # pre-activations with a single matrix multiply (for each of the
+        # state and the input) by concatenating the existing weight matrices
+        # and biases, so variable names and checkpoints are unchanged. It
+        # can't be used with layer normalization, which normalizes the gates
+        # and proposal separately, and the state (input) part can't be used
+        # with state (input) dropout, which uses separate masks.
+        self.fused_state = (fused and not use_layer_norm
+                            and dropout_state == None)
+        self.fused_x = (fused and not use_layer_norm and input_size > 0
+                        and dropout_input == None)
+        if self.fused_state:
+            self.state_to_gates_and_proposal = tf.concat(
+                [self.state_to_gates, self.state_to_proposal], axis=1)
+        if self.fused_x:
+            self.input_to_gates_and_proposal = tf.concat(
+                [self.input_to_gates, self.input_to_proposal], axis=1)
+        if (fused and self.gates_bias is not None
+            and self.proposal_bias is not None):
+            self.gates_and_proposal_bias = tf.concat(
+                [self.gates_bias, self.proposal_bias], axis=0)
+        else:
+            self.gates_and_proposal_bias = None
+
+    def _get_fused_bias(self, x_is_input):
+        """Returns the concatenated bias if it is applied to x / the state."""
+        bias_is_on_input = (
+            self.legacy_bias_type == LegacyBiasType.THEANO_A
+            or self.legacy_bias_type == LegacyBiasType.NEMATUS_COMPAT_FALSE)
+        if bias_is_on_input != x_is_input:
+            return None
+        return self.gates_and_proposal_bias
+
+    def _get_fused_x(self, x, input_is_3d=False):
+        """Computes gates_x and proposal_x using a single matrix multiply."""
+        if input_is_3d:
+            fused_x = matmul3d(x, self.input_to_gates_and_proposal)
+        else:
+            fused_x = tf.matmul(x, self.input_to_gates_and_proposal)
+        bias = self._get_fused_bias(x_is_input=True)
+        if bias is not None:
+            fused_x += bias
+        return tf.split(fused_x, [2*self.state_size, self.state_size],
+                        axis=-1)
+
+    def _get_fused_state(self, prev_state):
+        """Computes gates_state and proposal_state using a single matmul."""
+        fused_state = tf.matmul(prev_state, self.state_to_gates_and_proposal)
+        bias = self._get_fused_bias(x_is_input=False)
+        if bias is not None:
+            fused_state += bias
+        return tf.split(fused_state, [2*self.state_size, self.state_size],
+                        axis=-1)
+
     def _get_gates_x(self, x, input_is_3d=False):
         x = apply_dropout_mask(x, self.dropout_mask_input_to_gates, input_is_3d)
         if input_is_3d:
@@ -289,6 +357,8 @@ class GRUStep(object):
         # if x is fully known upfront 
         # this method exists only for efficiency reasons
 
+        if self.fused_x:
+            return self._get_fused_x(x, input_is_3d=True)
         gates_x = self._get_gates_x(x, input_is_3d=True)
         proposal_x = self._get_proposal_x(x, input_is_3d=True)
         return gates_x, proposal_x
@@ -300,10 +370,16 @@ class GRUStep(object):
                 gates_state=None,
                 proposal_x=None,
                 proposal_state=None):
+        if (self.fused_x and gates_x is None and proposal_x is None
+            and x != None):
+            gates_x, proposal_x = self._get_fused_x(x)
         if gates_x is None and x != None:
             gates_x = self._get_gates_x(x) 
         if proposal_x is None and x != None:
             proposal_x = self._get_proposal_x(x) 
+        if (self.fused_state and gates_state is None
+            and proposal_state is None):
+            gates_state, proposal_state = self._get_fused_state(prev_state)
         if gates_state is None:
             gates_state = self._get_gates_state(prev_state) 
         if proposal_state is None:
@@ -345,7 +421,8 @@ class DeepTransitionGRUStep(object):
                  dropout_input=None,
                  dropout_state=None,
                  transition_depth=1,
-                 var_scope_fn=lambda i: "gru{0}".format(i)):
+                 var_scope_fn=lambda i: "gru{0}".format(i),
+                 fused=False):
         self.gru_steps = []
         for i in range(transition_depth):
             with tf.variable_scope(var_scope_fn(i)):
@@ -355,7 +432,8 @@ class DeepTransitionGRUStep(object):
                               use_layer_norm=use_layer_norm,
                               legacy_bias_type=legacy_bias_type,
                               dropout_input=(dropout_input if i == 0 else None),
-                              dropout_state=dropout_state)
+                              dropout_state=dropout_state,
+                              fused=fused)
             self.gru_steps.append(gru)
 
     def precompute_from_x(self, x):
@@ -394,7 +472,8 @@ class GRUStack(object):
                  reverse_alternation=False,
                  context_state_size=0,
                  residual_connections=False,
-                 first_residual_output=0):
+                 first_residual_output=0,
+                 fused=False):
         self.state_size = state_size
         self.batch_size = batch_size
         self.alternating = alternating
@@ -414,7 +493,8 @@ class GRUStack(object):
                     legacy_bias_type=legacy_bias_type,
                     dropout_input=(dropout_input if i == 0 else dropout_state),
                     dropout_state=dropout_state,
-                    transition_depth=transition_depth))
+                    transition_depth=transition_depth,
+                    fused=fused))
 
     # Single timestep version
     def forward_single(self, prev_states, x, context=None):
@@ -552,14 +632,26 @@ class AttentionStep(object):
             self.hidden_from_context = \
                 self.hidden_context_norm.forward(self.hidden_from_context)
 
-    def forward(self, prev_state):
+    @property
+    def inputs(self):
+        """The per-sentence inputs to the attention (see forward)."""
+        return [self.context, self.context_mask, self.hidden_from_context]
+
+    def forward(self, prev_state, inputs=None):
+        # If inputs is given, then it replaces self.inputs and prev_state
+        # only contains states for the corresponding subset of the batch
+        # (e.g. for the unfinished sentences in beam search, which carries
+        # the inputs for those sentences in its loop state).
+        if inputs is None:
+            inputs = self.inputs
+        context, context_mask, hidden_from_context = inputs
         prev_state = apply_dropout_mask(prev_state,
                                         self.dropout_mask_state_to_hidden)
         hidden_from_state = tf.matmul(prev_state, self.state_to_hidden)
         if self.use_layer_norm:
             hidden_from_state = \
                 self.hidden_state_norm.forward(hidden_from_state)
-        hidden = self.hidden_from_context + hidden_from_state
+        hidden = hidden_from_context + hidden_from_state
         hidden = tf.nn.tanh(hidden)
         # context has shape seqLen x batch x context_state_size
         # mask has shape seqLen x batch
@@ -568,10 +660,10 @@ class AttentionStep(object):
         scores = tf.squeeze(scores, axis=2)
         scores = scores - tf.reduce_max(scores, axis=0, keepdims=True)
         scores = tf.exp(scores)
-        scores *= self.context_mask
+        scores *= context_mask
         scores = scores / tf.reduce_sum(scores, axis=0, keepdims=True)
 
-        attention_context = self.context * tf.expand_dims(scores, axis=2)
+        attention_context = context * tf.expand_dims(scores, axis=2)
         attention_context = tf.reduce_sum(attention_context, axis=0, keepdims=False)
 
         return attention_context, scores
@@ -612,6 +704,68 @@ class Masked_cross_entropy_loss(object):
         cost = tf.reduce_sum(cost, axis=0, keepdims=False)
         return cost
 
+class Sampled_cross_entropy_loss(object):
+    """Cross-entropy loss over a sampled subset of the target vocabulary.
+
+    The candidate set contains every target token that occurs in the
+    minibatch plus num_sampled negatives drawn from a log-uniform (Zipfian)
+    distribution, which matches the frequency-sorted vocabularies produced by
+    build_dictionary.py. Logits of the sampled negatives are corrected by
+    subtracting the log of their expected count (Jean et al., 2015), and
+    negatives that coincide with a target token are masked out.
+
+    The caller is responsible for computing logits restricted to
+    self.candidate_ids (e.g. via FeedForwardLayer's output_ids argument).
+    """
+    def __init__(self,
+                 y_true,
+                 y_mask,
+                 vocab_size,
+                 num_sampled):
+        self.y_mask = y_mask
+
+        flat_y = tf.reshape(y_true, [-1])
+        target_ids, label_idxs = tf.unique(flat_y)
+        self.labels = tf.reshape(label_idxs, tf.shape(y_true))
+
+        # The true classes passed to the sampler are irrelevant because we
+        # handle accidental hits ourselves (below), so just pass a dummy.
+        dummy_true_classes = tf.zeros([1, 1], dtype=tf.int64)
+        sampled_ids, _, sampled_expected_count = \
+            tf.nn.log_uniform_candidate_sampler(
+                true_classes=dummy_true_classes,
+                num_true=1,
+                num_sampled=num_sampled,
+                unique=True,
+                range_max=vocab_size)
+        sampled_ids = tf.cast(sampled_ids, dtype=target_ids.dtype)
+
+        accidental_hits = tf.reduce_any(
+            tf.equal(tf.expand_dims(sampled_ids, 1),
+                     tf.expand_dims(target_ids, 0)),
+            axis=1)
+        sampled_bias = -tf.log(sampled_expected_count)
+        sampled_bias = tf.where(accidental_hits,
+                                tf.fill(tf.shape(sampled_bias), -1e9),
+                                sampled_bias)
+
+        # Target tokens are always in the candidate set, so they need no
+        # correction.
+        self.candidate_ids = tf.concat([target_ids, sampled_ids], axis=0)
+        self.candidate_bias = tf.concat(
+            [tf.zeros(tf.shape(target_ids), dtype=tf.float32), sampled_bias],
+            axis=0)
+
+    def forward(self, candidate_logits):
+        logits = candidate_logits + self.candidate_bias
+        cost = tf.losses.sparse_softmax_cross_entropy(
+            labels=self.labels,
+            logits=logits,
+            weights=self.y_mask,
+            reduction=tf.losses.Reduction.NONE)
+        cost = tf.reduce_sum(cost, axis=0, keepdims=False)
+        return cost
+
 class LexicalModel(object):
     def __init__(self,
                  in_size,
@@ -26,6 +26,35 @@ class ModelInputs(object):
             shape=(seq_len, batch_size),
             dtype=tf.float32)
 
+        # Segment IDs are only used if sentences are packed (currently only by
+        # the Transformer when training with pack_sequences). By default, each
+        # row contains a single sentence.
+        self.x_segments = tf.placeholder_with_default(
+            tf.cast(self.x_mask, dtype=tf.int32),
+            name='x_segments',
+            shape=(seq_len, batch_size))
+
+        self.y_segments = tf.placeholder_with_default(
+            tf.cast(self.y_mask, dtype=tf.int32),
+            name='y_segments',
+            shape=(seq_len, batch_size))
+
+        # The number of times each source sentence is repeated in the decoder
+        # (used by RNN beam search, which runs the encoder once per sentence
+        # and then tiles the result in-graph to get one copy per hypothesis).
+        self.decoder_repeats = tf.placeholder_with_default(
+            1,
+            name='decoder_repeats',
+            shape=())
+
+        # Candidate target IDs for vocabulary selection (see
+        # util.get_shortlist_ids). This is only fed to search graphs that were
+        # built to use a shortlist.
+        self.shortlist = tf.placeholder(
+            name='shortlist',
+            shape=(None,),
+            dtype=tf.int32)
+
         self.training = tf.placeholder_with_default(
             False,
             name='training',
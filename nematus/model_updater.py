@@ -3,6 +3,8 @@ import math
 import numpy
 import tensorflow as tf
 
+import util
+
 
 class ModelUpdater(object):
     """Helper class for training using multiple GPUs and/or large minibatches.
@@ -42,7 +44,8 @@ class ModelUpdater(object):
         self._graph = _ModelUpdateGraph(config, num_gpus, replicas, optimizer,
                                         global_step)
 
-    def update(self, session, x, x_mask, y, y_mask, write_summary):
+    def update(self, session, x, x_mask, y, y_mask, write_summary,
+               x_segments=None, y_segments=None):
         """Updates the model for a single minibatch.
 
         Args:
@@ -51,6 +54,10 @@ class ModelUpdater(object):
             y: Numpy array with shape (seq_len, batch_size)
             y_mask: Numpy array with shape (seq_len, batch_size)
             write_summary: Boolean
+            x_segments: Numpy array with shape (seq_len, batch_size) or None
+            y_segments: Numpy array with shape (seq_len, batch_size) or None
+                (the segment arrays are only given if multiple sentences
+                are packed into each row - see util.prepare_packed_data)
 
         Returns:
             The sum of the individual sentence losses. The loss for a sentence
@@ -75,8 +82,16 @@ class ModelUpdater(object):
             n = len(self._replicas) * self._config.gradient_aggregation_steps
             start_points = self._split_minibatch_into_n(x_mask, y_mask, n)
 
-        split_x, split_x_mask, split_y, split_y_mask, weights = \
-            self._split_and_pad_minibatch(x, x_mask, y, y_mask, start_points)
+        split_x, split_x_mask, split_y, split_y_mask, weights, \
+            split_x_segments, split_y_segments = \
+                self._split_and_pad_minibatch(x, x_mask, y, y_mask,
+                                              start_points, x_segments,
+                                              y_segments)
+
+        if x_segments is None:
+            num_sents = x.shape[-1]
+        else:
+            num_sents = int(numpy.sum(numpy.max(x_segments, axis=0)))
 
         # Normalize the weights so that _ModelUpdateGraph can just sum the
         # weighted gradients from each sub-batch (without needing a
@@ -87,7 +102,7 @@ class ModelUpdater(object):
         # maxibatches) contribute less.
         if self._config.token_batch_size == 0:
             # Actual batch size / Max batch size, in sentences
-            scaling_factor = x.shape[-1] / self._config.batch_size
+            scaling_factor = num_sents / self._config.batch_size
         else:
             # Actual batch size / Max batch size, in tokens
             scaling_factor = (x_mask.shape[0] * x_mask.shape[1]) / self._config.token_batch_size
@@ -103,6 +118,11 @@ class ModelUpdater(object):
                 feed_dict[self._replicas[j].inputs.x_mask] = split_x_mask[i+j]
                 feed_dict[self._replicas[j].inputs.y] = split_y[i+j]
                 feed_dict[self._replicas[j].inputs.y_mask] = split_y_mask[i+j]
+                if x_segments is not None:
+                    feed_dict[self._replicas[j].inputs.x_segments] = \
+                        split_x_segments[i+j]
+                    feed_dict[self._replicas[j].inputs.y_segments] = \
+                        split_y_segments[i+j]
                 feed_dict[self._replicas[j].inputs.training] = True
             session.run([self._graph.accum_ops], feed_dict=feed_dict)
 
@@ -121,7 +141,7 @@ class ModelUpdater(object):
         session.run(self._graph.reset_ops)
 
         # Return the sum of the individual sentence losses.
-        return mean_loss_per_sent * x.shape[-1]
+        return mean_loss_per_sent * num_sents
 
     def _split_minibatch_into_n(self, x_mask, y_mask, n):
         """Determines how to split a minibatch into n equal-sized sub-batches.
@@ -225,7 +245,8 @@ class ModelUpdater(object):
 
         return start_points
 
-    def _split_and_pad_minibatch(self, x, x_mask, y, y_mask, start_points):
+    def _split_and_pad_minibatch(self, x, x_mask, y, y_mask, start_points,
+                                 x_segments=None, y_segments=None):
         """Splits a minibatch according to a list of split points.
 
         Args:
@@ -234,11 +255,15 @@ class ModelUpdater(object):
             y: Numpy array with shape (seq_len, batch_size)
             y_mask: Numpy array with shape (seq_len, batch_size)
             start_points: list of zero-based indices
+            x_segments: Numpy array with shape (seq_len, batch_size) or None
+            y_segments: Numpy array with shape (seq_len, batch_size) or None
 
         Returns:
-            Five lists: for each of x, x_mask, y, and y_mask, respectively,
+            Seven lists: for each of x, x_mask, y, and y_mask, respectively,
             a list is returned containing the split version. The fifth list
-            contains the (unnormalized) weights of the sub-batches.
+            contains the (unnormalized) weights of the sub-batches. The last
+            two lists contain the split versions of x_segments and
+            y_segments (or are None if those were not given).
         """
 
         # Split the individual arrays.
@@ -252,6 +277,9 @@ class ModelUpdater(object):
         split_x_mask = split_array(x_mask, start_points)
         split_y = split_array(y, start_points)
         split_y_mask = split_array(y_mask, start_points)
+        if x_segments is not None:
+            split_x_segments = split_array(x_segments, start_points)
+            split_y_segments = split_array(y_segments, start_points)
 
         # Trim arrays so that the seq_len dimension is equal to the longest
         # source / target sentence in the sub-batch (rather than the whole
@@ -260,13 +288,27 @@ class ModelUpdater(object):
         def trim_arrays(arrays, new_seq_lens):
             return [a[..., 0:l, :] for a, l in zip(arrays, new_seq_lens)]
 
-        max_lens = [int(numpy.max(numpy.sum(m, axis=0))) for m in split_x_mask]
+        # If using XLA, round up to keep the number of distinct shapes small.
+        # Since the minibatch was itself padded to a multiple of the bucket
+        # width, this never exceeds the minibatch's seq_len.
+        length_bucket = util.get_length_bucket(self._config)
+
+        def max_seq_len(mask):
+            max_len = int(numpy.max(numpy.sum(mask, axis=0)))
+            return min(util.round_up_length(max_len, length_bucket),
+                       mask.shape[0])
+
+        max_lens = [max_seq_len(m) for m in split_x_mask]
         split_x = trim_arrays(split_x, max_lens)
         split_x_mask = trim_arrays(split_x_mask, max_lens)
+        if x_segments is not None:
+            split_x_segments = trim_arrays(split_x_segments, max_lens)
 
-        max_lens = [int(numpy.max(numpy.sum(m, axis=0))) for m in split_y_mask]
+        max_lens = [max_seq_len(m) for m in split_y_mask]
         split_y = trim_arrays(split_y, max_lens)
         split_y_mask = trim_arrays(split_y_mask, max_lens)
+        if y_segments is not None:
+            split_y_segments = trim_arrays(split_y_segments, max_lens)
 
         # Compute the weight of each sub-batch by summing the number of
         # source and target tokens. Note that this counts actual tokens
@@ -291,11 +333,17 @@ class ModelUpdater(object):
         pad(split_x_mask, padding_size)
         pad(split_y, padding_size)
         pad(split_y_mask, padding_size)
+        if x_segments is not None:
+            pad(split_x_segments, padding_size)
+            pad(split_y_segments, padding_size)
+        else:
+            split_x_segments, split_y_segments = None, None
 
         for i in range(padding_size):
             weights.append(0.0)
 
-        return split_x, split_x_mask, split_y, split_y_mask, weights
+        return (split_x, split_x_mask, split_y, split_y_mask, weights,
+                split_x_segments, split_y_segments)
 
 
 class _ModelUpdateGraph(object):
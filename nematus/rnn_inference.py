@@ -2,7 +2,13 @@ import numpy
 import tensorflow as tf
 
 
-def sample(session, model, x, x_mask, graph=None):
+# Cost given to hypotheses that were removed from the beam by pruning (see
+# _prune_hypotheses). It must be far from the float32 limits, since
+# costs are added to log probabilities of f_min.
+PRUNED_COST = 1e30
+
+
+def sample(session, model, x, x_mask, graph=None, num_samples=1):
     """Randomly samples translations from a RNNModel.
 
     Args:
@@ -11,11 +17,15 @@ def sample(session, model, x, x_mask, graph=None):
         x: Numpy array with shape (factors, max_seq_len, batch_size).
         x_mask: Numpy array with shape (max_seq_len, batch_size).
         graph: a SampleGraph object (to allow reuse if sampling repeatedly).
+        num_samples: number of samples to draw for each input sentence (the
+            encoder is only run once).
 
     Returns:
-        A list of NumPy arrays (one for each input sentence in x).
+        A list of NumPy arrays (num_samples for each input sentence in x,
+        with the samples for each sentence being consecutive).
     """
-    feed_dict = {model.inputs.x: x, model.inputs.x_mask: x_mask}
+    feed_dict = {model.inputs.x: x, model.inputs.x_mask: x_mask,
+                 model.inputs.decoder_repeats: num_samples}
     if graph is None:
         graph = SampleGraph(model)
     sampled_ys = session.run(graph.outputs, feed_dict=feed_dict)
@@ -25,12 +35,14 @@ def sample(session, model, x, x_mask, graph=None):
         sample = numpy.trim_zeros(list(sample), trim='b')
         sample.append(0)
         samples.append(sample)
-    assert len(samples) == x.shape[-1]
+    assert len(samples) == x.shape[-1] * num_samples
     return samples
 
 
 def beam_search(session, models, x, x_mask, beam_size,
-                normalization_alpha=0.0, graph=None):
+                normalization_alpha=0.0, graph=None, prune_relative=0.0,
+                prune_absolute=0.0, early_stopping=False, shortlist=None,
+                extra_outputs=False):
     """Beam search using one or more RNNModels..
 
     If using an ensemble (i.e. more than one model), then at each timestep
@@ -45,67 +57,164 @@ def beam_search(session, models, x, x_mask, beam_size,
         beam_size: beam width.
         normalization_alpha: length normalization hyperparamter.
         graph: a BeamSearchGraph (to allow reuse if searching repeatedly).
+        prune_relative: if > 0, drop hypotheses with a probability less than
+            prune_relative times that of the best hypothesis.
+        prune_absolute: if > 0, drop hypotheses with a log probability more
+            than prune_absolute below that of the best hypothesis.
+        early_stopping: stop searching for a sentence once its best finished
+            hypothesis has a lower cost than its best unfinished hypothesis
+            (ignoring length normalization).
+        shortlist: optional NumPy array of candidate target IDs (see
+            util.get_shortlist_ids); the graph must have been built with
+            use_shortlist=True.
+        extra_outputs: if True, also return the attention weights and word
+            probabilities of each translation; the graph must have been
+            built with extra_outputs=True.
 
     Returns:
         A list of lists of (translation, score) pairs. The outer list contains
         one list for each input sentence in the batch. The inner lists contain
-        k elements (where k is the beam size), sorted by score in ascending
-        order (i.e. best first, assuming lower scores are better).
+        up to k elements (where k is the beam size; there are fewer if
+        hypotheses were pruned), sorted by score in ascending order (i.e.
+        best first, assuming lower scores are better). If extra_outputs is
+        True, then the pairs are replaced by (translation, score, alignment,
+        word_probs) tuples, where alignment is a NumPy array with shape
+        (len(translation), source_len) containing the attention weights
+        (averaged over the models) for each target word and word_probs is a
+        list containing the probability of each target word (the geometric
+        mean of the models' probabilities). Both include the final <EOS>.
     """
-    def normalize(sent, cost):
-        return (sent, cost / (len(sent) ** normalization_alpha))
+    def normalize(hypo):
+        sent, cost = hypo[:2]
+        return (sent, cost / (len(sent) ** normalization_alpha)) + hypo[2:]
 
-    x_repeat = numpy.repeat(x, repeats=beam_size, axis=-1)
-    x_mask_repeat = numpy.repeat(x_mask, repeats=beam_size, axis=-1)
+    # The encoder is run once per sentence; its outputs are repeated in-graph
+    # for each hypothesis (see RNNModel).
     feed_dict = {}
     for model in models:
-        feed_dict[model.inputs.x] = x_repeat
-        feed_dict[model.inputs.x_mask] = x_mask_repeat
+        feed_dict[model.inputs.x] = x
+        feed_dict[model.inputs.x_mask] = x_mask
+        feed_dict[model.inputs.decoder_repeats] = beam_size
+        if shortlist is not None:
+            feed_dict[model.inputs.shortlist] = shortlist
     if graph is None:
-        graph = BeamSearchGraph(models, beam_size)
-    ys, parents, costs = session.run(graph.outputs, feed_dict=feed_dict)
+        graph = BeamSearchGraph(models, beam_size,
+                                use_shortlist=(shortlist is not None),
+                                extra_outputs=extra_outputs)
+    assert graph.extra_outputs == extra_outputs
+    feed_dict[graph.prune_relative] = prune_relative
+    feed_dict[graph.prune_absolute] = prune_absolute
+    feed_dict[graph.early_stopping] = early_stopping
+    outputs = session.run(graph.outputs, feed_dict=feed_dict)
+    if extra_outputs:
+        ys, parents, costs, alignments, word_log_probs = outputs
+        hypotheses = _reconstruct_hypotheses(
+            ys, parents, costs, beam_size, alignments=alignments,
+            word_log_probs=word_log_probs,
+            source_lengths=numpy.sum(x_mask, axis=0).astype('int64'))
+    else:
+        ys, parents, costs = outputs
+        hypotheses = _reconstruct_hypotheses(ys, parents, costs, beam_size)
     beams = []
-    for beam in _reconstruct_hypotheses(ys, parents, costs, beam_size):
+    for beam in hypotheses:
+        beam = [hypo for hypo in beam if hypo[1] < PRUNED_COST]
         if normalization_alpha > 0.0:
-            beam = [normalize(sent, cost) for (sent, cost) in beam]
-        beams.append(sorted(beam, key=lambda sent_cost: sent_cost[1]))
+            beam = [normalize(hypo) for hypo in beam]
+        beams.append(sorted(beam, key=lambda hypo: hypo[1]))
     return beams
 
 
-def _reconstruct_hypotheses(ys, parents, cost, beam_size):
+def _backtrack_step_outputs(outputs, parents):
+    """Collects per-step outputs along the parent pointers of all hypotheses.
+
+    Args:
+        outputs: NumPy array with shape (max_seq_len, beam_size*batch_size,
+            ...) containing an output (e.g. a word ID) for each timestep and
+            row of the beam.
+        parents: NumPy array with shape (max_seq_len, beam_size*batch_size).
+
+    Returns:
+        A NumPy array with shape (beam_size*batch_size, max_seq_len, ...)
+        containing the outputs of each final hypothesis in order.
+    """
+    seq_len, num_hypos = parents.shape
+    hypo_outputs = numpy.zeros((num_hypos,) + outputs.shape[:1] +
+                               outputs.shape[2:], dtype=outputs.dtype)
+    hypo_ids = numpy.arange(num_hypos)
+    for pos in range(seq_len - 1, -1, -1):
+        hypo_outputs[:, pos] = outputs[pos, hypo_ids]
+        hypo_ids = parents[pos, hypo_ids]
+    return hypo_outputs
+
+
+def _backtrack_hypotheses(ys, parents):
+    """Follows the parent pointers of all hypotheses at once.
+
+    Args:
+        ys: NumPy array with shape (max_seq_len, beam_size*batch_size).
+        parents: NumPy array with same shape as ys.
+
+    Returns:
+        A pair (hypos, lengths), where hypos is a NumPy array with shape
+        (beam_size*batch_size, max_seq_len+1) containing the zero-padded
+        translations and lengths is a NumPy array with shape
+        (beam_size*batch_size) giving the length of each translation,
+        including a single trailing <EOS> (i.e. zero).
+    """
+    seq_len, num_hypos = ys.shape
+    hypos = numpy.zeros((num_hypos, seq_len + 1), dtype=ys.dtype)
+    hypos[:, :seq_len] = _backtrack_step_outputs(ys, parents)
+    # Trim trailing zeros, then count one <EOS>.
+    nonzero = (hypos != 0)
+    last_nonzero_pos = seq_len - numpy.argmax(nonzero[:, ::-1], axis=1)
+    lengths = numpy.where(numpy.any(nonzero, axis=1), last_nonzero_pos + 2, 1)
+    return hypos, lengths
+
+
+def _reconstruct_hypotheses(ys, parents, cost, beam_size, alignments=None,
+                            word_log_probs=None, source_lengths=None):
     """Converts raw beam search outputs into a more usable form.
 
     Args:
         ys: NumPy array with shape (max_seq_len, beam_size*batch_size).
         parents: NumPy array with same shape as ys.
-        cost: NumPy array with same shape as ys.
+        cost: NumPy array with shape (beam_size*batch_size).
         beam_size: integer.
+        alignments: optional NumPy array with shape (max_seq_len,
+            beam_size*batch_size, max_source_len) containing the attention
+            weights of each step.
+        word_log_probs: NumPy array with same shape as ys containing the log
+            probability of each step's word (required if alignments is
+            given).
+        source_lengths: NumPy array with shape (batch_size) containing the
+            length of each source sentence (required if alignments is given).
 
     Returns:
-        A list of lists of (translation, score) pairs. The outer list contains
-        one list for each input sentence in the batch. The inner lists contain
-        k elements (where k is the beam size).
+        A list of lists of (translation, score) pairs, or, if alignments is
+        given, (translation, score, alignment, word_probs) tuples (see
+        beam_search). The outer list contains one list for each input
+        sentence in the batch. The inner lists contain k elements (where k
+        is the beam size).
     """
-    def reconstruct_single(ys, parents, hypoId, hypo, pos):
-        if pos < 0:
-            hypo.reverse()
-            return hypo
-        else:
-            hypo.append(ys[pos, hypoId])
-            hypoId = parents[pos, hypoId]
-            return reconstruct_single(ys, parents, hypoId, hypo, pos - 1)
-
+    hypos, lengths = _backtrack_hypotheses(ys, parents)
+    if alignments is not None:
+        hypo_alignments = _backtrack_step_outputs(alignments, parents)
+        hypo_word_probs = numpy.exp(
+            _backtrack_step_outputs(word_log_probs, parents))
     hypotheses = []
     batch_size = ys.shape[1] // beam_size
-    pos = ys.shape[0] - 1
     for batch in range(batch_size):
         hypotheses.append([])
         for beam in range(beam_size):
             i = batch*beam_size + beam
-            hypo = reconstruct_single(ys, parents, i, [], pos)
-            hypo = numpy.trim_zeros(hypo, trim='b') # b for back
-            hypo.append(0)
-            hypotheses[batch].append((hypo, cost[i]))
+            hypo = list(hypos[i, :lengths[i]])
+            if alignments is None:
+                hypotheses[batch].append((hypo, cost[i]))
+                continue
+            alignment = hypo_alignments[i, :lengths[i],
+                                        :source_lengths[batch]]
+            word_probs = list(hypo_word_probs[i, :lengths[i]])
+            hypotheses[batch].append((hypo, cost[i], alignment, word_probs))
     return hypotheses
 
 
@@ -121,23 +230,49 @@ class SampleGraph(object):
 
 """Builds a graph fragment for beam search over one or more RNNModels."""
 class BeamSearchGraph(object):
-    def __init__(self, models, beam_size, normalization_alpha):
+    def __init__(self, models, beam_size, use_shortlist=False,
+                 extra_outputs=False):
         self._beam_size = beam_size
-        self._normalization_alpha = normalization_alpha
-        self._sampled_ys, self._parents, self._cost = \
-            construct_beam_search_ops(models, beam_size)
+        self._use_shortlist = use_shortlist
+        self._extra_outputs = extra_outputs
+        # Pruning settings are fed at run time, so they can vary per call.
+        self._prune_relative = tf.placeholder_with_default(
+            0.0, shape=(), name='prune_relative')
+        self._prune_absolute = tf.placeholder_with_default(
+            0.0, shape=(), name='prune_absolute')
+        self._early_stopping = tf.placeholder_with_default(
+            False, shape=(), name='early_stopping')
+        self._outputs = construct_beam_search_ops(
+            models, beam_size, self._prune_relative, self._prune_absolute,
+            self._early_stopping, use_shortlist, extra_outputs)
 
     @property
     def outputs(self):
-        return (self._sampled_ys, self._parents, self._cost)
+        return self._outputs
+
+    @property
+    def prune_relative(self):
+        return self._prune_relative
+
+    @property
+    def prune_absolute(self):
+        return self._prune_absolute
+
+    @property
+    def early_stopping(self):
+        return self._early_stopping
 
     @property
     def beam_size(self):
         return self._beam_size
 
     @property
-    def normalization_alpha(self):
-        return self._normalization_alpha
+    def use_shortlist(self):
+        return self._use_shortlist
+
+    @property
+    def extra_outputs(self):
+        return self._extra_outputs
 
 
 def construct_sampling_ops(model):
@@ -147,8 +282,9 @@ def construct_sampling_ops(model):
         model: a RNNModel.
 
     Returns:
-        A Tensor with shape (max_seq_len, batch_size) containing one sampled
-        translation for each input sentence in model.inputs.x.
+        A Tensor with shape (max_seq_len, batch_size*repeats) containing one
+        sampled translation for each input sentence in model.inputs.x and
+        each of its repeats in the decoder (see model.inputs.decoder_repeats).
     """
     decoder = model.decoder
     batch_size = tf.shape(decoder.init_state)[0]
@@ -163,6 +299,11 @@ def construct_sampling_ops(model):
         size=decoder.translation_maxlen,
         clear_after_read=True, #TODO: does this help? or will it only introduce bugs in the future?
         name='y_sampled_array')
+    max_lengths = model.sampling_utils.get_max_lengths(
+        model.inputs.x_mask, decoder.translation_maxlen)
+    repeats = model.inputs.decoder_repeats
+    max_lengths = tf.reshape(
+        tf.tile(tf.expand_dims(max_lengths, 1), [1, repeats]), [-1])
     init_loop_vars = [i, decoder.init_state, [decoder.init_state] * high_depth,
                       init_y, init_emb, y_array]
 
@@ -198,7 +339,9 @@ def construct_sampling_ops(model):
         new_y = tf.multinomial(logits, num_samples=1)
         new_y = tf.cast(new_y, dtype=tf.int32)
         new_y = tf.squeeze(new_y, axis=1)
-        new_y = tf.where(tf.equal(prev_y, tf.constant(0, dtype=tf.int32)),
+        new_y = tf.where(tf.logical_or(
+                             tf.equal(prev_y, tf.constant(0, dtype=tf.int32)),
+                             tf.greater_equal(i, max_lengths)),
                          tf.zeros_like(new_y), new_y)
         y_array = y_array.write(index=i, value=new_y)
         new_emb = decoder.y_emb_layer.forward(new_y, factor=0)
@@ -214,7 +357,74 @@ def construct_sampling_ops(model):
     return sampled_ys
 
 
-def construct_beam_search_ops(models, beam_size):
+def _prune_hypotheses(parent_ys, new_ys, new_cost, beam_size, prune_relative,
+                      prune_absolute, early_stopping):
+    """Applies beam pruning and early stopping to one step of beam search.
+
+    Args:
+        parent_ys: Tensor with shape (num_rows) containing the previous word
+            of each new hypothesis' parent (zero if the parent had ended).
+        new_ys: Tensor with shape (num_rows) containing the new words.
+        new_cost: Tensor with shape (num_rows) containing the new costs
+            (log probabilities for extensions of unfinished hypotheses).
+        beam_size: integer.
+        prune_relative, prune_absolute, early_stopping: see beam_search
+            (Python values or scalar Tensors).
+
+    Returns:
+        A pair (new_ys, new_cost), where pruned hypotheses are ended and
+        given a cost of PRUNED_COST.
+    """
+    num_rows = tf.shape(new_ys)[0]
+    f_min = numpy.finfo(numpy.float32).min
+    # Prune. Only candidates that extend an unfinished hypothesis have a
+    # (negative) log probability as their cost; the others are kept as
+    # they are.
+    is_candidate = tf.not_equal(parent_ys, 0)
+    candidate_cost = tf.where(is_candidate, new_cost,
+                              tf.fill([num_rows], f_min))
+    best_cost = tf.reduce_max(tf.reshape(candidate_cost, [-1, beam_size]),
+                              axis=1, keepdims=True)
+    best_cost = tf.reshape(
+        tf.tile(best_cost, [1, beam_size]), [num_rows])
+    threshold = tf.fill([num_rows], f_min)
+    threshold = tf.where(
+        tf.greater(prune_relative, 0.0),
+        tf.maximum(threshold, best_cost + tf.log(
+            tf.maximum(tf.cast(prune_relative, tf.float32), 1e-30))),
+        threshold)
+    threshold = tf.where(
+        tf.greater(prune_absolute, 0.0),
+        tf.maximum(threshold, best_cost - prune_absolute),
+        threshold)
+    pruned = tf.logical_and(is_candidate, tf.less(new_cost, threshold))
+    # Early stopping: if a sentence's best finished hypothesis (including
+    # ones finished at this step) beats its best unfinished one, then no
+    # unfinished hypothesis can overtake it, so prune them all.
+    is_alive = tf.logical_and(tf.not_equal(new_ys, 0),
+                              tf.logical_not(pruned))
+    is_finished = tf.logical_and(tf.equal(new_ys, 0),
+                                 tf.less(tf.abs(new_cost), PRUNED_COST))
+    best_finished = tf.reduce_min(tf.reshape(
+        tf.where(is_finished, tf.abs(new_cost),
+                 tf.fill([num_rows], PRUNED_COST)), [-1, beam_size]),
+        axis=1)
+    best_alive = tf.reduce_max(tf.reshape(
+        tf.where(is_alive, new_cost, tf.fill([num_rows], f_min)),
+        [-1, beam_size]), axis=1)
+    stop = tf.logical_and(early_stopping,
+                          tf.less_equal(best_finished, -best_alive))
+    stop = tf.reshape(tf.tile(tf.expand_dims(stop, 1), [1, beam_size]),
+                      [num_rows])
+    pruned = tf.logical_or(pruned, tf.logical_and(is_alive, stop))
+    new_ys = tf.where(pruned, tf.zeros_like(new_ys), new_ys)
+    new_cost = tf.where(pruned, tf.fill([num_rows], PRUNED_COST), new_cost)
+    return new_ys, new_cost
+
+
+def construct_beam_search_ops(models, beam_size, prune_relative=0.0,
+                              prune_absolute=0.0, early_stopping=False,
+                              use_shortlist=False, extra_outputs=False):
     """Builds a graph fragment for beam search over one or more RNNModels.
 
     Strategy:
@@ -226,6 +436,25 @@ def construct_beam_search_ops(models, beam_size):
         divide idxs by num_classes to get state_idxs
         use gather to get new states
         take the remainder of idxs after num_classes to get new_predicted words
+        optionally prune: end the pruned hypotheses and set their cost to
+            PRUNED_COST (so that they can be filtered out of the results)
+
+    The pruning arguments (see beam_search) can be Python values or scalar
+    Tensors.
+
+    If use_shortlist is True, then logits are only computed for the target
+    IDs fed to each model's inputs.shortlist placeholder (which must be
+    sorted, so that <EOS> comes first). Word indices then refer to positions
+    in the shortlist and are mapped back to target IDs after top k.
+
+    Returns:
+        A tuple (sampled_ys, parents, cost). If extra_outputs is True, then
+        two further Tensors are returned: the attention weights of each step,
+        averaged over the models, with shape (max_seq_len, batch_size,
+        max_source_len), and the log probability of each step's word, with
+        shape (max_seq_len, batch_size), where the log probabilities are
+        averaged over the models. Like sampled_ys, these are ordered by the
+        beam after each step, so they are reconstructed with the parents.
     """
 
     # Get some parameter settings.  For ensembling, some parameters are required
@@ -237,10 +466,28 @@ def construct_beam_search_ops(models, beam_size):
     batch_size = tf.shape(decoder.init_state)[0]
     embedding_size = decoder.embedding_size
     translation_maxlen = decoder.translation_maxlen
-    target_vocab_size = decoder.target_vocab_size
+    if use_shortlist:
+        shortlist = models[0].inputs.shortlist
+        target_vocab_size = tf.shape(shortlist)[0]
+    else:
+        target_vocab_size = decoder.target_vocab_size
     high_depth = 0 if decoder.high_gru_stack == None \
                    else len(decoder.high_gru_stack.grus)
 
+    # Sentences for which all hypotheses have ended are dropped from the loop
+    # state, so that the decoder is only run for the remaining ones. The
+    # loop state then has one row for each hypothesis of an unfinished
+    # sentence, and active_rows maps these to rows of the full batch.
+    # This isn't possible if there are per-step dropout masks (see Decoder).
+    compact = not any(m.decoder.uses_step_dropout for m in models)
+
+    # Hypotheses that reach their sentence's maximum length are forced to end
+    # (see SamplingUtils.get_max_lengths).
+    max_lengths = models[0].sampling_utils.get_max_lengths(
+        models[0].inputs.x_mask, translation_maxlen)
+    row_max_lengths = tf.reshape(
+        tf.tile(tf.expand_dims(max_lengths, 1), [1, beam_size]), [-1])
+
     # Initialize loop variables
     i = tf.constant(0)
     init_ys = -tf.ones(dtype=tf.int32, shape=[batch_size])
@@ -260,31 +507,64 @@ def construct_beam_search_ops(models, beam_size):
                 size=translation_maxlen,
                 clear_after_read=True,
                 name='parent_idx_array')
+    # These are only written if extra_outputs is True.
+    a_array = tf.TensorArray(
+                dtype=tf.float32,
+                size=translation_maxlen,
+                clear_after_read=True,
+                name='alignment_array')
+    wp_array = tf.TensorArray(
+                dtype=tf.float32,
+                size=translation_maxlen,
+                clear_after_read=True,
+                name='word_log_prob_array')
     init_base_states = [m.decoder.init_state for m in models]
     init_high_states = [[m.decoder.init_state] * high_depth for m in models]
+    init_active_rows = tf.range(batch_size)
+    # The per-sentence inputs of each model's attention and (if it has one)
+    # lexical model (see AttentionStep.forward), which are compacted along
+    # with the states.
+    init_sentence_inputs = []
+    for m in models:
+        inputs = list(m.decoder.attstep.inputs)
+        if m.decoder.lexical_layer is not None:
+            inputs.append(m.decoder.x_embs)
+        init_sentence_inputs.append(inputs)
     init_loop_vars = [i, init_base_states, init_high_states, init_ys, init_embs,
-                      init_cost, ys_array, p_array]
+                      init_cost, init_cost, init_active_rows,
+                      init_sentence_inputs, ys_array, p_array, a_array,
+                      wp_array]
 
     # Prepare cost matrix for completed sentences -> Prob(EOS) = 1 and Prob(x) = 0
-    eos_log_probs = tf.constant(
-                        [[0.] + ([f_min]*(target_vocab_size - 1))],
-                        dtype=tf.float32)
-    eos_log_probs = tf.tile(eos_log_probs, multiples=[batch_size,1])
-
-    def cond(i, prev_base_states, prev_high_states, prev_ys, prev_embs, cost, ys_array, p_array):
+    eos_log_probs = tf.expand_dims(
+                        tf.one_hot(0, target_vocab_size, on_value=0.,
+                                   off_value=f_min, dtype=tf.float32),
+                        axis=0)
+
+    def cond(i, prev_base_states, prev_high_states, prev_ys, prev_embs, cost,
+             full_cost, active_rows, sentence_inputs, ys_array, p_array,
+             a_array, wp_array):
         return tf.logical_and(
                 tf.less(i, translation_maxlen),
                 tf.reduce_any(tf.not_equal(prev_ys, 0)))
 
-    def body(i, prev_base_states, prev_high_states, prev_ys, prev_embs, cost, ys_array, p_array):
+    def body(i, prev_base_states, prev_high_states, prev_ys, prev_embs, cost,
+             full_cost, active_rows, sentence_inputs, ys_array, p_array,
+             a_array, wp_array):
+        num_rows = tf.shape(prev_ys)[0]
         # get predictions from all models and sum the log probs
         sum_log_probs = None
+        sum_att_alphas = None
         base_states = [None] * len(models)
         high_states = [None] * len(models)
         for j in range(len(models)):
             d = models[j].decoder
             states1 = d.grustep1.forward(prev_base_states[j], prev_embs[j])
-            att_ctx, att_alphas = d.attstep.forward(states1)
+            att_ctx, att_alphas = d.attstep.forward(
+                states1, sentence_inputs[j][:len(d.attstep.inputs)])
+            if extra_outputs:
+                sum_att_alphas = att_alphas if sum_att_alphas is None \
+                                 else sum_att_alphas + att_alphas
             base_states[j] = d.grustep2.forward(states1, att_ctx)
             if d.high_gru_stack == None:
                 stack_output = base_states[j]
@@ -298,48 +578,132 @@ def construct_beam_search_ops(models, beam_size):
                         prev_high_states[j], base_states[j], context=att_ctx)
 
             if d.lexical_layer is not None:
-                lexical_state = d.lexical_layer.forward(d.x_embs, att_alphas)
+                x_embs = sentence_inputs[j][len(d.attstep.inputs)]
+                lexical_state = d.lexical_layer.forward(x_embs, att_alphas)
             else:
                 lexical_state = None
 
+            candidate_ids = models[j].inputs.shortlist if use_shortlist \
+                            else None
             logits = d.predictor.get_logits(prev_embs[j], stack_output,
-                                            att_ctx, lexical_state, multi_step=False)
+                                            att_ctx, lexical_state, multi_step=False,
+                                            candidate_ids=candidate_ids)
             log_probs = tf.nn.log_softmax(logits) # shape (batch, vocab_size)
             if sum_log_probs == None:
                 sum_log_probs = log_probs
             else:
                 sum_log_probs += log_probs
 
+        # only allow EOS for hypotheses that have reached their maximum length
+        rows_eos_log_probs = tf.tile(eos_log_probs, multiples=[num_rows, 1])
+        capped = tf.greater_equal(
+            i, tf.gather(row_max_lengths, active_rows) if compact
+               else row_max_lengths)
+        sum_log_probs = tf.where(capped, sum_log_probs + rows_eos_log_probs,
+                                 sum_log_probs)
+
         # set cost of EOS to zero for completed sentences so that they are in top k
         # Need to make sure only EOS is selected because a completed sentence might
         # kill ongoing sentences
-        sum_log_probs = tf.where(tf.equal(prev_ys, 0), eos_log_probs, sum_log_probs)
+        sum_log_probs = tf.where(tf.equal(prev_ys, 0), rows_eos_log_probs,
+                                 sum_log_probs)
 
         all_costs = sum_log_probs + tf.expand_dims(cost, axis=1) # TODO: you might be getting NaNs here since -inf is in log_probs
 
         all_costs = tf.reshape(all_costs,
                                shape=[-1, target_vocab_size * beam_size])
-        values, indices = tf.nn.top_k(all_costs, k=beam_size) #the sorted option is by default True, is this needed?
-        new_cost = tf.reshape(values, shape=[batch_size])
+        values, indices = models[0].sampling_utils.beam_top_k(
+            all_costs, beam_size, target_vocab_size)
+        new_cost = tf.reshape(values, shape=[num_rows])
         offsets = tf.range(
                     start = 0,
                     delta = beam_size,
-                    limit = batch_size,
+                    limit = num_rows,
                     dtype=tf.int32)
         offsets = tf.expand_dims(offsets, axis=1)
         survivor_idxs = (indices // target_vocab_size) + offsets
         new_ys = indices % target_vocab_size
-        survivor_idxs = tf.reshape(survivor_idxs, shape=[batch_size])
-        new_ys = tf.reshape(new_ys, shape=[batch_size])
+        survivor_idxs = tf.reshape(survivor_idxs, shape=[num_rows])
+        new_ys = tf.reshape(new_ys, shape=[num_rows])
+        if extra_outputs:
+            # The attention weights and word log probabilities of the new
+            # hypotheses (i.e. those of their parents' step).
+            new_alignments = tf.transpose(tf.gather(
+                sum_att_alphas / len(models), survivor_idxs, axis=1))
+            new_word_log_probs = tf.gather_nd(
+                sum_log_probs,
+                tf.stack([survivor_idxs, new_ys], axis=1)) / len(models)
+        if use_shortlist:
+            new_ys = tf.gather(shortlist, new_ys)
         new_embs = [m.decoder.y_emb_layer.forward(new_ys, factor=0) for m in models]
         new_base_states = [tf.gather(s, indices=survivor_idxs) for s in base_states]
         new_high_states = [[tf.gather(s, indices=survivor_idxs) for s in states] for states in high_states]
-        new_cost = tf.where(tf.equal(new_ys, 0), tf.abs(new_cost), new_cost)
+        new_ys, new_cost = _prune_hypotheses(
+            tf.gather(prev_ys, survivor_idxs), new_ys, new_cost, beam_size,
+            prune_relative, prune_absolute, early_stopping)
 
-        ys_array = ys_array.write(i, value=new_ys)
-        p_array = p_array.write(i, value=survivor_idxs)
+        new_cost = tf.where(tf.equal(new_ys, 0), tf.abs(new_cost), new_cost)
 
-        return i+1, new_base_states, new_high_states, new_ys, new_embs, new_cost, ys_array, p_array
+        if not compact:
+            ys_array = ys_array.write(i, value=new_ys)
+            p_array = p_array.write(i, value=survivor_idxs)
+            if extra_outputs:
+                a_array = a_array.write(i, value=new_alignments)
+                wp_array = wp_array.write(i, value=new_word_log_probs)
+            return i+1, new_base_states, new_high_states, new_ys, new_embs, \
+                   new_cost, new_cost, active_rows, sentence_inputs, \
+                   ys_array, p_array, a_array, wp_array
+
+        # Scatter the results back into the full batch. Finished sentences
+        # (i.e. rows that are no longer active) get <EOS> with themselves as
+        # parent and keep their cost.
+        scatter_idxs = tf.expand_dims(active_rows, axis=1)
+        full_ys = tf.scatter_nd(scatter_idxs, new_ys, shape=[batch_size])
+        full_parents = tf.range(batch_size) + tf.scatter_nd(
+            scatter_idxs, tf.gather(active_rows, survivor_idxs) - active_rows,
+            shape=[batch_size])
+        is_active = tf.scatter_nd(scatter_idxs, tf.ones_like(active_rows),
+                                  shape=[batch_size])
+        full_cost = tf.where(tf.equal(is_active, 1),
+                             tf.scatter_nd(scatter_idxs, new_cost,
+                                           shape=[batch_size]),
+                             full_cost)
+        ys_array = ys_array.write(i, value=full_ys)
+        p_array = p_array.write(i, value=full_parents)
+        if extra_outputs:
+            source_len = tf.shape(new_alignments)[1]
+            a_array = a_array.write(i, value=tf.scatter_nd(
+                scatter_idxs, new_alignments,
+                shape=[batch_size, source_len]))
+            wp_array = wp_array.write(i, value=tf.scatter_nd(
+                scatter_idxs, new_word_log_probs, shape=[batch_size]))
+
+        # Drop the sentences for which all hypotheses have now ended.
+        sentence_is_active = tf.reduce_any(
+            tf.not_equal(tf.reshape(new_ys, [-1, beam_size]), 0), axis=1)
+        row_is_active = tf.reshape(
+            tf.tile(tf.expand_dims(sentence_is_active, 1), [1, beam_size]),
+            [-1])
+        keep = tf.cast(tf.reshape(tf.where(row_is_active), [-1]), tf.int32)
+        new_base_states = [tf.gather(s, keep) for s in new_base_states]
+        new_high_states = [[tf.gather(s, keep) for s in states]
+                           for states in new_high_states]
+        new_embs = [tf.gather(e, keep) for e in new_embs]
+        new_ys = tf.gather(new_ys, keep)
+        new_cost = tf.gather(new_cost, keep)
+        active_rows = tf.gather(active_rows, keep)
+        # The per-sentence inputs are much larger than the states, so they
+        # are only copied at the steps where sentences are dropped.
+        shrunk = tf.less(tf.size(keep), num_rows)
+        def compact_input(t):
+            return tf.cond(shrunk, lambda: tf.gather(t, keep, axis=1),
+                           lambda: t)
+        sentence_inputs = [[compact_input(t) for t in inputs]
+                           for inputs in sentence_inputs]
+
+        return i+1, new_base_states, new_high_states, new_ys, new_embs, \
+               new_cost, full_cost, active_rows, sentence_inputs, ys_array, \
+               p_array, a_array, wp_array
 
 
     final_loop_vars = tf.while_loop(
@@ -347,10 +711,14 @@ def construct_beam_search_ops(models, beam_size):
                         body=body,
                         loop_vars=init_loop_vars,
                         back_prop=False)
-    i, _, _, _, _, cost, ys_array, p_array = final_loop_vars
+    i, _, _, _, _, _, cost, _, _, ys_array, p_array, a_array, wp_array = \
+        final_loop_vars
 
     indices = tf.range(0, i)
     sampled_ys = ys_array.gather(indices)
     parents = p_array.gather(indices)
     cost = tf.abs(cost) #to get negative-log-likelihood
+    if extra_outputs:
+        return sampled_ys, parents, cost, a_array.gather(indices), \
+               wp_array.gather(indices)
     return sampled_ys, parents, cost
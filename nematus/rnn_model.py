@@ -61,21 +61,57 @@ class RNNModel(object):
                                    dropout_embedding, dropout_hidden)
             ctx, embs = self.encoder.get_context(self.inputs.x, self.inputs.x_mask)
 
+        # Repeat the encoder outputs for the decoder, if required (i.e. for
+        # beam search). Each sentence's copies are kept adjacent, as with
+        # numpy.repeat().
+        repeats = self.inputs.decoder_repeats
+        ctx = _repeat_batch(ctx, repeats)
+        embs = _repeat_batch(embs, repeats)
+        x_mask = _repeat_batch(self.inputs.x_mask, repeats)
+
         with tf.variable_scope("decoder"):
             if config.tie_encoder_decoder_embeddings:
                 tied_embeddings = self.encoder.emb_layer
             else:
                 tied_embeddings = None
-            self.decoder = Decoder(config, ctx, embs, self.inputs.x_mask,
+            self.decoder = Decoder(config, ctx, embs, x_mask,
                                    dropout_target, dropout_embedding,
                                    dropout_hidden, tied_embeddings)
-            self.logits = self.decoder.score(self.inputs.y)
+            predictor_inputs = self.decoder.get_predictor_inputs(
+                self.inputs.y)
+            self.logits = self.decoder.predictor.get_logits(
+                *predictor_inputs, multi_step=True)
 
         with tf.variable_scope("loss"):
             self.loss_layer = layers.Masked_cross_entropy_loss(
                 self.inputs.y, self.inputs.y_mask, config.label_smoothing,
                 training=self.inputs.training)
-            self._loss_per_sentence = self.loss_layer.forward(self.logits)
+            if config.sampled_softmax_size == 0:
+                self._loss_per_sentence = self.loss_layer.forward(self.logits)
+            else:
+                # Use the sampled softmax for training only; validation and
+                # scoring still get the exact loss. The full logits are
+                # recomputed inside the branch (rather than using self.logits)
+                # so that they are not evaluated at training time.
+                sampled_loss_layer = layers.Sampled_cross_entropy_loss(
+                    self.inputs.y, self.inputs.y_mask,
+                    vocab_size=config.target_vocab_size,
+                    num_sampled=config.sampled_softmax_size)
+
+                def sampled_softmax_loss():
+                    logits = self.decoder.predictor.get_logits(
+                        *predictor_inputs, multi_step=True,
+                        candidate_ids=sampled_loss_layer.candidate_ids)
+                    return sampled_loss_layer.forward(logits)
+
+                def full_softmax_loss():
+                    logits = self.decoder.predictor.get_logits(
+                        *predictor_inputs, multi_step=True)
+                    return self.loss_layer.forward(logits)
+
+                self._loss_per_sentence = tf.cond(self.inputs.training,
+                                                  sampled_softmax_loss,
+                                                  full_softmax_loss)
             self._loss = tf.reduce_mean(self._loss_per_sentence, keepdims=False)
 
         self.sampling_utils = SamplingUtils(config)
@@ -89,12 +125,29 @@ class RNNModel(object):
         return self._loss
 
 
+def _repeat_batch(t, repeats):
+    """Repeats each element of a time-major Tensor along the batch axis."""
+    shape = tf.shape(t)
+    t = tf.expand_dims(t, axis=2)
+    multiples = tf.concat([[1, 1], [repeats], tf.ones_like(shape[2:])], axis=0)
+    t = tf.tile(t, multiples)
+    new_shape = tf.concat([[shape[0], shape[1]*repeats], shape[2:]], axis=0)
+    static_shape = t.get_shape().as_list()
+    t = tf.reshape(t, new_shape)
+    t.set_shape([None, None] + static_shape[3:])
+    return t
+
+
 class Decoder(object):
     def __init__(self, config, context, x_embs, x_mask,
                  dropout_target, dropout_embedding, dropout_hidden,
                  encoder_embedding_layer=None):
 
         self.dropout_target = dropout_target
+        # Dropout masks for the decoder steps are created with the full batch
+        # size, so beam search can only shrink the batch if there are none.
+        self.uses_step_dropout = (dropout_embedding is not None
+                                  or dropout_hidden is not None)
         batch_size = tf.shape(x_mask)[1]
 
         with tf.variable_scope("initial_state_constructor"):
@@ -140,7 +193,8 @@ class Decoder(object):
                     use_layer_norm=config.rnn_layer_normalization,
                     legacy_bias_type=bias_type,
                     dropout_input=dropout_embedding,
-                    dropout_state=dropout_hidden)
+                    dropout_state=dropout_hidden,
+                    fused=config.rnn_fused_gru)
             with tf.variable_scope("attention"):
                 self.attstep = layers.AttentionStep(
                     context=context,
@@ -164,7 +218,8 @@ class Decoder(object):
                 dropout_input=dropout_hidden,
                 dropout_state=dropout_hidden,
                 transition_depth=config.rnn_dec_base_transition_depth-1,
-                var_scope_fn=lambda i: "gru{0}".format(i+1))
+                var_scope_fn=lambda i: "gru{0}".format(i+1),
+                fused=config.rnn_fused_gru)
 
         with tf.variable_scope("high"):
             if config.rnn_dec_depth == 1:
@@ -186,7 +241,8 @@ class Decoder(object):
                     transition_depth=config.rnn_dec_high_transition_depth,
                     context_state_size=(2*config.state_size if config.rnn_dec_deep_context else 0),
                     residual_connections=True,
-                    first_residual_output=0)
+                    first_residual_output=0,
+                    fused=config.rnn_fused_gru)
 
         if config.rnn_lexical_model:
             with tf.variable_scope("lexical"):
@@ -210,6 +266,18 @@ class Decoder(object):
 
 
     def score(self, y):
+        y_embs, states, attended_states, lexical_states = \
+            self.get_predictor_inputs(y)
+        logits = self.predictor.get_logits(y_embs, states, attended_states, lexical_states, multi_step=True)
+        return logits
+
+    def get_predictor_inputs(self, y):
+        """Runs the decoder recurrence over y (via teacher forcing).
+
+        Returns:
+            A tuple (y_embs, states, attended_states, lexical_states) that can
+            be passed to Predictor.get_logits().
+        """
         with tf.variable_scope("y_embeddings_layer"):
             y_but_last = tf.slice(y, [0,0], [tf.shape(y)[0]-1, -1])
             y_embs = self.y_emb_layer.forward(y_but_last, factor=0)
@@ -252,8 +320,7 @@ class Decoder(object):
         else:
             lexical_states = None
 
-        logits = self.predictor.get_logits(y_embs, states, attended_states, lexical_states, multi_step=True)
-        return logits
+        return y_embs, states, attended_states, lexical_states
 
 class Predictor(object):
     def __init__(self, config, batch_size, dropout_embedding, dropout_hidden, hidden_to_logits_W=None):
@@ -325,7 +392,13 @@ class Predictor(object):
                                 non_linearity=lambda y: y,
                                 dropout_input=dropout_embedding)
 
-    def get_logits(self, y_embs, states, attended_states, lexical_states, multi_step=True):
+    def get_logits(self, y_embs, states, attended_states, lexical_states,
+                   multi_step=True, candidate_ids=None):
+        """Computes the output logits.
+
+        If candidate_ids is given (a 1D Tensor of target vocabulary IDs) then
+        logits are only computed for those IDs, in the given order.
+        """
         with tf.variable_scope("prev_emb_to_hidden"):
             hidden_emb = self.prev_emb_to_hidden.forward(y_embs, input_is_3d=multi_step)
 
@@ -349,14 +422,18 @@ class Predictor(object):
 
         if self.config.softmax_mixture_size == 1:
             with tf.variable_scope("hidden_to_logits"):
-                logits = self.hidden_to_logits.forward(hidden, input_is_3d=multi_step)
+                logits = self.hidden_to_logits.forward(
+                    hidden, input_is_3d=multi_step, output_ids=candidate_ids)
 
             if self.config.rnn_lexical_model:
                 with tf.variable_scope("lexical_to_logits"):
-                    logits += self.lexical_to_logits.forward(lexical_states, input_is_3d=multi_step)
+                    logits += self.lexical_to_logits.forward(
+                        lexical_states, input_is_3d=multi_step,
+                        output_ids=candidate_ids)
 
         else:
             assert self.config.softmax_mixture_size > 1
+            assert candidate_ids is None
             pi_logits = self.hidden_to_pi_logits.forward(hidden,
                                                          input_is_3d=multi_step)
             pi = tf.nn.softmax(pi_logits)
@@ -405,7 +482,8 @@ class Encoder(object):
                 transition_depth=config.rnn_enc_transition_depth,
                 alternating=True,
                 residual_connections=True,
-                first_residual_output=1)
+                first_residual_output=1,
+                fused=config.rnn_fused_gru)
 
         with tf.variable_scope("backward-stack"):
             self.backward_encoder = layers.GRUStack(
@@ -421,7 +499,8 @@ class Encoder(object):
                 alternating=True,
                 reverse_alternation=True,
                 residual_connections=True,
-                first_residual_output=1)
+                first_residual_output=1,
+                fused=config.rnn_fused_gru)
 
     def get_context(self, x, x_mask):
 
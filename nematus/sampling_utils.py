@@ -6,6 +6,10 @@ class SamplingUtils(object):
     def __init__(self, config_or_settings_obj):
         self.sampling_temperature = config_or_settings_obj.sampling_temperature
         self.translation_strategy = config_or_settings_obj.translation_strategy
+        self.fixed_kv_cache = config_or_settings_obj.fixed_kv_cache
+        self.two_stage_top_k = config_or_settings_obj.two_stage_top_k
+        self.max_len_a = config_or_settings_obj.max_len_a
+        self.max_len_b = config_or_settings_obj.max_len_b
 
     def adjust_logits(self, logits):
         if self.sampling_temperature != 1.0:
@@ -14,4 +18,51 @@ class SamplingUtils(object):
 
         return logits
 
+    def get_max_lengths(self, x_mask, translation_maxlen):
+        """Returns the maximum translation length for each source sentence.
+
+        If max_len_a or max_len_b is set, this is
+        max_len_a * source_length + max_len_b (rounded down), otherwise it is
+        translation_maxlen. It never exceeds translation_maxlen.
+
+        Args:
+            x_mask: source mask Tensor with shape (max_seq_len, batch_size).
+            translation_maxlen: integer.
+
+        Returns:
+            An int32 Tensor with shape (batch_size).
+        """
+        batch_size = tf.shape(x_mask)[1]
+        if self.max_len_a == 0 and self.max_len_b == 0:
+            return tf.fill([batch_size], translation_maxlen)
+        # The mask includes the source sentence's <EOS>.
+        source_lengths = tf.reduce_sum(x_mask, axis=0) - 1.
+        max_lengths = tf.floor(self.max_len_a * source_lengths + self.max_len_b)
+        return tf.minimum(tf.cast(max_lengths, tf.int32), translation_maxlen)
+
+    def beam_top_k(self, scores, k, vocab_size):
+        """Selects the top k of the flattened (num_beams * vocab_size) scores
+        for each sentence, like tf.nn.top_k(scores, k).
+
+        With two_stage_top_k, the top k words are first selected separately
+        for each beam entry and then the top k of the resulting k * num_beams
+        candidates are selected. The results are identical (including for
+        ties), but the second stage is over a much smaller set.
+        """
+        if not self.two_stage_top_k:
+            return tf.nn.top_k(scores, k=k)
+        batch_size = tf.shape(scores)[0]
+        # Stage 1: [batch_size * num_beams, k]
+        beam_values, beam_words = tf.nn.top_k(
+            tf.reshape(scores, [-1, vocab_size]), k=k)
+        # Stage 2: [batch_size, k]
+        beam_values = tf.reshape(beam_values, [batch_size, -1])
+        beam_words = tf.reshape(beam_words, [batch_size, -1])
+        values, positions = tf.nn.top_k(beam_values, k=k)
+        batch_ids = tf.tile(tf.expand_dims(tf.range(batch_size), 1), [1, k])
+        words = tf.gather_nd(beam_words, tf.stack([batch_ids, positions], axis=2))
+        # Convert back to indices into the flattened scores.
+        indices = (positions // k) * vocab_size + words
+        return values, indices
+
 
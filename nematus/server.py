@@ -73,9 +73,12 @@ class NematusServer(object):
             translation_request.segments,
             translation_request.settings
         )
+        settings = translation_request.settings
         response_data = {
             'status': TranslationResponse.STATUS_OK,
             'segments': [translation.target_words for translation in translations],
+            'word_alignments': [translation.get_alignment_json() for translation in translations] if settings.get_alignment else None,
+            'word_probabilities': [translation.word_probabilities for translation in translations] if settings.get_word_probs else None,
         }
         translation_response = response_provider(self._style, **response_data)
         logging.debug("RESPONSE - " + repr(translation_response))
@@ -22,6 +22,12 @@ class TranslationRequestNematus(TranslationRequest):
             self.settings.normalization_alpha = request['normalize']
         if 'character_level' in request:
             self.settings.char_level = request['character_level']
+        if 'beam_prune_relative' in request:
+            self.settings.beam_prune_relative = request['beam_prune_relative']
+        if 'beam_prune_absolute' in request:
+            self.settings.beam_prune_absolute = request['beam_prune_absolute']
+        if 'early_stopping' in request:
+            self.settings.early_stopping = request['early_stopping']
         if 'suppress_unk' in request:
             self.settings.suppress_unk = request['suppress_unk']
         if 'return_word_alignment' in request:
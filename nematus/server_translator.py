@@ -25,12 +25,24 @@ class Translation(object):
     """
     Models a translated segment.
     """
-    def __init__(self, source_words, target_words, sentence_id=None, score=0, hypothesis_id=None):
+    def __init__(self, source_words, target_words, sentence_id=None, score=0, hypothesis_id=None, alignment=None, word_probabilities=None):
         self.source_words = source_words
         self.target_words = target_words
         self.sentence_id = sentence_id
         self.score = score
         self.hypothesis_id = hypothesis_id
+        self.alignment = alignment
+        self.word_probabilities = word_probabilities
+
+    def get_alignment_json(self):
+        """
+        Returns the alignment (attention weights) in JSON format (see
+        util.alignment_to_json).
+        """
+        return util.alignment_to_json(self.sentence_id,
+                                      self.source_words.split(),
+                                      self.target_words, self.score,
+                                      self.alignment)
 
 
 class QueueItem(object):
@@ -68,9 +80,13 @@ class Translator(object):
         for model in self._models:
             config = load_config_from_json_file(model)
             setattr(config, 'reload', model)
+            # Dropout is inactive during translation anyway, but building RNN
+            # models without it lets beam search drop finished sentences.
+            setattr(config, 'rnn_use_dropout', False)
             self._options.append(config)
 
-        _, _, _, self._num_to_target = util.load_dictionaries(self._options[0])
+        _, _, _, num_to_target = util.load_dictionaries(self._options[0])
+        self._target_vocab = util.inverse_vocab_array(num_to_target)
 
     def _init_queues(self):
         """
@@ -168,7 +184,12 @@ class Translator(object):
                                             self._options[0].factors,
                                             maxlen=None)
 
-        sample = ensemble.beam_search(sess, x, x_mask, k)
+        sample = ensemble.beam_search(
+            sess, x, x_mask, k,
+            prune_relative=input_item.prune_relative,
+            prune_absolute=input_item.prune_absolute,
+            early_stopping=input_item.early_stopping,
+            extra_outputs=input_item.extra_outputs)
 
         return sample
 
@@ -195,6 +216,10 @@ class Translator(object):
                                    k=translation_settings.beam_size,
                                    normalization_alpha=translation_settings.normalization_alpha,
                                    nbest=translation_settings.n_best,
+                                   prune_relative=translation_settings.beam_prune_relative,
+                                   prune_absolute=translation_settings.beam_prune_absolute,
+                                   early_stopping=translation_settings.early_stopping,
+                                   extra_outputs=(translation_settings.get_alignment or translation_settings.get_word_probs),
                                    batch=batch,
                                    idx=idx,
                                    request_id=translation_settings.request_id)
@@ -251,35 +276,45 @@ class Translator(object):
             logging.info('Translated {} sents'.format(n_sent))
 
         outputs = [beam for batch in outputs for beam in batch]
-        outputs = numpy.array(outputs, dtype=numpy.object)
-        outputs = outputs[idxs.argsort()]
+        # (Not reordered with a NumPy object array, which would try to turn
+        # the hypotheses and alignments into extra dimensions.)
+        outputs = [outputs[i] for i in idxs.argsort()]
 
-        translations = []
-        for i, beam in enumerate(outputs):
+        beams = []
+        for beam in outputs:
             if translation_settings.normalization_alpha:
-                beam = [(sent_cost[0], sent_cost[1]/len(sent_cost[0])** translation_settings.normalization_alpha) for sent_cost in beam]
-            beam = sorted(beam, key=lambda sent_cost1: sent_cost1[1])
+                beam = [(hypo[0], hypo[1]/len(hypo[0])** translation_settings.normalization_alpha) + hypo[2:] for hypo in beam]
+            beam = sorted(beam, key=lambda hypo: hypo[1])
+            if translation_settings.n_best is not True:
+                beam = beam[:1]
+            beams.append(beam)
+
+        # Convert all hypotheses to words at once.
+        all_words = util.seqs2words([hypo[0] for beam in beams for hypo in beam],
+                                    self._target_vocab, join=False)
+        all_words.reverse()
 
+        translations = []
+        for i, beam in enumerate(beams):
             if translation_settings.n_best is True:
                 n_best_list = []
-                for j, (sent, cost) in enumerate(beam):
-                    target_words = util.seq2words(sent, self._num_to_target,
-                                                  join=False)
+                for j, hypo in enumerate(beam):
+                    target_words = all_words.pop()
                     translation = Translation(sentence_id=i,
                                               source_words=source_segments[i],
                                               target_words=target_words,
-                                              score=cost,
-                                              hypothesis_id=j)
+                                              score=hypo[1],
+                                              hypothesis_id=j,
+                                              **self._extra_outputs(hypo))
                     n_best_list.append(translation)
                 translations.append(n_best_list)
             else:
-                best_hypo, cost = beam[0]
-                target_words = util.seq2words(best_hypo, self._num_to_target,
-                                              join=False)
+                target_words = all_words.pop()
                 translation = Translation(sentence_id=i,
                                             source_words=source_segments[i],
                                             target_words=target_words,
-                                            score=cost)
+                                            score=beam[0][1],
+                                            **self._extra_outputs(beam[0]))
                 translations.append(translation)
 
         duration = time.time() - start_time
@@ -287,6 +322,16 @@ class Translator(object):
 
         return translations
 
+    def _extra_outputs(self, hypo):
+        """
+        Returns the alignment and word probabilities of a hypothesis (if it
+        has them) as keyword arguments for Translation.
+        """
+        if len(hypo) < 4:
+            return {}
+        return {'alignment': hypo[2],
+                'word_probabilities': [float(p) for p in hypo[3]]}
+
     def translate_file(self, input_object, translation_settings):
         """
         """
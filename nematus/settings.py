@@ -3,6 +3,7 @@
 """
 Parses console arguments.
 """
+import os
 import sys
 import argparse
 import uuid
@@ -78,11 +79,25 @@ class TranslationSettings(BaseSettings):
                 default=sys.stdin, metavar='PATH',
                 help="input file (default: standard input)")
 
+            # The output file is opened in _set_additional_vars, since it
+            # mustn't be truncated when resuming (see --progress_file).
             self._parser.add_argument(
-                '-o', '--output', type=argparse.FileType('w'),
-                default=sys.stdout, metavar='PATH',
+                '-o', '--output', type=str, default=None, metavar='PATH',
                 help="output file (default: standard output)")
 
+        self._parser.add_argument(
+            '--progress_file', type=str, default=None, metavar='PATH',
+            help="record the input and output positions in PATH after " \
+                 "each maxibatch; if PATH exists, resume from the " \
+                 "recorded positions (requires --input and --output)")
+
+        self._parser.add_argument(
+            '--stream_window', type=float, default=0.0, metavar='SECONDS',
+            help="streaming mode: translate the input as it arrives, " \
+                 "batching the lines that arrive within SECONDS of each " \
+                 "other (up to a maxibatch), and flush the output after " \
+                 "each batch; 0 disables (default: %(default)s)")
+
         self._parser.add_argument(
             '-k', '--beam_size', type=int, default=5, metavar='INT',
             help="beam size (default: %(default)s)")
@@ -108,6 +123,13 @@ class TranslationSettings(BaseSettings):
             help="size of maxibatch (number of minibatches that are sorted " \
                  "by length) (default: %(default)s)")
 
+        self._parser.add_argument(
+            '--token_batch_size', type=int, default=0, metavar='INT',
+            help="minibatch size (expressed in number of source tokens, " \
+                 "including padding and multiplied by the beam size); " \
+                 "minibatches still have at most minibatch_size sentences; " \
+                 "0 disables (default: %(default)s)")
+
         self._parser.add_argument(
             '--sampling_temperature', type=float, default=1.0, nargs="?",
             const=1.0, metavar="FLOAT",
@@ -117,9 +139,138 @@ class TranslationSettings(BaseSettings):
             '--translation_strategy', type=str, choices=['beam_search', 'sampling'], default="beam_search",
             help="translation_strategy, either beam_search or sampling (default: %(default)s)")
 
+        self._parser.add_argument(
+            '--num_samples', type=int, default=1, metavar='INT',
+            help="with sampling, draw INT samples for each sentence and " \
+                 "write them on consecutive lines (default: %(default)s)")
+
+        self._parser.add_argument(
+            '--beam_prune_relative', type=float, default=0.0,
+            metavar='FLOAT',
+            help="RNN only: drop hypotheses whose probability is less than " \
+                 "FLOAT (between 0 and 1) times that of the best " \
+                 "hypothesis; 0 disables (default: %(default)s)")
+
+        self._parser.add_argument(
+            '--beam_prune_absolute', type=float, default=0.0,
+            metavar='FLOAT',
+            help="RNN only: drop hypotheses whose log probability is more " \
+                 "than FLOAT below that of the best hypothesis; 0 disables " \
+                 "(default: %(default)s)")
+
+        self._parser.add_argument(
+            '--early_stopping', action="store_true",
+            help="RNN only: stop beam search for a sentence once its best " \
+                 "finished hypothesis has a lower cost than its best " \
+                 "unfinished one (ignoring length normalization)")
+
+        self._parser.add_argument(
+            '-a', '--output_alignment', type=str, default=None,
+            metavar='PATH',
+            help="RNN only: write the alignment (i.e. attention weights) of " \
+                 "each translation to PATH")
+
+        self._parser.add_argument(
+            '--json_alignment', action="store_true",
+            help="write the alignments in JSON format (as read by " \
+                 "utils/copy_unknown_words.py)")
+
+        self._parser.add_argument(
+            '--print_word_probabilities', action="store_true",
+            help="RNN only: after each translation, write a line with the " \
+                 "probability of each of its words (including the " \
+                 "end-of-sentence token)")
+
+        self._parser.add_argument(
+            '--max_len_a', type=float, default=0.0, metavar='FLOAT',
+            help="limit the length of each translation to FLOAT * source " \
+                 "length + max_len_b (capped at the model's " \
+                 "translation_maxlen); if max_len_a and max_len_b are both " \
+                 "0, only translation_maxlen is used (default: %(default)s)")
+
+        self._parser.add_argument(
+            '--max_len_b', type=int, default=0, metavar='INT',
+            help="see --max_len_a (default: %(default)s)")
+
+        self._parser.add_argument(
+            '--two_stage_top_k', action="store_true",
+            help="in beam search, select the top k words for each " \
+                 "hypothesis before selecting the top k of all candidates " \
+                 "(gives identical results; may be faster for large " \
+                 "vocabularies)")
+
+        self._parser.add_argument(
+            '--shortlist', type=str, default=None, metavar='PATH',
+            help="beam search only: restrict the output layer of each " \
+                 "minibatch to the candidate translations of its source " \
+                 "words, read from PATH (one source word per line, " \
+                 "followed by its candidate target words)")
+
+        self._parser.add_argument(
+            '--shortlist_frequent', type=int, default=100, metavar='INT',
+            help="with --shortlist, also include the INT most frequent " \
+                 "target words (default: %(default)s)")
+
+        self._parser.add_argument(
+            '--fixed_kv_cache', action="store_true",
+            help="Transformer only: store decoder self-attention keys and " \
+                 "values in buffers of size translation_maxlen that are " \
+                 "allocated once and written to one position per step, " \
+                 "instead of concatenating them at every step (beam " \
+                 "search still reorders the whole buffers)")
+
+        self._parser.add_argument(
+            '--translation_cache', type=str, default=None, metavar='PATH',
+            help="beam search only: look up translations in (and add them " \
+                 "to) the SQLite database PATH, which is created if needed; " \
+                 "entries are specific to the models and decoding settings")
+
+        self._parser.add_argument(
+            '--workers', type=int, default=1, metavar='INT',
+            help="translate with INT worker processes, each with its own " \
+                 "copy of the models and an equal share of the CPU cores " \
+                 "(default: %(default)s)")
+
+        self._parser.add_argument(
+            '--xla_jit', action="store_true",
+            help="compile the graph with XLA (just-in-time); source lengths " \
+                 "are padded to a multiple of the model's xla_length_bucket " \
+                 "to limit the number of recompilations")
+
     def _set_additional_vars(self):
         self.request_id = uuid.uuid4()
         self.num_processes = 1
+        # Set per request by the server (see server/api/).
+        self.get_alignment = False
+        self.get_word_probs = False
+        if self._from_console_arguments:
+            if self.progress_file is not None:
+                # Resuming requires seeking in both files.
+                if self.input is sys.stdin or self.output is None:
+                    self._parser.error(
+                        '--progress_file requires --input and --output')
+                # Checked before the alignment file is opened (truncated).
+                if self.output_alignment is not None:
+                    self._parser.error('--progress_file cannot be used ' \
+                                       'with --output_alignment')
+                if self.stream_window > 0.0:
+                    self._parser.error('--progress_file cannot be used ' \
+                                       'with --stream_window')
+                if os.path.exists(self.progress_file) and \
+                   not os.path.exists(self.output):
+                    self._parser.error(
+                        'progress file {} exists, but output file {} does ' \
+                        'not (delete the progress file to start ' \
+                        'over)'.format(self.progress_file, self.output))
+            if self.output is None:
+                self.output = sys.stdout
+            elif self.progress_file is not None and \
+                 os.path.exists(self.progress_file):
+                self.output = open(self.output, 'r+')
+            else:
+                self.output = open(self.output, 'w')
+        if self.output_alignment is not None:
+            self.output_alignment = open(self.output_alignment, 'w')
 
 class ServerSettings(BaseSettings):
     """
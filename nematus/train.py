@@ -49,7 +49,8 @@ def load_data(config):
                         use_factor=(config.factors > 1),
                         maxibatch_size=config.maxibatch_size,
                         token_batch_size=config.token_batch_size,
-                        keep_data_in_memory=config.keep_train_set_in_memory)
+                        keep_data_in_memory=config.keep_train_set_in_memory,
+                        pack_sequences=config.pack_sequences)
 
     if config.valid_freq and config.valid_source_dataset and config.valid_target_dataset:
         valid_text_iterator = TextIterator(
@@ -129,6 +130,11 @@ def train(config, sess):
     updater = ModelUpdater(config, num_gpus, replicas, optimizer, global_step,
                            writer)
 
+    if config.autotune_batch:
+        logging.info('Autotuning minibatch size...')
+        sess.run(tf.global_variables_initializer())
+        autotune_batch_size(sess, config, updater, num_replicas)
+
     saver, progress = model_loader.init_or_restore_variables(
         config, sess, train=True)
 
@@ -144,6 +150,8 @@ def train(config, sess):
 
     text_iterator, valid_text_iterator = load_data(config)
     _, _, num_to_source, num_to_target = util.load_dictionaries(config)
+    source_vocabs = [util.inverse_vocab_array(d) for d in num_to_source]
+    target_vocab = util.inverse_vocab_array(num_to_target)
     total_loss = 0.
     n_sents, n_words = 0, 0
     last_time = time.time()
@@ -155,15 +163,27 @@ def train(config, sess):
                 logging.error('Mismatch between number of factors in settings ({0}), and number in training corpus ({1})\n'.format(config.factors, len(source_sents[0][0])))
                 sys.exit(1)
             x_in, x_mask_in, y_in, y_mask_in = util.prepare_data(
-                source_sents, target_sents, config.factors, maxlen=None)
+                source_sents, target_sents, config.factors, maxlen=None,
+                length_bucket=util.get_length_bucket(config))
             if x_in is None:
                 logging.info('Minibatch with zero sample under length {0}'.format(config.maxlen))
                 continue
             write_summary_for_this_batch = config.summary_freq and ((progress.uidx % config.summary_freq == 0) or (config.finish_after and progress.uidx % config.finish_after == 0))
             (factors, seqLen, batch_size) = x_in.shape
 
-            loss = updater.update(sess, x_in, x_mask_in, y_in, y_mask_in,
-                                  write_summary_for_this_batch)
+            if config.pack_sequences:
+                # The unpacked arrays are still used below for sampling, etc.
+                x_packed, x_mask_packed, y_packed, y_mask_packed, \
+                    x_segments, y_segments = util.prepare_packed_data(
+                        source_sents, target_sents, config.factors,
+                        length_bucket=util.get_length_bucket(config))
+                loss = updater.update(sess, x_packed, x_mask_packed,
+                                      y_packed, y_mask_packed,
+                                      write_summary_for_this_batch,
+                                      x_segments, y_segments)
+            else:
+                loss = updater.update(sess, x_in, x_mask_in, y_in, y_mask_in,
+                                      write_summary_for_this_batch)
             total_loss += loss
             n_sents += batch_size
             n_words += int(numpy.sum(y_mask_in))
@@ -182,10 +202,10 @@ def train(config, sess):
                 x_small, x_mask_small, y_small = x_in[:, :, :10], x_mask_in[:, :10], y_in[:, :10]
                 samples = model_set.sample(sess, x_small, x_mask_small)
                 assert len(samples) == len(x_small.T) == len(y_small.T), (len(samples), x_small.shape, y_small.shape)
-                for xx, yy, ss in zip(x_small.T, y_small.T, samples):
-                    source = util.factoredseq2words(xx, num_to_source)
-                    target = util.seq2words(yy, num_to_target)
-                    sample = util.seq2words(ss, num_to_target)
+                sources = util.factoredseqs2words(x_small.T, source_vocabs)
+                targets = util.seqs2words(y_small.T, target_vocab)
+                samples = util.seqs2words(samples, target_vocab)
+                for source, target, sample in zip(sources, targets, samples):
                     logging.info('SOURCE: {}'.format(source))
                     logging.info('TARGET: {}'.format(target))
                     logging.info('SAMPLE: {}'.format(sample))
@@ -197,13 +217,14 @@ def train(config, sess):
                                                normalization_alpha=config.normalization_alpha)
                 # samples is a list with shape batch x beam x len
                 assert len(samples) == len(x_small.T) == len(y_small.T), (len(samples), x_small.shape, y_small.shape)
-                for xx, yy, ss in zip(x_small.T, y_small.T, samples):
-                    source = util.factoredseq2words(xx, num_to_source)
-                    target = util.seq2words(yy, num_to_target)
+                sources = util.factoredseqs2words(x_small.T, source_vocabs)
+                targets = util.seqs2words(y_small.T, target_vocab)
+                for source, target, ss in zip(sources, targets, samples):
                     logging.info('SOURCE: {}'.format(source))
                     logging.info('TARGET: {}'.format(target))
-                    for i, (sample_seq, cost) in enumerate(ss):
-                        sample = util.seq2words(sample_seq, num_to_target)
+                    hypos = util.seqs2words([seq for seq, _ in ss],
+                                            target_vocab)
+                    for i, (sample, (_, cost)) in enumerate(zip(hypos, ss)):
                         msg = 'SAMPLE {}: {} Cost/Len/Avg {}/{}/{}'.format(
                             i, sample, cost, len(sample), cost/len(sample))
                         logging.info(msg)
@@ -262,6 +283,112 @@ def train(config, sess):
             break
 
 
+def autotune_batch_size(session, config, updater, num_replicas,
+                        min_sents=8, num_steps=3, tolerance=0.05,
+                        patience=2):
+    """Chooses the per-device minibatch size that maximizes throughput.
+
+    Runs timed ModelUpdater.update() calls on synthetic minibatches of
+    maxlen-token sentence pairs, doubling the number of sentences until
+    either the device runs out of memory or throughput drops clearly below
+    the best one seen so far. Each probe is timed over several updates after
+    a warm-up update, and a single probe that is slower by less than the
+    tolerance (e.g. because of timing noise) does not end the search; the
+    fastest probe is chosen. The search also stops after patience probes
+    without improvement, or when the minibatch would exceed a maxibatch
+    (which bounds the minibatch size in training), since not all devices
+    (e.g. CPUs) report running out of memory before the process is killed.
+    config.max_tokens_per_device and, unless it was given, also
+    config.token_batch_size are then set accordingly.
+
+    Note that the probes update the model variables and optimizer state, so
+    these must be (re-)initialized afterwards.
+
+    Args:
+        session: a TensorFlow session.
+        config: the model config (an argparse.Namespace).
+        updater: a ModelUpdater object.
+        num_replicas: the number of model replicas (i.e. devices).
+        min_sents: the number of sentences per device in the first probe.
+        num_steps: the number of timed updates per probe.
+        tolerance: the relative throughput drop (with respect to the best
+            probe) that ends the search.
+        patience: the number of consecutive probes without improvement that
+            ends the search.
+
+    Returns:
+        The chosen number of tokens per device.
+    """
+    # Probe with a single sub-batch per replica.
+    saved_settings = (config.token_batch_size, config.max_tokens_per_device,
+                      config.gradient_aggregation_steps)
+    config.token_batch_size = 0
+    config.max_tokens_per_device = 0
+    config.gradient_aggregation_steps = 1
+
+    seq_len = util.round_up_length(config.maxlen + 1,
+                                   util.get_length_bucket(config))
+    max_sents = config.batch_size * config.maxibatch_size
+    best_tokens, best_tokens_per_sec = None, 0.0
+    num_bad_probes = 0
+    sents_per_device = min_sents
+    while True:
+        batch_size = sents_per_device * num_replicas
+        x = numpy.stack([numpy.random.randint(2, vocab_size,
+                                              size=(seq_len, batch_size))
+                         for vocab_size in config.source_vocab_sizes])
+        y = numpy.random.randint(2, config.target_vocab_size,
+                                 size=(seq_len, batch_size))
+        x_mask = numpy.ones((seq_len, batch_size), dtype='float32')
+        y_mask = numpy.ones((seq_len, batch_size), dtype='float32')
+        tokens = sents_per_device * seq_len
+        try:
+            # The first update includes one-off allocation costs.
+            updater.update(session, x, x_mask, y, y_mask, False)
+            start_time = time.time()
+            for _ in range(num_steps):
+                updater.update(session, x, x_mask, y, y_mask, False)
+            duration = time.time() - start_time
+        except tf.errors.ResourceExhaustedError:
+            logging.info('Batch autotuning: {} tokens per device: out of '
+                         'memory'.format(tokens))
+            break
+        tokens_per_sec = 2 * tokens * num_replicas * num_steps / duration
+        logging.info('Batch autotuning: {} tokens per device: {:.1f} '
+                     'tokens/sec'.format(tokens, tokens_per_sec))
+        if tokens_per_sec > best_tokens_per_sec:
+            best_tokens, best_tokens_per_sec = tokens, tokens_per_sec
+            num_bad_probes = 0
+        elif tokens_per_sec < (1.0 - tolerance) * best_tokens_per_sec:
+            break
+        else:
+            num_bad_probes += 1
+            if num_bad_probes >= patience:
+                break
+        sents_per_device *= 2
+        if sents_per_device * num_replicas > max_sents:
+            logging.info('Batch autotuning: stopping at the maxibatch size '
+                         '({} sentences)'.format(max_sents))
+            break
+
+    config.token_batch_size, config.max_tokens_per_device, \
+        config.gradient_aggregation_steps = saved_settings
+
+    if best_tokens is None:
+        logging.error('Batch autotuning failed: out of memory with {} '
+                      'sentences of length {} per device'.format(
+                          min_sents, config.maxlen))
+        sys.exit(1)
+
+    config.max_tokens_per_device = best_tokens
+    if config.token_batch_size == 0:
+        config.token_batch_size = best_tokens * num_replicas
+    logging.info('Batch autotuning: using token_batch_size={} and '
+                 'max_tokens_per_device={}'.format(
+                     config.token_batch_size, config.max_tokens_per_device))
+    return best_tokens
+
+
 def save_non_checkpoint(session, saver, save_path):
     """Saves the model to a temporary directory then moves it to save_path.
 
@@ -383,8 +510,9 @@ def calc_cross_entropy_per_sentence(session, model, config, text_iterator,
                           '({0}) and number present in data ({1})'.format(
                           config.factors, len(xx[0][0])))
             sys.exit(1)
-        x, x_mask, y, y_mask = util.prepare_data(xx, yy, config.factors,
-                                                 maxlen=None)
+        x, x_mask, y, y_mask = util.prepare_data(
+            xx, yy, config.factors, maxlen=None,
+            length_bucket=util.get_length_bucket(config))
 
         # Run the minibatch through the model to get the sentence-level cross
         # entropy values.
@@ -417,6 +545,9 @@ if __name__ == "__main__":
     # Create the TensorFlow session.
     tf_config = tf.ConfigProto()
     tf_config.allow_soft_placement = True
+    if config.xla_jit:
+        tf_config.graph_options.optimizer_options.global_jit_level = \
+            tf.OptimizerOptions.ON_1
 
     # Train.
     with tf.Session(config=tf_config) as sess:
@@ -9,7 +9,9 @@ from transformer_layers import \
     MaskedCrossEntropy, \
     get_shape_list, \
     get_right_context_mask, \
-    get_positional_signal
+    get_positional_signal, \
+    get_segment_mask, \
+    get_segment_positions
 from transformer_blocks import AttentionBlock, FFNBlock
 from transformer_inference import greedy_search, beam_search
 
@@ -47,15 +49,35 @@ class Transformer(object):
         # Build the training-specific parts of the graph.
 
         with tf.name_scope('{:s}_loss'.format(self.name)):
+            if self.config.pack_sequences:
+                # Rows may contain multiple sentences (see
+                # util.prepare_packed_data), so attention is restricted to
+                # within sentences and each target sentence gets its own <GO>.
+                source_segments = tf.transpose(self.inputs.x_segments,
+                                               perm=[1,0])
+                target_segments = tf.transpose(self.inputs.y_segments,
+                                               perm=[1,0])
+                target_positions = get_segment_positions(target_segments)
+                target_ids_in = tf.where(tf.equal(target_positions, 0),
+                                         tf.ones_like(self.target_ids_in),
+                                         self.target_ids_in)
+            else:
+                source_segments, target_segments = None, None
+                target_ids_in = self.target_ids_in
             # Encode source sequences
             with tf.name_scope('{:s}_encode'.format(self.name)):
                 enc_output, cross_attn_mask = self.enc.encode(
-                    self.source_ids, self.source_mask)
+                    self.source_ids, self.source_mask, source_segments)
+                if self.config.pack_sequences:
+                    cross_attn_mask = get_segment_mask(target_segments,
+                                                       source_segments,
+                                                       self.float_dtype)
             # Decode into target sequences
             with tf.name_scope('{:s}_decode'.format(self.name)):
-                logits = self.dec.decode_at_train(self.target_ids_in,
+                logits = self.dec.decode_at_train(target_ids_in,
                                                   enc_output,
-                                                  cross_attn_mask)
+                                                  cross_attn_mask,
+                                                  target_segments)
             # Instantiate loss layer(s)
             loss_layer = MaskedCrossEntropy(self.dec_vocab_size,
                                             self.config.label_smoothing,
@@ -67,8 +89,21 @@ class Transformer(object):
             masked_loss, sentence_loss, batch_loss = \
                 loss_layer.forward(logits, self.target_ids_out, self.target_mask, self.training)
 
-            sent_lens = tf.reduce_sum(self.target_mask, axis=1, keepdims=False)
-            self._loss_per_sentence = sentence_loss * sent_lens
+            if self.config.pack_sequences:
+                # Sum the token losses separately for each packed sentence,
+                # then drop the empty (row, segment) slots.
+                num_segments = tf.reduce_max(target_segments)
+                segment_one_hot = tf.one_hot(target_segments - 1,
+                                             depth=num_segments,
+                                             dtype=self.float_dtype)
+                loss_per_segment = tf.reduce_sum(
+                    tf.expand_dims(masked_loss, 2) * segment_one_hot, axis=1)
+                segment_lens = tf.reduce_sum(segment_one_hot, axis=1)
+                self._loss_per_sentence = tf.boolean_mask(
+                    loss_per_segment, tf.greater(segment_lens, 0.0))
+            else:
+                sent_lens = tf.reduce_sum(self.target_mask, axis=1, keepdims=False)
+                self._loss_per_sentence = sentence_loss * sent_lens
             self._loss = tf.reduce_mean(self._loss_per_sentence, keepdims=False)
         
         self.sampling_utils = SamplingUtils(config)
@@ -207,8 +242,9 @@ class TransformerEncoder(object):
                 self.encoder_stack[layer_id]['self_attn'] = self_attn_block
                 self.encoder_stack[layer_id]['ffn'] = ffn_block
 
-    def encode(self, source_ids, source_mask):
-        """ Encodes source-side input tokens into meaningful, contextually-enriched representations. """
+    def encode(self, source_ids, source_mask, source_segments=None):
+        """ Encodes source-side input tokens into meaningful, contextually-enriched representations. If
+        source_segments is given, each row may contain multiple packed sentences, which are encoded independently. """
 
         def _prepare_source():
             """ Pre-processes inputs to the encoder and generates the corresponding attention masks."""
@@ -225,7 +261,12 @@ class TransformerEncoder(object):
             self_attn_mask = attn_mask
             cross_attn_mask = attn_mask
             # Add positional encodings
-            positional_signal = get_positional_signal(time_steps, depth, self.float_dtype)
+            if source_segments is None:
+                positional_signal = get_positional_signal(time_steps, depth, self.float_dtype)
+            else:
+                self_attn_mask = get_segment_mask(source_segments, source_segments, self.float_dtype)
+                positional_signal = get_positional_signal(time_steps, depth, self.float_dtype,
+                                                          positions=get_segment_positions(source_segments))
             source_embeddings += positional_signal
             # Apply dropout
             if self.config.transformer_dropout_embeddings > 0:
@@ -281,13 +322,15 @@ class TransformerDecoder(object):
         """ Embeds target-side indices to obtain the corresponding dense tensor representations. """
         return self.embedding_layer.embed(index_sequence)
 
-    def _get_initial_memories(self, batch_size, beam_size):
-        """ Initializes decoder memories used for accelerated inference. """
+    def _get_initial_memories(self, batch_size, beam_size, capacity=0):
+        """ Initializes decoder memories used for accelerated inference; if capacity > 0, the memories are
+        fixed-size buffers that are filled in one time-step at a time, otherwise they are empty and grow with each
+        decoding step. """
         initial_memories = dict()
         for layer_id in range(1, self.config.transformer_dec_depth + 1):
             initial_memories['layer_{:d}'.format(layer_id)] = \
-                {'keys': tf.tile(tf.zeros([batch_size, 0, self.config.state_size]), [beam_size, 1, 1]),
-                 'values': tf.tile(tf.zeros([batch_size, 0, self.config.state_size]), [beam_size, 1, 1])}
+                {'keys': tf.tile(tf.zeros([batch_size, capacity, self.config.state_size]), [beam_size, 1, 1]),
+                 'values': tf.tile(tf.zeros([batch_size, capacity, self.config.state_size]), [beam_size, 1, 1])}
         return initial_memories
 
     def _build_graph(self):
@@ -324,9 +367,10 @@ class TransformerDecoder(object):
                 self.decoder_stack[layer_id]['cross_attn'] = cross_attn_block
                 self.decoder_stack[layer_id]['ffn'] = ffn_block
 
-    def decode_at_train(self, target_ids, enc_output, cross_attn_mask):
+    def decode_at_train(self, target_ids, enc_output, cross_attn_mask, target_segments=None):
         """ Returns the probability distribution over target-side tokens conditioned on the output of the encoder;
-         performs decoding in parallel at training time. """
+         performs decoding in parallel at training time. If target_segments is given, each row may contain multiple
+         packed sentences. """
 
         def _decode_all(target_embeddings):
             """ Decodes the encoder-generated representations into target-side logits in parallel. """
@@ -370,8 +414,14 @@ class TransformerDecoder(object):
                 cross_attn_mask = tf.transpose(cross_attn_mask, [3, 1, 2, 0])
 
             self_attn_mask = get_right_context_mask(tf.shape(target_ids)[-1])
+            if target_segments is None:
+                positions = None
+            else:
+                self_attn_mask += get_segment_mask(target_segments, target_segments, self.float_dtype)
+                positions = get_segment_positions(target_segments)
             positional_signal = get_positional_signal(tf.shape(target_ids)[-1],
                                                       self.config.embedding_size,
-                                                      self.float_dtype)
+                                                      self.float_dtype,
+                                                      positions=positions)
             logits = _decoding_function()
         return logits
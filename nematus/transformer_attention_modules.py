@@ -95,6 +95,13 @@ class MultiHeadAttentionLayer(object):
         values = self.values_projection.forward(memory_context)
         return queries, keys, values
 
+    def compute_memory_projections(self, memory_context):
+        """ Projects the memory context into attention keys and values; allows the static encoder-side inputs to
+        encoder-decoder attention to be computed once per sentence and re-used at every decoding step. """
+        keys = self.keys_projection.forward(memory_context)
+        values = self.values_projection.forward(memory_context)
+        return {'keys': keys, 'values': values}
+
     def _split_among_heads(self, inputs):
         """ Splits the attention inputs among multiple heads. """
         # Retrieve the depth of the input tensor to be split (input is 3d)
@@ -157,21 +164,41 @@ class MultiHeadAttentionLayer(object):
         weighted_memories = tf.matmul(attn_weights, values)
         return weighted_memories
 
-    def forward(self, query_context, memory_context, attn_mask, layer_memories):
-        """ Propagates the input information through the attention layer. """
-        # The context for the query and the referenced memory is identical in case of self-attention
-        if memory_context is None:
-            memory_context = query_context
+    def forward(self, query_context, memory_context, attn_mask, layer_memories, cached_memories=None,
+                memory_position=None):
+        """ Propagates the input information through the attention layer; if given, cached_memories holds the
+        pre-computed keys and values (see compute_memory_projections) and memory_context is ignored. If
+        memory_position is given, layer_memories are fixed-size buffers and the new keys and values are written to
+        that (time-step) position; attention is then restricted to the positions written so far. """
+        if cached_memories is not None:
+            # Only the queries need to be projected
+            queries = self.queries_projection.forward(query_context)
+            keys = cached_memories['keys']
+            values = cached_memories['values']
+        else:
+            # The context for the query and the referenced memory is identical in case of self-attention
+            if memory_context is None:
+                memory_context = query_context
 
-        # Get attention inputs
-        queries, keys, values = self._compute_attn_inputs(query_context, memory_context)
+            # Get attention inputs
+            queries, keys, values = self._compute_attn_inputs(query_context, memory_context)
 
         # Recall and update memories (analogous to the RNN state) - decoder only
         if layer_memories is not None:
-            keys = tf.concat([layer_memories['keys'], keys], axis=1)
-            values = tf.concat([layer_memories['values'], values], axis=1)
-            layer_memories['keys'] = keys
-            layer_memories['values'] = values
+            if memory_position is not None:
+                # Write to a single position of the buffers, whose shape stays fixed, and attend to the prefix
+                num_rows = get_shape_list(keys)[0]
+                indices = tf.stack([tf.range(num_rows), tf.fill([num_rows], memory_position)], axis=1)
+                layer_memories['keys'] = tf.tensor_scatter_nd_update(layer_memories['keys'], indices, keys[:, 0, :])
+                layer_memories['values'] = tf.tensor_scatter_nd_update(layer_memories['values'], indices,
+                                                                       values[:, 0, :])
+                keys = layer_memories['keys'][:, :memory_position + 1, :]
+                values = layer_memories['values'][:, :memory_position + 1, :]
+            else:
+                keys = tf.concat([layer_memories['keys'], keys], axis=1)
+                values = tf.concat([layer_memories['values'], values], axis=1)
+                layer_memories['keys'] = keys
+                layer_memories['values'] = values
 
         # Split attention inputs among attention heads
         split_queries = self._split_among_heads(queries)
@@ -61,13 +61,20 @@ class AttentionBlock(object):
                                          training=training,
                                          name='post_{:s}_sublayer'.format(attn_name))
 
-    def forward(self, inputs, memory_context, attn_mask, layer_memories=None):
+    def compute_memory_projections(self, memory_context):
+        """ Pre-computes the attention keys and values for the given (static) memory context. """
+        return self.attn.compute_memory_projections(memory_context)
+
+    def forward(self, inputs, memory_context, attn_mask, layer_memories=None, cached_memories=None,
+                memory_position=None):
         """ Propagates input data through the block. """
         if not self.self_attention:
-            assert (memory_context is not None), \
+            assert (memory_context is not None or cached_memories is not None), \
                 'Encoder memories have to be provided for encoder-decoder attention computation.'
         attn_inputs = self.pre_attn.forward(inputs)
-        attn_outputs, layer_memories = self.attn.forward(attn_inputs, memory_context, attn_mask, layer_memories)
+        attn_outputs, layer_memories = self.attn.forward(attn_inputs, memory_context, attn_mask, layer_memories,
+                                                         cached_memories=cached_memories,
+                                                         memory_position=memory_position)
         block_out = self.post_attn.forward(attn_outputs, residual_inputs=inputs)
         return block_out, layer_memories
 
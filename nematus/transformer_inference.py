@@ -6,7 +6,7 @@ from transformer_layers import \
     get_shape_list, \
     get_positional_signal
 
-def sample(session, model, x, x_mask, graph=None):
+def sample(session, model, x, x_mask, graph=None, num_samples=1):
     """Randomly samples from a Transformer translation model.
 
     Args:
@@ -15,9 +15,12 @@ def sample(session, model, x, x_mask, graph=None):
         x: Numpy array with shape (factors, max_seq_len, batch_size).
         x_mask: Numpy array with shape (max_seq_len, batch_size).
         graph: a SampleGraph (to allow reuse if sampling repeatedly).
+        num_samples: number of samples to draw for each input sentence (the
+            encoder is only run once).
 
     Returns:
-        A list of NumPy arrays (one for each input sentence in x).
+        A list of NumPy arrays (num_samples for each input sentence in x,
+        with the samples for each sentence being consecutive).
     """
     feed_dict = {}
     feed_dict[model.inputs.x] = x
@@ -25,17 +28,17 @@ def sample(session, model, x, x_mask, graph=None):
     feed_dict[model.training] = False
     if graph is None:
         graph = SampleGraph(model)
+    feed_dict[graph.num_samples] = num_samples
     target_batch, scores = session.run(graph.outputs, feed_dict=feed_dict)
-    assert len(target_batch) == x.shape[-1]
-    assert len(scores) == x.shape[-1]
+    assert len(target_batch) == x.shape[-1] * num_samples
+    assert len(scores) == x.shape[-1] * num_samples
     return target_batch
 
 
 def beam_search(session, models, x, x_mask, beam_size,
-                normalization_alpha=0.0, graph=None):
-    """Beam search using one Transformer translation model (TODO ensemble)
+                normalization_alpha=0.0, graph=None, shortlist=None):
+    """Beam search using one or more Transformer translation models.
 
-    TODO Ensemble
     If using an ensemble (i.e. more than one model), then at each timestep
     the top k tokens are selected according to the sum of the models'
     probabilities (where k is the beam size).
@@ -48,6 +51,9 @@ def beam_search(session, models, x, x_mask, beam_size,
         beam_size: beam width.
         normalization_alpha: length normalization hyperparameter.
         graph: a BeamSearchGraph (to allow reuse if searching repeatedly).
+        shortlist: optional NumPy array of candidate target IDs (see
+            util.get_shortlist_ids); the graph must have been built with
+            use_shortlist=True.
 
     Returns:
         A list of lists of (translation, score) pairs. The outer list has one
@@ -55,14 +61,17 @@ def beam_search(session, models, x, x_mask, beam_size,
         k elements (where k is the beam size), sorted by score in best-first
         order.
     """
-    assert len(models) == 1  # ensembles not supported yet
     feed_dict = {}
     for model in models:
         feed_dict[model.inputs.x] = x
         feed_dict[model.inputs.x_mask] = x_mask
         feed_dict[model.training] = False
+        if shortlist is not None:
+            feed_dict[model.inputs.shortlist] = shortlist
     if graph is None:
-        graph = BeamSearchGraph(models, beam_size, normalization_alpha)
+        graph = BeamSearchGraph(models, beam_size,
+                                use_shortlist=(shortlist is not None))
+    feed_dict[graph.normalization_alpha] = normalization_alpha
     target_batch, scores = session.run(graph.outputs, feed_dict=feed_dict)
     assert len(target_batch) == x.shape[-1]
     assert len(scores) == x.shape[-1]
@@ -77,20 +86,32 @@ def beam_search(session, models, x, x_mask, beam_size,
 """Builds a graph fragment for sampling over a TransformerModel."""
 class SampleGraph(object):
     def __init__(self, model):
-        self._ids, self._scores = construct_sampling_ops(model)
+        # The number of samples per sentence is fed at run time.
+        self._num_samples = tf.placeholder_with_default(
+            1, shape=(), name='num_samples')
+        self._ids, self._scores = construct_sampling_ops(model,
+                                                         self._num_samples)
 
     @property
     def outputs(self):
         return (self._ids, self._scores)
 
+    @property
+    def num_samples(self):
+        return self._num_samples
+
 
 """Builds a graph fragment for beam search over a TransformerModel."""
 class BeamSearchGraph(object):
-    def __init__(self, models, beam_size, normalization_alpha):
+    def __init__(self, models, beam_size, use_shortlist=False):
         self._beam_size = beam_size
-        self._normalization_alpha = normalization_alpha
+        self._use_shortlist = use_shortlist
+        # The normalization alpha is fed at run time, so it can vary per call.
+        self._normalization_alpha = tf.placeholder_with_default(
+            0.0, shape=(), name='normalization_alpha')
         self._outputs = construct_beam_search_ops(models, beam_size,
-                                                  normalization_alpha)
+                                                  self._normalization_alpha,
+                                                  use_shortlist)
 
     @property
     def outputs(self):
@@ -104,71 +125,167 @@ class BeamSearchGraph(object):
     def normalization_alpha(self):
         return self._normalization_alpha
 
+    @property
+    def use_shortlist(self):
+        return self._use_shortlist
 
-def construct_sampling_ops(model):
+
+def construct_sampling_ops(model, num_samples=1):
     """Builds a graph fragment for sampling over a TransformerModel.
 
     Args:
         model: a TransformerModel.
+        num_samples: number of samples per sentence (an integer or scalar
+            Tensor).
 
     Returns:
-        A tuple (ids, scores), where ids is a Tensor with shape (batch_size,
-        max_seq_len) containing one sampled translation for each input sentence
-        in model.inputs.x and scores is a Tensor with shape (batch_size)
+        A tuple (ids, scores), where ids is a Tensor with shape
+        (batch_size*num_samples, max_seq_len) containing num_samples sampled
+        translations for each input sentence in model.inputs.x (consecutively)
+        and scores is a Tensor with shape (batch_size*num_samples)
     """
-    ids, scores = decode_greedy(model, do_sample=True)
+    ids, scores = decode_greedy(model, do_sample=True, num_samples=num_samples)
     return ids, scores
 
 
-def construct_beam_search_ops(models, beam_size, normalization_alpha):
-    """Builds a graph fragment for sampling over a TransformerModel.
+def construct_beam_search_ops(models, beam_size, normalization_alpha,
+                              use_shortlist=False):
+    """Builds a graph fragment for beam search over one or more TransformerModels.
+
+    If using an ensemble (i.e. more than one model), then the models are run
+    in lock-step and their log probabilities are summed at each timestep.
 
     Args:
         models: a list of TransformerModel objects.
+        beam_size: beam width.
+        normalization_alpha: length normalization hyperparameter (a Python
+            value or scalar Tensor).
+        use_shortlist: only compute log probabilities for the target IDs fed
+            to each model's inputs.shortlist placeholder.
 
     Returns:
         A tuple (ids, scores), where ids is a Tensor with shape (batch_size, k,
         max_seq_len) containing k translations for each input sentence in
         model.inputs.x and scores is a Tensor with shape (batch_size, k)
     """
-    assert len(models) == 1
-    model = models[0]
-    ids, scores = decode_greedy(model,
-                                beam_size=beam_size,
-                                normalization_alpha=normalization_alpha)
+    ids, scores = decode_beam(models, beam_size, normalization_alpha,
+                              use_shortlist)
     return ids, scores
 
 
-def decode_greedy(model, do_sample=False, beam_size=0,
-                  normalization_alpha=None):
+def decode_greedy(model, do_sample=False, num_samples=1):
     # Determine size of current batch
     batch_size, _ = get_shape_list(model.source_ids)
-    # Encode source sequences
-    with tf.name_scope('{:s}_encode'.format(model.name)):
-        enc_output, cross_attn_mask = model.enc.encode(model.source_ids,
-                                                       model.source_mask)
+    decoder = model.dec
+    max_prediction_length = decoder.config.translation_maxlen
+    # Multiple samples per sentence share the encoder output, which is tiled like for beam search
+    decoding_function, initial_memories = \
+        get_decoding_function(model, batch_size, num_samples, max_prediction_length)
+    sentence_batch_size = batch_size
+    batch_size = sentence_batch_size * num_samples
     # Decode into target sequences
     with tf.name_scope('{:s}_decode'.format(model.name)):
-        dec_output, scores = decode_at_test(model, model.dec, enc_output,
-            cross_attn_mask, batch_size, beam_size, do_sample, normalization_alpha)
+        # Initialize target IDs with <GO>
+        initial_ids = tf.cast(tf.fill([batch_size, 1], 1), dtype=decoder.int_dtype)
+        max_lengths = model.sampling_utils.get_max_lengths(model.inputs.x_mask, max_prediction_length)
+        max_lengths = tf.tile(max_lengths, [num_samples])
+        dec_output, scores = greedy_search(model,
+                                           decoding_function,
+                                           initial_ids,
+                                           initial_memories,
+                                           decoder.int_dtype,
+                                           decoder.float_dtype,
+                                           max_prediction_length,
+                                           batch_size,
+                                           0,
+                                           do_sample,
+                                           time_major=False,
+                                           max_lengths=max_lengths)
+        # Make each sentence's samples consecutive ([num_samples * batch_size] -> [batch_size * num_samples])
+        dec_output = tf.reshape(tf.transpose(tf.reshape(dec_output, [num_samples, sentence_batch_size, -1]),
+                                             [1, 0, 2]), [batch_size, -1])
+        scores = tf.reshape(tf.transpose(tf.reshape(scores, [num_samples, sentence_batch_size])), [-1])
     return dec_output, scores
 
 
-def decode_at_test(model, decoder, enc_output, cross_attn_mask, batch_size, beam_size, do_sample, normalization_alpha):
-    """ Returns the probability distribution over target-side tokens conditioned on the output of the encoder;
-     performs decoding via auto-regression at test time. """
+def decode_beam(models, beam_size, normalization_alpha, use_shortlist=False):
+    # Parameters that must be consistent across an ensemble (e.g. the target
+    # vocabulary) are taken from the first model, as are translation_maxlen
+    # and the data types.
+    decoder = models[0].dec
+    batch_size, _ = get_shape_list(models[0].source_ids)
+    max_prediction_length = decoder.config.translation_maxlen
+    decoding_functions = []
+    initial_memories = []
+    for model in models:
+        output_ids = model.inputs.shortlist if use_shortlist else None
+        decoding_function, model_memories = \
+            get_decoding_function(model, batch_size, beam_size, max_prediction_length, output_ids)
+        decoding_functions.append(decoding_function)
+        initial_memories.append(model_memories)
+
+    def _ensemble_decoding_function(step_target_ids, current_time_step, memories):
+        """ Sums the log probabilities of the ensemble members; memories contains one entry per model. """
+        sum_log_probs = None
+        new_memories = []
+        for decoding_function, model_memories in zip(decoding_functions, memories):
+            step_logits, model_memories = decoding_function(step_target_ids, current_time_step, model_memories)
+            log_probs = tf.nn.log_softmax(step_logits, axis=-1)
+            if sum_log_probs is None:
+                sum_log_probs = log_probs
+            else:
+                sum_log_probs += log_probs
+            new_memories.append(model_memories)
+        return sum_log_probs, new_memories
+
+    with tf.name_scope('{:s}_decode'.format(models[0].name)):
+        # Initialize target IDs with <GO>
+        initial_ids = tf.cast(tf.fill([batch_size], 1), dtype=decoder.int_dtype)
+        max_lengths = models[0].sampling_utils.get_max_lengths(models[0].inputs.x_mask, max_prediction_length)
+        # With a shortlist, the log probabilities only cover the shortlisted target IDs
+        output_ids = models[0].inputs.shortlist if use_shortlist else None
+        vocab_size = decoder.embedding_layer.get_vocab_size() if output_ids is None else tf.shape(output_ids)[0]
+        output_sequences, scores = _beam_search(_ensemble_decoding_function,
+                                                initial_ids,
+                                                initial_memories,
+                                                decoder.int_dtype,
+                                                decoder.float_dtype,
+                                                max_prediction_length,
+                                                batch_size,
+                                                beam_size,
+                                                vocab_size,
+                                                0,
+                                                normalization_alpha,
+                                                models[0].sampling_utils,
+                                                max_lengths,
+                                                output_ids)
+    return output_sequences, scores
+
+
+def get_decoding_function(model, batch_size, beam_size, max_prediction_length, output_ids=None):
+    """ Encodes the source sequences and returns a function that performs a single decoding step via auto-regression
+    at test time (returning logits over target-side tokens), together with the initial decoder memories; beam_size
+    is the number of hypotheses decoded per source sentence (1 for greedy decoding and sampling). If output_ids is
+    given, the logits are restricted to these target-side tokens. """
+    decoder = model.dec
 
-    def _decode_step(target_embeddings, memories):
+    def _decode_step(target_embeddings, current_time_step, memories):
         """ Decode the encoder-generated representations into target-side logits with auto-regression. """
         # Propagate inputs through the encoder stack
         dec_output = target_embeddings
-        # NOTE: No self-attention mask is applied at decoding, as future information is unavailable
+        # NOTE: No self-attention mask is needed, as future information is unavailable; fixed-size memories are
+        # written at the current time-step, and only the positions up to it are attended to
+        self_attn_mask = None
+        memory_position = current_time_step - 1 if fixed_kv_cache else None
         for layer_id in range(1, decoder.config.transformer_dec_depth + 1):
             dec_output, memories['layer_{:d}'.format(layer_id)] = \
                 decoder.decoder_stack[layer_id]['self_attn'].forward(
-                    dec_output, None, None, memories['layer_{:d}'.format(layer_id)])
+                    dec_output, None, self_attn_mask, memories['layer_{:d}'.format(layer_id)],
+                    memory_position=memory_position)
             dec_output, _ = \
-                decoder.decoder_stack[layer_id]['cross_attn'].forward(dec_output, enc_output, cross_attn_mask)
+                decoder.decoder_stack[layer_id]['cross_attn'].forward(
+                    dec_output, None, cross_attn_mask,
+                    cached_memories=cross_attn_memories['layer_{:d}'.format(layer_id)])
             dec_output = decoder.decoder_stack[layer_id]['ffn'].forward(dec_output)
         # Return prediction at the final time-step to be consistent with the inference pipeline
         dec_output = dec_output[:, -1, :]
@@ -188,55 +305,43 @@ def decode_at_test(model, decoder, enc_output, cross_attn_mask, batch_size, beam
 
     def _decoding_function(step_target_ids, current_time_step, memories):
         """ Generates logits for the target-side token predicted for the next-time step with auto-regression. """
-        # Embed the model's predictions up to the current time-step; add positional information, mask
-        target_embeddings = _pre_process_targets(step_target_ids, current_time_step)
-        # Pass encoder context and decoder embeddings through the decoder
-        dec_output, memories = _decode_step(target_embeddings, memories)
-        # Project decoder stack outputs and apply the soft-max non-linearity
-        step_logits = decoder.softmax_projection_layer.project(dec_output)
+        with tf.variable_scope(decoder.name):
+            # Embed the model's predictions up to the current time-step; add positional information, mask
+            target_embeddings = _pre_process_targets(step_target_ids, current_time_step)
+            # Pass encoder context and decoder embeddings through the decoder
+            dec_output, memories = _decode_step(target_embeddings, current_time_step, memories)
+            # Project decoder stack outputs and apply the soft-max non-linearity
+            step_logits = decoder.softmax_projection_layer.project(dec_output, output_ids)
         return step_logits, memories
 
+    # Encode source sequences
+    with tf.name_scope('{:s}_encode'.format(model.name)):
+        enc_output, cross_attn_mask = model.enc.encode(model.source_ids,
+                                                       model.source_mask)
+
     with tf.variable_scope(decoder.name):
         # Transpose encoder information in hybrid models
         if decoder.from_rnn:
             enc_output = tf.transpose(enc_output, [1, 0, 2])
             cross_attn_mask = tf.transpose(cross_attn_mask, [3, 1, 2, 0])
 
-        positional_signal = get_positional_signal(decoder.config.translation_maxlen,
+        # Project the encoder output into cross-attention keys and values once, rather than at every decoding step;
+        # for beam search, keys, values and mask are also tiled to the beam layout (beam-major, as for the memories)
+        cross_attn_memories = dict()
+        for layer_id in range(1, decoder.config.transformer_dec_depth + 1):
+            layer_memories = decoder.decoder_stack[layer_id]['cross_attn'].compute_memory_projections(enc_output)
+            cross_attn_memories['layer_{:d}'.format(layer_id)] = \
+                {key: tf.tile(value, [beam_size, 1, 1]) for key, value in layer_memories.items()}
+        cross_attn_mask = tf.tile(cross_attn_mask, [beam_size, 1, 1, 1])
+
+        positional_signal = get_positional_signal(max_prediction_length,
                                                   decoder.config.embedding_size,
                                                   decoder.float_dtype)
-        if beam_size > 0:
-            # Initialize target IDs with <GO>
-            initial_ids = tf.cast(tf.fill([batch_size], 1), dtype=decoder.int_dtype)
-            initial_memories = decoder._get_initial_memories(batch_size, beam_size=beam_size)
-            output_sequences, scores = _beam_search(_decoding_function,
-                                                   initial_ids,
-                                                   initial_memories,
-                                                   decoder.int_dtype,
-                                                   decoder.float_dtype,
-                                                   decoder.config.translation_maxlen,
-                                                   batch_size,
-                                                   beam_size,
-                                                   decoder.embedding_layer.get_vocab_size(),
-                                                   0,
-                                                   normalization_alpha)
-
-        else:
-            # Initialize target IDs with <GO>
-            initial_ids = tf.cast(tf.fill([batch_size, 1], 1), dtype=decoder.int_dtype)
-            initial_memories = decoder._get_initial_memories(batch_size, beam_size=1)
-            output_sequences, scores = greedy_search(model,
-                                                     _decoding_function,
-                                                     initial_ids,
-                                                     initial_memories,
-                                                     decoder.int_dtype,
-                                                     decoder.float_dtype,
-                                                     decoder.config.translation_maxlen,
-                                                     batch_size,
-                                                     0,
-                                                     do_sample,
-                                                     time_major=False)
-    return output_sequences, scores
+        # Optionally use self-attention memories of a fixed capacity, rather than growing them at every step
+        fixed_kv_cache = model.sampling_utils.fixed_kv_cache
+        memory_capacity = max_prediction_length if fixed_kv_cache else 0
+        initial_memories = decoder._get_initial_memories(batch_size, beam_size=beam_size, capacity=memory_capacity)
+    return _decoding_function, initial_memories
 
 
 """ Inference functions for the transformer model. The generative process follows the 'Look, Generate, Update' paradigm, 
@@ -267,9 +372,11 @@ def compute_batch_indices(batch_size, beam_size):
 
 def get_memory_invariants(memories):
     """ Calculates the invariant shapes for the model memories (i.e. states of th RNN ar layer-wise attentions of the
-    transformer). """
+    transformer); for ensembles, memories is a list with one dictionary per model. """
     memory_type = type(memories)
-    if memory_type == dict:
+    if memory_type == list:
+        memory_invariants = [get_memory_invariants(model_memories) for model_memories in memories]
+    elif memory_type == dict:
         memory_invariants = dict()
         for layer_id in memories.keys():
             memory_invariants[layer_id] = {key: tf.TensorShape([None] * len(get_shape_list(memories[layer_id][key])))
@@ -279,14 +386,19 @@ def get_memory_invariants(memories):
     return memory_invariants
 
 
-# Seems to work alright
 def gather_memories(memory_dict, gather_coordinates):
     """ Gathers layer-wise memory tensors corresponding to top sequences from the provided memory dictionary
-    during beam search. """
+    during beam search; for ensembles, memory_dict is a list with one dictionary per model. """
+    if type(memory_dict) == list:
+        return [gather_memories(model_memories, gather_coordinates) for model_memories in memory_dict]
     # Initialize dicts
     gathered_memories = dict()
     # Get coordinate shapes
     coords_dims = get_shape_list(gather_coordinates)
+    # Memories are stored beam-major, i.e. the memory for (batch b, beam k) is found in row (k * batch_size + b);
+    # convert the [batch_size, beam_size, 2] coordinates into a flat list of rows in the same (beam-major) order
+    flat_indices = gather_coordinates[:, :, 1] * coords_dims[0] + gather_coordinates[:, :, 0]
+    flat_indices = tf.reshape(tf.transpose(flat_indices, [1, 0]), [-1])
 
     # Gather
     for layer_key in memory_dict.keys():
@@ -294,14 +406,7 @@ def gather_memories(memory_dict, gather_coordinates):
         gathered_memories[layer_key] = dict()
 
         for attn_key in layer_dict.keys():
-            attn_tensor = layer_dict[attn_key]
-            attn_dims = get_shape_list(attn_tensor)
-            # Not sure if this is faster than the 'memory-less' version
-            flat_tensor = \
-                tf.transpose(tf.reshape(attn_tensor, [-1, coords_dims[0]] + attn_dims[1:]), [1, 0, 2, 3])
-            gathered_values = tf.reshape(tf.transpose(tf.gather_nd(flat_tensor, gather_coordinates), [1, 0, 2, 3]),
-                                         [tf.multiply(coords_dims[1], coords_dims[0])] + attn_dims[1:])
-            gathered_memories[layer_key][attn_key] = gathered_values
+            gathered_memories[layer_key][attn_key] = tf.gather(layer_dict[attn_key], flat_indices)
 
     return gathered_memories
 
@@ -346,14 +451,16 @@ def greedy_search(model,
                   batch_size,
                   eos_id,
                   do_sample,
-                  time_major):
-    """ Greedily decodes the target sequence conditioned on the output of the encoder and the current output prefix. """
+                  time_major,
+                  max_lengths=None):
+    """ Greedily decodes the target sequence conditioned on the output of the encoder and the current output prefix;
+    if given, max_lengths holds the maximum length for each sentence, after which <EOS> is forced. """
 
     # Declare time-dimension
     time_dim = int(not time_major)  # i.e. 0 if time_major, 1 if batch_major
 
     # Define the 'body for the tf.while_loop() call
-    def _decoding_step(current_time_step, all_finished, next_ids, decoded_ids, decoded_score, memories):
+    def _decoding_step(current_time_step, all_finished, next_ids, decoded_ids_array, decoded_score, memories):
         """ Defines a single step of greedy decoding. """
         # Propagate through decoder
         step_logits, memories = decoding_function(next_ids, current_time_step, memories)
@@ -366,18 +473,21 @@ def greedy_search(model,
         else:
             # Greedy decoding
             next_ids = tf.argmax(step_scores, -1, output_type=int_dtype)
+        # Force <EOS> for sentences that have reached their maximum length
+        if max_lengths is not None:
+            next_ids = tf.where(tf.greater(current_time_step, max_lengths),
+                                tf.fill([batch_size], tf.cast(eos_id, int_dtype)), next_ids)
         # Collect scores associated with the selected tokens
         score_coordinates = tf.stack([tf.range(batch_size, dtype=int_dtype), next_ids], axis=1)
         decoded_score += tf.gather_nd(step_scores, score_coordinates)
-        # Concatenate newly decoded token ID with the previously decoded ones
-        decoded_ids = tf.concat([decoded_ids, tf.expand_dims(next_ids, 1)], 1)
+        # Store the newly decoded token ID
+        decoded_ids_array = decoded_ids_array.write(current_time_step - 1, next_ids)
+        # Check if generation has concluded with <EOS>
+        all_finished |= tf.equal(next_ids, eos_id)
         # Extend next_id's dimensions to be compatible with input dimensionality for the subsequent step
         next_ids = tf.expand_dims(next_ids, time_dim)
-        # Check if generation has concluded with <EOS>
-        # all_finished |= tf.equal(tf.squeeze(next_ids, axis=time_dim), eos_id)
-        all_finished |= tf.equal(tf.reduce_prod(decoded_ids - eos_id, axis=time_dim), eos_id)
 
-        return current_time_step + 1, all_finished, next_ids, decoded_ids, decoded_score, memories
+        return current_time_step + 1, all_finished, next_ids, decoded_ids_array, decoded_score, memories
 
     # Define the termination condition for the tf.while_loop() call
     def _continue_decoding(_current_time_step, _all_finished, *_):
@@ -393,24 +503,28 @@ def greedy_search(model,
     current_time_step = tf.constant(1)
     all_finished = tf.fill([batch_size], False)  # None of the sequences is marked as finished
     next_ids = initial_ids
-    decoded_ids = tf.zeros([batch_size, 0], dtype=int_dtype)  # Sequence buffer is empty
+    decoded_ids_array = tf.TensorArray(dtype=int_dtype, size=0, dynamic_size=True,
+                                       element_shape=tf.TensorShape([None]))  # Sequence buffer is empty
     decoded_score = tf.zeros([batch_size], dtype=float_dtype)
     memories = initial_memories
 
     # Execute the auto-regressive decoding step via while loop
-    _, _, _, decoded_ids, log_scores, memories = \
+    _, _, _, decoded_ids_array, log_scores, memories = \
         tf.while_loop(cond=_continue_decoding,
                       body=_decoding_step,
-                      loop_vars=[current_time_step, all_finished, next_ids, decoded_ids, decoded_score, memories],
+                      loop_vars=[current_time_step, all_finished, next_ids, decoded_ids_array, decoded_score,
+                                 memories],
                       shape_invariants=[tf.TensorShape([]),
                                         tf.TensorShape([None]),
                                         tf.TensorShape([None, None]),
-                                        tf.TensorShape([None, None]),
+                                        tf.TensorShape(None),
                                         tf.TensorShape([None]),
                                         get_memory_invariants(memories)],
                       parallel_iterations=10,
                       swap_memory=False,
                       back_prop=False)
+    # [time_steps, batch_size] -> [batch_size, time_steps]
+    decoded_ids = tf.transpose(decoded_ids_array.stack(), [1, 0])
 
     # Should return logits also, for training
     return decoded_ids, log_scores
@@ -426,9 +540,17 @@ def _beam_search(decoding_function,
                 beam_size,
                 vocab_size,
                 eos_id,
-                normalization_alpha):
+                normalization_alpha,
+                sampling_utils,
+                max_lengths=None,
+                output_ids=None):
     """ Decodes the target sequence by maintaining a beam of candidate hypotheses, thus allowing for better exploration
     of the hypothesis space; optionally applies scaled length normalization; based on the T2T implementation.
+    Unlike for greedy_search, decoding_function must return log probabilities rather than logits (e.g. the sum of
+    the log probabilities of an ensemble's members); sampling_utils selects the top-k candidates at each step. If
+    given, max_lengths holds the maximum length for each sentence, after which only <EOS> can be selected. If given,
+    output_ids maps positions in the log probabilities to target-side token-IDs (with <EOS> at position eos_id).
+    normalization_alpha can be a Python value or a scalar Tensor (an alpha of 0 disables length normalization).
 
         alive = set of n unfinished hypotheses presently within the beam; n == beam_size
         finished = set of n finished hypotheses, each terminating in <EOS>; n == beam_size
@@ -443,19 +565,23 @@ def _beam_search(decoding_function,
         next_ids = tf.transpose(next_ids, [1, 0])  # [beam_size, batch_size]; transpose to match model
         next_ids = tf.reshape(next_ids, [-1, 1])  # [beam_size * batch_size, 1]
 
-        step_logits, alive_memories = decoding_function(next_ids, current_time_step, alive_memories)
-        step_logits = tf.reshape(step_logits, [beam_size, batch_size, -1])  # [beam_size, batch_size, num_words]
-        step_logits = tf.transpose(step_logits, [1, 0, 2])  # [batch_size, beam_size, num_words]; transpose back
+        step_log_probs, alive_memories = decoding_function(next_ids, current_time_step, alive_memories)
+        step_log_probs = tf.reshape(step_log_probs, [beam_size, batch_size, -1])  # [beam_size, batch_size, num_words]
+        # [batch_size, beam_size, num_words]; transpose back
+        candidate_log_probs = tf.transpose(step_log_probs, [1, 0, 2])
+
+        # Only allow <EOS> for sentences that have reached their maximum length
+        if max_lengths is not None:
+            eos_only = tf.one_hot(eos_id, vocab_size, on_value=0., off_value=-1. * 1e7, dtype=float_dtype)
+            candidate_log_probs = tf.where(tf.greater(current_time_step, max_lengths),
+                                           candidate_log_probs + eos_only, candidate_log_probs)
 
         # Calculate the scores for all possible extensions of alive hypotheses
-        candidate_log_probs = tf.nn.log_softmax(step_logits, axis=-1)
         curr_log_probs = candidate_log_probs + tf.expand_dims(alive_log_probs, axis=2)
 
         # Apply length normalization
-        length_penalty = 1.
-        if normalization_alpha > 0.:
-            length_penalty = ((5. + tf.to_float(current_time_step)) ** normalization_alpha) / \
-                             ((5. + 1.) ** normalization_alpha)
+        length_penalty = ((5. + tf.to_float(current_time_step)) ** normalization_alpha) / \
+                         ((5. + 1.) ** normalization_alpha)
         curr_scores = curr_log_probs / length_penalty
 
         # at first time step, all beams are identical - pick first
@@ -465,7 +591,7 @@ def _beam_search(decoding_function,
                       lambda: tf.reshape(curr_scores, [batch_size, -1]))
 
         # Select top-k highest scores
-        top_scores, top_ids = tf.nn.top_k(flat_curr_scores, k=beam_size)
+        top_scores, top_ids = sampling_utils.beam_top_k(flat_curr_scores, beam_size, vocab_size)
 
         # Recover non-normalized scores for tracking
         top_log_probs = top_scores * length_penalty
@@ -473,6 +599,8 @@ def _beam_search(decoding_function,
         # Determine the beam from which the top-scoring items originate and their identity (i.e. token-ID)
         top_beam_indices = top_ids // vocab_size
         top_ids %= vocab_size
+        if output_ids is not None:
+            top_ids = tf.gather(output_ids, top_ids)
 
         # Determine the location of top candidates
         batch_index_matrix = compute_batch_indices(batch_size, beam_size)  # [batch_size, beam_size]
@@ -582,13 +710,15 @@ def _beam_search(decoding_function,
         length or if none of the extended hypotheses are more likely than the lowest scoring finished hypothesis. """
         # Check if the maximum prediction length has been reached
         length_criterion = tf.less(curr_time_step, translation_maxlen)
+        if max_lengths is not None:
+            # Allow one step beyond the longest maximum length, in which <EOS> is forced
+            length_criterion = tf.logical_and(length_criterion,
+                                              tf.less_equal(curr_time_step, tf.reduce_max(max_lengths) + 1))
 
         # Otherwise, check if the most likely alive hypothesis is less likely than the least probable completed sequence
         # Calculate the best possible score of the most probably sequence currently alive
-        max_length_penalty = 1.
-        if normalization_alpha > 0.:
-            max_length_penalty = ((5. + tf.to_float(translation_maxlen)) ** normalization_alpha) / \
-                                 ((5. + 1.) ** normalization_alpha)
+        max_length_penalty = ((5. + tf.to_float(translation_maxlen)) ** normalization_alpha) / \
+                             ((5. + 1.) ** normalization_alpha)
 
         highest_alive_score = alive_log_probs[:, 0] / max_length_penalty
         # Calculate the score of the least likely sequence currently finished
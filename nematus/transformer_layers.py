@@ -54,9 +54,32 @@ def get_right_context_mask(time_steps):
     return attn_mask
 
 
-def get_positional_signal(time_steps, depth, float_dtype, min_timescale=1, max_timescale=10000):
+def get_segment_mask(query_segments, key_segments, float_dtype):
+    """ Generates the mask preventing tokens from attending to positions outside of their own sentence (segment)
+    when multiple sentences are packed into a single sequence; segment ID 0 denotes padding. """
+    # Shape [batch_size, query_length, key_length]
+    same_segment = tf.equal(tf.expand_dims(query_segments, 2), tf.expand_dims(key_segments, 1))
+    attn_mask = tf.logical_and(same_segment, tf.expand_dims(tf.greater(key_segments, 0), 1))
+    attn_mask = -1e9 * (1.0 - tf.cast(attn_mask, float_dtype))
+    # Expand mask to 4d. so as to be compatible with attention weights
+    return tf.expand_dims(attn_mask, 1)
+
+
+def get_segment_positions(segments):
+    """ Computes the position of each token within its own sentence (segment) for packed sequences. Segments are
+    assumed to be contiguous and numbered in increasing order, with ID 0 denoting trailing padding. """
+    time_steps = get_shape_list(segments)[1]
+    # Count the (non-padding) tokens that belong to preceding segments
+    is_preceding = tf.logical_and(tf.less(tf.expand_dims(segments, 1), tf.expand_dims(segments, 2)),
+                                  tf.expand_dims(tf.greater(segments, 0), 1))
+    num_preceding = tf.reduce_sum(tf.cast(is_preceding, tf.int32), axis=2)
+    return tf.expand_dims(tf.range(time_steps), 0) - num_preceding
+
+
+def get_positional_signal(time_steps, depth, float_dtype, min_timescale=1, max_timescale=10000, positions=None):
     """ Generates a series of sinusoid functions capable of expressing the relative and absolute position
-    of a token within a longer sequence. """
+    of a token within a longer sequence. If positions (shape [batch_size, time_steps]) is given then the signal is
+    generated for those positions, rather than for 0..time_steps-1 (as needed for packed sequences). """
     # Convert to floats
     min_timescale = tf.cast(min_timescale, float_dtype)
     max_timescale = tf.cast(max_timescale, float_dtype)
@@ -67,16 +90,18 @@ def get_positional_signal(time_steps, depth, float_dtype, min_timescale=1, max_t
     incremented_timescales = \
         min_timescale * tf.exp(tf.range(num_timescales, dtype=float_dtype) * -log_timescale_increment)
     # Assign the designated number of time-scales per token position
-    positions = tf.cast(tf.range(time_steps), float_dtype)
-    scaled_time = tf.expand_dims(positions, 1) * tf.expand_dims(incremented_timescales, 0)
-    positional_signal = tf.concat([tf.sin(scaled_time), tf.cos(scaled_time)], axis=1)
+    if positions is None:
+        positions = tf.expand_dims(tf.range(time_steps), 0)
+    positions = tf.cast(positions, float_dtype)
+    scaled_time = tf.expand_dims(positions, 2) * tf.reshape(incremented_timescales, [1, 1, -1])
+    positional_signal = tf.concat([tf.sin(scaled_time), tf.cos(scaled_time)], axis=2)
 
     # Pad the signal tensor, if needed
     pad_size = depth % 2
     if pad_size != 0:
-        tf.pad(positional_signal, [[0, 0], [0, pad_size]])
+        tf.pad(positional_signal, [[0, 0], [0, 0], [0, pad_size]])
     # Reshape the signal to make it compatible with the target tensor
-    positional_signal = tf.reshape(positional_signal, [1, time_steps, depth])
+    positional_signal = tf.reshape(positional_signal, [-1, time_steps, depth])
     return positional_signal
 
 
@@ -107,9 +132,13 @@ class EmbeddingLayer(object):
         embeddings *= tf.sqrt(tf.cast(self.hidden_size, self.float_dtype))
         return embeddings
 
-    def project(self, dec_out):
-        """ Projects the transformer decoder's output into the vocabulary space. """
-        projections = matmul_nd(dec_out, self.projection_matrix)
+    def project(self, dec_out, output_ids=None):
+        """ Projects the transformer decoder's output into the vocabulary space; if output_ids is given, only the
+        projections onto the corresponding vocabulary items are computed, in the given order. """
+        projection_matrix = self.projection_matrix
+        if output_ids is not None:
+            projection_matrix = tf.gather(projection_matrix, output_ids, axis=1)
+        projections = matmul_nd(dec_out, projection_matrix)
         return projections
 
     def get_embedding_table(self):
@@ -4,16 +4,24 @@
 
 import argparse
 import logging
+import multiprocessing
+import queue
+import sys
+import threading
+import time
 
 import tensorflow as tf
 
 from config import load_config_from_json_file
+import exception
 import inference
 import model_loader
 import rnn_model
 from settings import TranslationSettings
 from transformer import Transformer as TransformerModel
 from sampling_utils import SamplingUtils
+from translation_cache import TranslationCache, file_checksum
+import util
 
 
 def main(settings):
@@ -25,19 +33,83 @@ def main(settings):
     level = logging.DEBUG if settings.verbose else logging.INFO
     logging.basicConfig(level=level, format='%(levelname)s: %(message)s')
 
-    # Create the TensorFlow session.
-    tf_config = tf.ConfigProto()
-    tf_config.allow_soft_placement = True
-    session = tf.Session(config=tf_config)
-
     # Load config file for each model.
     configs = []
     for model in settings.models:
         config = load_config_from_json_file(model)
         setattr(config, 'reload', model)
+        # Dropout is inactive during translation anyway, but building RNN
+        # models without it lets beam search drop finished sentences.
+        setattr(config, 'rnn_use_dropout', False)
         configs.append(config)
 
-    # Create the model graphs and restore their variables.
+    # Load the shortlist, if any.
+    shortlist = None
+    if settings.shortlist is not None:
+        shortlist = util.load_shortlist(settings.shortlist, configs[0])
+
+    # Open the translation cache, if any.
+    cache = None
+    if settings.translation_cache is not None:
+        cache = TranslationCache(settings.translation_cache, settings.models,
+                                 get_decoding_settings(settings))
+
+    if settings.workers > 1:
+        translate_with_workers(settings, configs, shortlist, cache)
+        return
+
+    # Create the TensorFlow session and the models.
+    session = create_session(settings)
+    models = load_models(settings, configs, session)
+
+    # Translate the source file.
+    inference.translate_file(input_file=settings.input,
+                             output_file=settings.output,
+                             session=session,
+                             models=models,
+                             configs=configs,
+                             beam_size=settings.beam_size,
+                             nbest=settings.n_best,
+                             minibatch_size=settings.minibatch_size,
+                             maxibatch_size=settings.maxibatch_size,
+                             normalization_alpha=settings.normalization_alpha,
+                             length_bucket=util.get_length_bucket(
+                                 configs[0], settings.xla_jit),
+                             prune_relative=settings.beam_prune_relative,
+                             prune_absolute=settings.beam_prune_absolute,
+                             early_stopping=settings.early_stopping,
+                             shortlist=shortlist,
+                             shortlist_frequent=settings.shortlist_frequent,
+                             token_batch_size=settings.token_batch_size,
+                             cache=cache,
+                             num_samples=settings.num_samples,
+                             progress_file=settings.progress_file,
+                             stream_window=settings.stream_window,
+                             alignment_file=settings.output_alignment,
+                             json_alignment=settings.json_alignment,
+                             word_probabilities=
+                                 settings.print_word_probabilities)
+
+
+def create_session(settings, num_threads=0):
+    """Creates the TensorFlow session.
+
+    If num_threads is greater than zero, then TensorFlow's intra- and
+    inter-op thread pools are limited to that many threads.
+    """
+    tf_config = tf.ConfigProto()
+    tf_config.allow_soft_placement = True
+    if num_threads > 0:
+        tf_config.intra_op_parallelism_threads = num_threads
+        tf_config.inter_op_parallelism_threads = num_threads
+    if settings.xla_jit:
+        tf_config.graph_options.optimizer_options.global_jit_level = \
+            tf.OptimizerOptions.ON_1
+    return tf.Session(config=tf_config)
+
+
+def load_models(settings, configs, session):
+    """Creates the model graphs and restores their variables."""
     logging.debug("Loading models\n")
     models = []
     for i, config in enumerate(configs):
@@ -50,21 +122,197 @@ def main(settings):
                                                            ensemble_scope=scope)
             model.sampling_utils = SamplingUtils(settings)
             models.append(model)
+    return models
 
-    # TODO Ensembling is currently only supported for RNNs, so if
-    # TODO len(models) > 1 then check models are all rnn
 
-    # Translate the source file.
-    inference.translate_file(input_file=settings.input,
-                             output_file=settings.output,
-                             session=session,
-                             models=models,
-                             configs=configs,
-                             beam_size=settings.beam_size,
-                             nbest=settings.n_best,
-                             minibatch_size=settings.minibatch_size,
-                             maxibatch_size=settings.maxibatch_size,
-                             normalization_alpha=settings.normalization_alpha)
+def get_decoding_settings(settings):
+    """Returns the settings that affect translations (see TranslationCache)."""
+    return {
+        'beam_size': settings.beam_size,
+        'normalization_alpha': settings.normalization_alpha,
+        'translation_strategy': settings.translation_strategy,
+        'beam_prune_relative': settings.beam_prune_relative,
+        'beam_prune_absolute': settings.beam_prune_absolute,
+        'early_stopping': settings.early_stopping,
+        'max_len_a': settings.max_len_a,
+        'max_len_b': settings.max_len_b,
+        # The shortlist file may be changed in place, so use its contents.
+        'shortlist': (None if settings.shortlist is None
+                      else file_checksum(settings.shortlist)),
+        'shortlist_frequent': settings.shortlist_frequent,
+    }
+
+
+def translate_with_workers(settings, configs, shortlist, cache):
+    """Translates the source file using settings.workers processes.
+
+    Each worker process loads its own copy of the models and translates
+    whole maxibatches, which it takes from a shared input queue. The CPU
+    cores are split evenly between the workers. The parent process (which
+    doesn't use TensorFlow) reads the input and writes the results in the
+    original order.
+    """
+    num_workers = settings.workers
+    num_threads = max(1, multiprocessing.cpu_count() // num_workers)
+    logging.info('Translating with {} worker processes ({} threads '
+                 'each)'.format(num_workers, num_threads))
+
+    # The workers are forked (whatever the platform's default start method),
+    # so they inherit the settings, configs, shortlist and cache, and can
+    # run the nested worker function.
+    context = multiprocessing.get_context('fork')
+
+    # The input queue is bounded, so that the input is read as needed.
+    input_queue = context.Queue(maxsize=2*num_workers)
+    output_queue = context.Queue()
+
+    def worker(worker_id):
+        """Translates maxibatches until it receives None."""
+        try:
+            session = create_session(settings, num_threads)
+            models = load_models(settings, configs, session)
+            translator = inference.MaxibatchTranslator(
+                session, models, configs, beam_size=settings.beam_size,
+                nbest=settings.n_best,
+                minibatch_size=settings.minibatch_size,
+                normalization_alpha=settings.normalization_alpha,
+                length_bucket=util.get_length_bucket(configs[0],
+                                                     settings.xla_jit),
+                prune_relative=settings.beam_prune_relative,
+                prune_absolute=settings.beam_prune_absolute,
+                early_stopping=settings.early_stopping,
+                shortlist=shortlist,
+                shortlist_frequent=settings.shortlist_frequent,
+                token_batch_size=settings.token_batch_size,
+                cache=cache,
+                num_samples=settings.num_samples,
+                alignments=(settings.output_alignment is not None),
+                json_alignment=settings.json_alignment,
+                word_probabilities=settings.print_word_probabilities)
+            while True:
+                item = input_queue.get()
+                if item is None:
+                    break
+                idx, num_prev_translated, maxibatch = item
+                ordered_beams = translator.translate(
+                    translator.prepare(maxibatch), num_prev_translated)
+                lines = translator.format(ordered_beams, num_prev_translated)
+                alignment_lines = None
+                if settings.output_alignment is not None:
+                    alignment_lines = translator.format_alignments(
+                        ordered_beams, num_prev_translated, maxibatch)
+                output_queue.put((idx, len(maxibatch), lines,
+                                  alignment_lines))
+        except BaseException as e:
+            msg = e.msg if isinstance(e, exception.Error) else repr(e)
+            output_queue.put(
+                (None, 0, 'worker {} failed: {}'.format(worker_id, msg),
+                 None))
+            return
+        output_queue.put((None, 0, None, None))
+
+    def feeder():
+        """Splits the input into maxibatches and queues them.
+
+        If reading the input fails, then the error is reported to the main
+        process through the output queue (like a worker failure).
+        """
+        try:
+            num_prev_translated = num_resumed
+            maxibatch_size = settings.maxibatch_size * settings.minibatch_size
+            if settings.stream_window > 0.0:
+                maxibatches = inference.read_maxibatches_streaming(
+                    settings.input, maxibatch_size, settings.stream_window)
+            else:
+                maxibatches = inference.read_maxibatches(
+                    settings.input, maxibatch_size,
+                    with_offsets=(progress_file is not None))
+            for idx, (maxibatch, offset) in enumerate(maxibatches):
+                input_offsets[idx] = offset
+                input_queue.put((idx, num_prev_translated, maxibatch))
+                num_prev_translated += len(maxibatch)
+        except Exception as e:
+            output_queue.put(
+                (None, 0, 'reading the input failed: {!r}'.format(e), None))
+            return
+        for _ in range(num_workers):
+            input_queue.put(None)
+
+    progress_file = settings.progress_file
+    if progress_file is not None and settings.stream_window > 0.0:
+        logging.error('a progress file cannot be used in streaming mode')
+        sys.exit(1)
+    if progress_file is not None and settings.output_alignment is not None:
+        logging.error('a progress file cannot be used with an alignment file')
+        sys.exit(1)
+    num_resumed = 0
+    if progress_file is not None:
+        num_resumed = inference.resume_translation(
+            progress_file, settings.input, settings.output)
+    input_offsets = {}
+
+    start_time = time.time()
+
+    processes = [context.Process(target=worker, args=(i,))
+                 for i in range(num_workers)]
+    for process in processes:
+        process.start()
+    threading.Thread(target=feeder, daemon=True).start()
+
+    def fail(msg):
+        """Stops the workers and exits (without waiting for the queues)."""
+        logging.error(msg)
+        input_queue.cancel_join_thread()
+        output_queue.cancel_join_thread()
+        for process in processes:
+            process.terminate()
+        sys.exit(1)
+
+    # Write each maxibatch's translations once all previous ones are written.
+    pending = {}
+    next_idx = 0
+    num_translated = 0
+    num_finished_workers = 0
+    while num_finished_workers < num_workers:
+        try:
+            item = output_queue.get(timeout=5)
+        except queue.Empty:
+            # A worker that is killed (e.g. by the OOM killer) can't report
+            # its failure, so check that they are all still alive.
+            for process in processes:
+                if process.exitcode not in (None, 0):
+                    fail('worker process {} died with exit code {}'.format(
+                        process.pid, process.exitcode))
+            continue
+        idx, num_sents, lines, alignment_lines = item
+        if idx is None:
+            if lines is not None:
+                fail(lines)
+            num_finished_workers += 1
+            continue
+        pending[idx] = (num_sents, lines, alignment_lines)
+        while next_idx in pending:
+            num_sents, lines, alignment_lines = pending.pop(next_idx)
+            settings.output.writelines(lines)
+            if alignment_lines is not None:
+                settings.output_alignment.writelines(alignment_lines)
+            num_translated += num_sents
+            if progress_file is not None:
+                inference.save_progress(progress_file,
+                                        input_offsets.pop(next_idx),
+                                        settings.output,
+                                        num_resumed + num_translated)
+            elif settings.stream_window > 0.0:
+                settings.output.flush()
+                if alignment_lines is not None:
+                    settings.output_alignment.flush()
+            next_idx += 1
+    for process in processes:
+        process.join()
+
+    duration = time.time() - start_time
+    logging.info('Translated {} sents in {} sec. Speed {} sents/sec'.format(
+        num_translated, duration, num_translated/duration))
 
 
 if __name__ == "__main__":
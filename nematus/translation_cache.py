@@ -0,0 +1,128 @@
+"""Persistent cache of translations, stored in an SQLite database."""
+
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+
+def _hash_file(h, filename):
+    """Updates the hash object h with the name and contents of a file."""
+    h.update(os.path.basename(filename).encode('utf-8'))
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024**2), b''):
+            h.update(chunk)
+
+
+def file_checksum(filename):
+    """Computes a checksum over the contents of a file (e.g. a shortlist)."""
+    h = hashlib.sha1()
+    _hash_file(h, filename)
+    return h.hexdigest()
+
+
+def model_checksum(model_paths):
+    """Computes a checksum over the files of one or more saved models.
+
+    Each model path is a checkpoint prefix (e.g. 'model.best-valid-script'),
+    so this covers the checkpoint's index, data and meta files, as well as
+    the JSON config. Other files that share the prefix (e.g. other
+    checkpoints or the training progress file) are not included.
+    """
+    h = hashlib.sha1()
+    for path in model_paths:
+        prefix = glob.escape(path)
+        for suffix in ['.index', '.data-*', '.meta', '.json']:
+            for filename in sorted(glob.glob(prefix + suffix)):
+                _hash_file(h, filename)
+    return h.hexdigest()
+
+
+class TranslationCache(object):
+    """Maps source sentences to beams (lists of (translation, score) pairs).
+
+    Entries are keyed by the source sentence, the models' checksum and the
+    decoding settings, so a single cache file can be shared between different
+    models and settings. The cache can be used from multiple threads and
+    (forked) processes.
+    """
+
+    def __init__(self, filename, model_paths, decoding_settings):
+        """Opens (or creates) the cache file.
+
+        Args:
+            filename: path of the SQLite database.
+            model_paths: paths of the models (see model_checksum).
+            decoding_settings: a JSON-serializable dictionary containing all
+                settings that affect the translations.
+        """
+        self._filename = filename
+        h = hashlib.sha1()
+        h.update(model_checksum(model_paths).encode('utf-8'))
+        h.update(json.dumps(decoding_settings, sort_keys=True).encode('utf-8'))
+        self._prefix = h.hexdigest()
+        self._lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+        with self._lock:
+            self._connect()
+
+    def _connect(self):
+        """Returns the database connection of the current process."""
+        # SQLite connections must not be used across fork().
+        if self._pid != os.getpid():
+            self._connection = sqlite3.connect(self._filename, timeout=60,
+                                               check_same_thread=False)
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS translations '
+                '(key TEXT PRIMARY KEY, beam TEXT NOT NULL)')
+            self._connection.commit()
+            self._pid = os.getpid()
+        return self._connection
+
+    def _key(self, sentence):
+        h = hashlib.sha1(self._prefix.encode('utf-8'))
+        h.update(sentence.encode('utf-8'))
+        return h.hexdigest()
+
+    def get(self, sentences):
+        """Looks up a list of sentences.
+
+        Returns:
+            A list containing the cached beam for each sentence, or None if
+            the sentence isn't in the cache.
+        """
+        keys = [self._key(sent) for sent in sentences]
+        found = {}
+        with self._lock:
+            connection = self._connect()
+            # Stay well below SQLite's limit on the number of parameters.
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i+500]
+                query = 'SELECT key, beam FROM translations WHERE key IN ' \
+                        '({})'.format(','.join(['?'] * len(chunk)))
+                found.update(connection.execute(query, chunk).fetchall())
+        beams = []
+        for key in keys:
+            if key in found:
+                beams.append([(sent, cost)
+                              for sent, cost in json.loads(found[key])])
+            else:
+                beams.append(None)
+        return beams
+
+    def put(self, sentences, beams):
+        """Adds the beams of a list of sentences to the cache."""
+        rows = []
+        for sent, beam in zip(sentences, beams):
+            value = [([int(w) for w in hypo], float(cost))
+                     for hypo, cost in beam]
+            rows.append((self._key(sent), json.dumps(value)))
+        with self._lock:
+            connection = self._connect()
+            connection.executemany(
+                'INSERT OR REPLACE INTO translations (key, beam) '
+                'VALUES (?, ?)', rows)
+            connection.commit()
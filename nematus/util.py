@@ -21,7 +21,24 @@ def get_available_gpus():
 
 
 # batch preparation
-def prepare_data(seqs_x, seqs_y, n_factors, maxlen=None):
+def round_up_length(length, length_bucket):
+    """Rounds a sequence length up to a multiple of length_bucket."""
+    return -(-length // length_bucket) * length_bucket
+
+
+def get_length_bucket(config, xla_jit=None):
+    """Returns the width to which sequence lengths should be padded.
+
+    Padding is only used with XLA, where each distinct input shape triggers a
+    recompilation. xla_jit overrides config.xla_jit if given (e.g. to use the
+    value from TranslationSettings).
+    """
+    if xla_jit is None:
+        xla_jit = config.xla_jit
+    return config.xla_length_bucket if xla_jit else 1
+
+
+def prepare_data(seqs_x, seqs_y, n_factors, maxlen=None, length_bucket=1):
     # x: a list of sentences
     lengths_x = [len(s) for s in seqs_x]
     lengths_y = [len(s) for s in seqs_y]
@@ -46,8 +63,8 @@ def prepare_data(seqs_x, seqs_y, n_factors, maxlen=None):
             return None, None, None, None
 
     n_samples = len(seqs_x)
-    maxlen_x = numpy.max(lengths_x) + 1
-    maxlen_y = numpy.max(lengths_y) + 1
+    maxlen_x = round_up_length(numpy.max(lengths_x) + 1, length_bucket)
+    maxlen_y = round_up_length(numpy.max(lengths_y) + 1, length_bucket)
 
     x = numpy.zeros((n_factors, maxlen_x, n_samples)).astype('int64')
     y = numpy.zeros((maxlen_y, n_samples)).astype('int64')
@@ -62,6 +79,64 @@ def prepare_data(seqs_x, seqs_y, n_factors, maxlen=None):
     return x, x_mask, y, y_mask
 
 
+def prepare_packed_data(seqs_x, seqs_y, n_factors, length_bucket=1):
+    """Like prepare_data, but packs multiple sentence pairs into each row.
+
+    Rows have the same length as they would for prepare_data (i.e. the
+    longest source / target sentence plus <EOS>, rounded up to a multiple of
+    length_bucket) and sentence pairs are assigned to rows using a
+    first-fit-decreasing strategy. Each sentence keeps its own <EOS> token.
+
+    Returns:
+        x, x_mask, y, y_mask, x_segments, y_segments, where the first four
+        are as for prepare_data and the segment arrays (with the same shape
+        as the masks) give the 1-based index of the sentence within its row
+        for each token, or 0 for padding.
+    """
+    lengths_x = [len(s) + 1 for s in seqs_x]
+    lengths_y = [len(s) + 1 for s in seqs_y]
+    maxlen_x = round_up_length(max(lengths_x), length_bucket)
+    maxlen_y = round_up_length(max(lengths_y), length_bucket)
+
+    # Assign sentence pairs to rows. Each row is a list of sentence indices.
+    rows, used_x, used_y = [], [], []
+    order = sorted(range(len(seqs_x)),
+                   key=lambda i: lengths_x[i] + lengths_y[i], reverse=True)
+    for i in order:
+        for j in range(len(rows)):
+            if (used_x[j] + lengths_x[i] <= maxlen_x
+                    and used_y[j] + lengths_y[i] <= maxlen_y):
+                rows[j].append(i)
+                used_x[j] += lengths_x[i]
+                used_y[j] += lengths_y[i]
+                break
+        else:
+            rows.append([i])
+            used_x.append(lengths_x[i])
+            used_y.append(lengths_y[i])
+
+    n_rows = len(rows)
+    x = numpy.zeros((n_factors, maxlen_x, n_rows)).astype('int64')
+    y = numpy.zeros((maxlen_y, n_rows)).astype('int64')
+    x_segments = numpy.zeros((maxlen_x, n_rows)).astype('int32')
+    y_segments = numpy.zeros((maxlen_y, n_rows)).astype('int32')
+    for j, row in enumerate(rows):
+        pos_x, pos_y = 0, 0
+        for segment, i in enumerate(row, start=1):
+            len_x, len_y = lengths_x[i], lengths_y[i]
+            if len_x > 1:
+                x[:, pos_x:pos_x+len_x-1, j] = list(zip(*seqs_x[i]))
+            y[pos_y:pos_y+len_y-1, j] = seqs_y[i]
+            x_segments[pos_x:pos_x+len_x, j] = segment
+            y_segments[pos_y:pos_y+len_y, j] = segment
+            pos_x += len_x
+            pos_y += len_y
+    x_mask = (x_segments > 0).astype('float32')
+    y_mask = (y_segments > 0).astype('float32')
+
+    return x, x_mask, y, y_mask, x_segments, y_segments
+
+
 def load_dict(filename, model_type):
     try:
         # build_dictionary.py writes JSON files as UTF-8 so assume that here.
@@ -118,6 +193,137 @@ def factoredseq2words(seq, inverse_dictionaries, join=True):
         words.append(word)
     return ' '.join(words) if join else words
 
+def inverse_vocab_array(inverse_dictionary):
+    """Converts an inverse dictionary into an array-backed one.
+
+    Returns:
+        A NumPy object array containing the word for each ID (see
+        seqs2words). IDs that are not in inverse_dictionary, including any
+        beyond the end of the array, are mapped to 'UNK'.
+    """
+    size = max(inverse_dictionary) + 1 if len(inverse_dictionary) > 0 else 0
+    # The last element is for out-of-range IDs.
+    words = numpy.full(size + 1, 'UNK', dtype=object)
+    for i, word in inverse_dictionary.items():
+        words[i] = word
+    return words
+
+
+def seqs2words(seqs, inverse_vocab, join=True):
+    """Converts a batch of ID sequences into words in one go.
+
+    The result is the same as calling seq2words for each sequence.
+
+    Args:
+        seqs: a list of sequences (which may have different lengths) or a 2D
+            NumPy array with one (zero-padded) sequence per row.
+        inverse_vocab: array returned by inverse_vocab_array.
+        join: if True, return strings, otherwise lists of words.
+
+    Returns:
+        A list containing the words of each sequence.
+    """
+    return factoredseqs2words([numpy.expand_dims(seq, -1) for seq in seqs],
+                              [inverse_vocab], join=join)
+
+
+def factoredseqs2words(seqs, inverse_vocabs, join=True):
+    """Like seqs2words, but for factored sequences.
+
+    The result is the same as calling factoredseq2words for each sequence:
+    a sequence ends at the first position where any factor is zero (i.e.
+    <EOS>), and that position contributes a word made of the factors before
+    the zero (so it is an empty word for a plain <EOS>).
+
+    Args:
+        seqs: a list of arrays with shape (seq_len, factors) or a 3D NumPy
+            array with shape (batch_size, max_seq_len, factors).
+        inverse_vocabs: list of arrays returned by inverse_vocab_array (one
+            per factor).
+        join: if True, return strings, otherwise lists of words.
+
+    Returns:
+        A list containing the words of each sequence (with factors separated
+        by '|').
+    """
+    if len(seqs) == 0:
+        return []
+    num_factors = len(inverse_vocabs)
+    seq_lengths = numpy.array([len(seq) for seq in seqs])
+    # Pad with at least one zero, so that every row has one.
+    ids = numpy.zeros((len(seqs), max(seq_lengths) + 1, num_factors),
+                      dtype='int64')
+    for i, seq in enumerate(seqs):
+        ids[i, :len(seq)] = seq
+    is_zero = (ids == 0)
+    eos_positions = numpy.argmax(numpy.any(is_zero, axis=2), axis=1)
+    factors = []
+    for j, inverse_vocab in enumerate(inverse_vocabs):
+        factor_ids = numpy.minimum(ids[:, :, j], len(inverse_vocab) - 1)
+        factors.append(inverse_vocab[factor_ids])
+    words = factors[0]
+    for factor in factors[1:]:
+        words = words + '|' + factor
+    all_words = []
+    for i, pos in enumerate(eos_positions):
+        seq_words = list(words[i, :pos])
+        if pos < seq_lengths[i]:
+            # The <EOS> position itself (padding doesn't count).
+            num_before_zero = numpy.argmax(is_zero[i, pos])
+            seq_words.append('|'.join(factors[j][i, pos]
+                                      for j in range(num_before_zero)))
+        all_words.append(seq_words)
+    return [' '.join(w) for w in all_words] if join else all_words
+
+
+def alignment_to_json(sentence_id, source_words, target_words, score,
+                      alignment):
+    """Returns a translation's alignment as a JSON-serializable dictionary.
+
+    This is the format read by utils/copy_unknown_words.py. The alignment
+    matrix has a row for each target word and a column for each source word
+    (both including <EOS>). A final empty target word (as returned by
+    seq2words for <EOS>) is ignored.
+    """
+    target_words = _strip_eos_word(target_words)
+    return {'id': sentence_id,
+            'prob': float(score),
+            'target_sent': ' '.join(target_words),
+            'matrix': numpy.asarray(alignment).tolist(),
+            'source_sent': ' '.join(source_words)}
+
+
+def format_alignment(sentence_id, source_words, target_words, score,
+                     alignment, as_json=False):
+    """Formats a translation's alignment (i.e. attention weights).
+
+    By default, the output is a header line
+    'ID ||| TARGET ||| SCORE ||| SOURCE ||| SOURCE_LEN TARGET_LEN' (with the
+    lengths including <EOS>), followed by one line of attention weights per
+    target word and an empty line. If as_json is True, then the output is a
+    single line containing the result of alignment_to_json.
+    """
+    target_words = _strip_eos_word(target_words)
+    if as_json:
+        return json.dumps(alignment_to_json(sentence_id, source_words,
+                                            target_words, score, alignment),
+                          ensure_ascii=False) + '\n'
+    lines = [' ||| '.join([str(sentence_id), ' '.join(target_words),
+                           str(score), ' '.join(source_words),
+                           '{} {}'.format(len(source_words) + 1,
+                                          len(target_words) + 1)])]
+    for weights in alignment:
+        lines.append(' '.join(str(w) for w in weights))
+    return '\n'.join(lines) + '\n\n'
+
+
+def _strip_eos_word(words):
+    """Removes the empty word that seq2words produces for <EOS>, if any."""
+    if len(words) > 0 and words[-1] == '':
+        return words[:-1]
+    return words
+
+
 def reverse_dict(dictt):
     keys, values = list(zip(*list(dictt.items())))
     r_dictt = dict(list(zip(values, keys)))
@@ -133,7 +339,74 @@ def load_dictionaries(config):
     return source_to_num, target_to_num, num_to_source, num_to_target
 
 
-def read_all_lines(config, sentences, batch_size):
+def load_shortlist(filename, config):
+    """Loads a lexical shortlist (for vocabulary selection during decoding).
+
+    Each line of the file contains a source word followed by its candidate
+    translations (e.g. the top-N entries of a lexical translation table).
+    Words that are not in the (first factor's) source vocabulary or in the
+    target vocabulary are ignored.
+
+    Returns:
+        A dictionary mapping source word IDs to NumPy arrays of target IDs.
+    """
+    source_to_num, target_to_num, _, _ = load_dictionaries(config)
+    shortlist = {}
+    with open(filename, 'r', encoding='utf-8') as f:
+        for line in f:
+            words = line.split()
+            if len(words) < 2 or words[0] not in source_to_num[0]:
+                continue
+            ids = [target_to_num[w] for w in words[1:] if w in target_to_num]
+            ids = [i for i in ids if i < config.target_vocab_size]
+            source_id = source_to_num[0][words[0]]
+            if source_id in shortlist:
+                ids.extend(shortlist[source_id])
+            shortlist[source_id] = numpy.array(ids, dtype='int32')
+    return shortlist
+
+
+def get_shortlist_ids(shortlist, x, num_frequent, target_vocab_size):
+    """Returns the candidate target IDs for a minibatch.
+
+    These are the union of the shortlist entries for the source words in x
+    and of the num_frequent most frequent target words (vocabulary IDs are
+    assigned in order of frequency, after the special symbols, which are
+    always included).
+
+    Args:
+        shortlist: dictionary returned by load_shortlist.
+        x: Numpy array with shape (factors, max_seq_len, batch_size).
+        num_frequent: integer.
+        target_vocab_size: integer.
+
+    Returns:
+        A sorted NumPy array of unique target IDs (so <EOS> always comes
+        first).
+    """
+    ids = [numpy.arange(min(max(num_frequent, 3), target_vocab_size),
+                        dtype='int32')]
+    for source_id in numpy.unique(x[0]):
+        if source_id in shortlist:
+            ids.append(shortlist[source_id])
+    return numpy.unique(numpy.concatenate(ids)).astype('int32')
+
+
+def read_all_lines(config, sentences, batch_size, token_batch_size=0,
+                   beam_size=1, length_bucket=1):
+    """Converts sentences to IDs, sorts them by length and batches them.
+
+    If token_batch_size is greater than zero, then batches are instead cut
+    so that the padded number of source tokens (including <EOS>), multiplied
+    by beam_size (the number of times each sentence is repeated in the
+    decoder), doesn't exceed token_batch_size. Padded lengths are rounded up
+    to a multiple of length_bucket, as in prepare_data. Each batch contains
+    at least one sentence and at most batch_size sentences.
+
+    Returns:
+        A pair (batches, idxs), where idxs gives the original position of
+        each sentence in the concatenated batches.
+    """
     source_to_num, _, _, _ = load_dictionaries(config)
 
     if config.source_vocab_sizes != None:
@@ -166,6 +439,20 @@ def read_all_lines(config, sentences, batch_size):
 
     #merge into batches
     batches = []
+    if token_batch_size > 0:
+        # Lines are sorted by length, so the current line is the longest.
+        start = 0
+        for i in range(len(lines)):
+            padded_len = round_up_length(len(lines[i]) + 1, length_bucket)
+            padded_size = (i - start + 1) * padded_len * beam_size
+            if i > start and (padded_size > token_batch_size
+                              or i - start == batch_size):
+                batches.append(lines[start:i])
+                start = i
+        if start < len(lines):
+            batches.append(lines[start:])
+        return batches, idxs
+
     for i in range(0, len(lines), batch_size):
         batch = lines[i:i+batch_size]
         batches.append(batch)
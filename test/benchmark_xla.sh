@@ -0,0 +1,53 @@
+#!/bin/bash
+
+# compares training and translation speed with and without XLA JIT
+# compilation (--xla_jit). The setup is the same toy setup as in
+# test_train.sh, so the resulting models are only useful for timing.
+# Note that the first updates / minibatches include compilation time;
+# the words/sec and sents/sec figures logged by train.py and translate.py
+# give a better picture of steady-state speed.
+
+set -e
+
+for xla in "" "--xla_jit"; do
+  if [ -z "$xla" ]; then
+    name=no_xla
+  else
+    name=xla
+  fi
+  mkdir -p models/benchmark_$name
+
+  TIMEFORMAT="training ($name): %R sec"
+  time ../nematus/train.py \
+    --model models/benchmark_$name/model \
+    --datasets data/corpus.en data/corpus.de \
+    --dictionaries data/vocab.en.json data/vocab.de.json \
+    --dim_word 256 \
+    --dim 512 \
+    --n_words_src 30000 \
+    --n_words 30000 \
+    --maxlen 50 \
+    --optimizer adam \
+    --lrate 0.0001 \
+    --batch_size 40 \
+    --no_shuffle \
+    --dispFreq 50 \
+    --sampleFreq 0 \
+    --beamFreq 0 \
+    --validFreq 0 \
+    --saveFreq 0 \
+    --finish_after 200 \
+    --rnn_enc_transition_depth 2 \
+    --rnn_dec_base_transition_depth 3 \
+    --layer_normalisation \
+    --tie_decoder_embeddings \
+    $xla
+
+  TIMEFORMAT="translation ($name): %R sec"
+  time ../nematus/translate.py \
+    -m models/benchmark_$name/model-200 \
+    -i en-de/in \
+    -o models/benchmark_$name/out \
+    -k 5 \
+    $xla
+done
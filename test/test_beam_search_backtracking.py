@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import unittest
+
+import numpy
+
+sys.path.append(os.path.abspath('../nematus'))
+from rnn_inference import _backtrack_hypotheses, _backtrack_step_outputs
+
+class TestBeamSearchBacktracking(unittest.TestCase):
+    """
+    Unit tests for reconstructing hypotheses from beam search outputs
+    """
+
+    def reference(self, ys, parents, i):
+        hypo = []
+        for pos in range(ys.shape[0] - 1, -1, -1):
+            hypo.append(ys[pos, i])
+            i = parents[pos, i]
+        hypo.reverse()
+        hypo = numpy.trim_zeros(hypo, trim='b')
+        hypo.append(0)
+        return hypo
+
+    def test_matches_reference(self):
+        rng = numpy.random.RandomState(1234)
+        seq_len, batch_size, beam_size = 7, 3, 4
+        ys = rng.randint(0, 5, size=(seq_len, batch_size*beam_size))
+        offsets = numpy.repeat(numpy.arange(batch_size) * beam_size, beam_size)
+        parents = rng.randint(0, beam_size, size=ys.shape) + offsets
+        ys[-2:, :2] = 0
+        ys[:, 5] = 0
+        hypos, lengths = _backtrack_hypotheses(ys, parents)
+        for i in range(ys.shape[1]):
+            self.assertEqual(list(hypos[i, :lengths[i]]),
+                             self.reference(ys, parents, i))
+            self.assertTrue(numpy.all(hypos[i, lengths[i]:] == 0))
+
+    def test_step_outputs_follow_hypotheses(self):
+        rng = numpy.random.RandomState(1234)
+        seq_len, batch_size, beam_size = 6, 2, 3
+        ys = rng.randint(1, 5, size=(seq_len, batch_size*beam_size))
+        offsets = numpy.repeat(numpy.arange(batch_size) * beam_size, beam_size)
+        parents = rng.randint(0, beam_size, size=ys.shape) + offsets
+        # Per-step outputs with an extra dimension (like attention weights).
+        outputs = numpy.stack([ys, -ys], axis=2)
+        hypos, _ = _backtrack_hypotheses(ys, parents)
+        hypo_outputs = _backtrack_step_outputs(outputs, parents)
+        self.assertEqual(hypo_outputs.shape, (batch_size*beam_size, seq_len, 2))
+        self.assertTrue(numpy.all(hypo_outputs[:, :, 0] == hypos[:, :seq_len]))
+        self.assertTrue(numpy.all(hypo_outputs[:, :, 1] == -hypos[:, :seq_len]))
+
+
+if __name__ == '__main__':
+    unittest.main()
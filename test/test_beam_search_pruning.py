@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import unittest
+from unittest import mock
+
+import numpy
+import tensorflow as tf
+
+sys.path.append(os.path.abspath('../nematus'))
+from rnn_inference import beam_search, _prune_hypotheses, PRUNED_COST
+
+class TestPrunedHypotheses(unittest.TestCase):
+    """
+    Unit tests for the removal of pruned hypotheses from beam search results
+    """
+
+    def beam_search(self, ys, parents, costs, beam_size,
+                    normalization_alpha=0.0):
+        # The session returns the given raw beam search outputs.
+        session = mock.Mock()
+        session.run.return_value = (ys, parents, costs)
+        graph = mock.Mock(extra_outputs=False)
+        x = numpy.zeros((1, 3, ys.shape[1] // beam_size), dtype='int64')
+        x_mask = numpy.ones((3, ys.shape[1] // beam_size), dtype='float32')
+        return beam_search(session, [mock.Mock()], x, x_mask, beam_size,
+                           normalization_alpha=normalization_alpha,
+                           graph=graph)
+
+    def test_pruned_hypotheses_are_removed(self):
+        # Two sentences, beam size 3. Each row is a timestep.
+        ys = numpy.array([[5, 6, 7, 5, 6, 7],
+                          [0, 8, 0, 0, 0, 0]])
+        parents = numpy.array([[0, 1, 2, 3, 4, 5],
+                               [0, 1, 2, 3, 4, 5]])
+        costs = numpy.array([3.0, 1.0, PRUNED_COST,
+                             PRUNED_COST, PRUNED_COST, 2.0])
+        beams = self.beam_search(ys, parents, costs, 3)
+        self.assertEqual(beams, [[([6, 8, 0], 1.0), ([5, 0], 3.0)],
+                                 [([7, 0], 2.0)]])
+        beams = self.beam_search(ys, parents, costs, 3,
+                                 normalization_alpha=1.0)
+        self.assertEqual(beams, [[([6, 8, 0], 1.0/3), ([5, 0], 3.0/2)],
+                                 [([7, 0], 2.0/2)]])
+
+class TestPruneHypotheses(unittest.TestCase):
+    """
+    Unit tests for the pruning and early stopping step of RNN beam search
+    """
+
+    def prune(self, parent_ys, new_ys, new_cost, beam_size,
+              prune_relative=0.0, prune_absolute=0.0, early_stopping=False):
+        with tf.Graph().as_default(), tf.Session() as session:
+            outputs = _prune_hypotheses(
+                tf.constant(parent_ys, dtype=tf.int32),
+                tf.constant(new_ys, dtype=tf.int32),
+                tf.constant(new_cost, dtype=tf.float32), beam_size,
+                prune_relative, prune_absolute, early_stopping)
+            return session.run(outputs)
+
+    def test_disabled_pruning_leaves_output_unchanged(self):
+        rng = numpy.random.RandomState(1234)
+        beam_size, batch_size = 4, 3
+        num_rows = beam_size * batch_size
+        parent_ys = rng.randint(0, 3, size=num_rows)
+        new_ys = numpy.where(parent_ys == 0, 0, rng.randint(0, 5, size=num_rows))
+        # Extensions of unfinished hypotheses have log probabilities as
+        # costs; the others have positive costs.
+        new_cost = numpy.where(parent_ys == 0,
+                               rng.uniform(1.0, 10.0, size=num_rows),
+                               -rng.uniform(1.0, 10.0, size=num_rows))
+        ys, cost = self.prune(parent_ys, new_ys, new_cost, beam_size)
+        self.assertTrue(numpy.array_equal(ys, new_ys))
+        self.assertTrue(numpy.allclose(cost, new_cost))
+
+    def test_prune_relative_and_absolute(self):
+        parent_ys = [1, 1, 1]
+        new_ys = [4, 5, 6]
+        new_cost = [-1.0, -2.0, -5.0]
+        # Probability ratios to the best hypothesis are exp(-1) and exp(-4).
+        ys, cost = self.prune(parent_ys, new_ys, new_cost, 3,
+                              prune_relative=0.1)
+        self.assertEqual(list(ys), [4, 5, 0])
+        self.assertEqual(list(cost[:2]), [-1.0, -2.0])
+        self.assertEqual(cost[2], numpy.float32(PRUNED_COST))
+        ys, cost = self.prune(parent_ys, new_ys, new_cost, 3,
+                              prune_absolute=0.5)
+        self.assertEqual(list(ys), [4, 0, 0])
+
+    def test_early_stopping(self):
+        # The first sentence has a finished hypothesis (cost 2.0) that beats
+        # all unfinished ones, the second doesn't.
+        parent_ys = [0, 1, 1, 1]
+        new_ys = [0, 5, 0, 7]
+        new_cost = [2.0, -3.0, -6.0, -1.0]
+        ys, cost = self.prune(parent_ys, new_ys, new_cost, 2,
+                              early_stopping=True)
+        self.assertEqual(list(ys), [0, 0, 0, 7])
+        self.assertEqual(cost[1], numpy.float32(PRUNED_COST))
+        ys, cost = self.prune(parent_ys, new_ys, new_cost, 2,
+                              early_stopping=False)
+        self.assertEqual(list(ys), new_ys)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import unittest
+
+import numpy
+import tensorflow as tf
+
+sys.path.append(os.path.abspath('../nematus'))
+from sampling_utils import SamplingUtils
+from settings import TranslationSettings
+
+class TestBeamTopK(unittest.TestCase):
+    """
+    Unit tests for the two-stage top k selection in beam search
+    """
+
+    def top_k(self, scores, k, vocab_size, two_stage):
+        settings = TranslationSettings()
+        settings.two_stage_top_k = two_stage
+        sampling_utils = SamplingUtils(settings)
+        with tf.Graph().as_default(), tf.Session() as session:
+            scores_ph = tf.placeholder(tf.float32, shape=[None, None])
+            outputs = sampling_utils.beam_top_k(scores_ph, k, vocab_size)
+            return session.run(outputs, feed_dict={scores_ph: scores})
+
+    def test_matches_single_top_k(self):
+        rng = numpy.random.RandomState(1234)
+        batch_size, beam_size, vocab_size = 5, 4, 50
+        # Few distinct values, so there are many ties (within and across
+        # beam entries).
+        scores = rng.randint(0, 6, size=(batch_size, beam_size * vocab_size))
+        scores = scores.astype(numpy.float32)
+        # A sentence in which all scores are tied.
+        scores[0, :] = 1.0
+        values, indices = self.top_k(scores, beam_size, vocab_size, False)
+        values2, indices2 = self.top_k(scores, beam_size, vocab_size, True)
+        self.assertTrue(numpy.array_equal(values, values2))
+        self.assertTrue(numpy.array_equal(indices, indices2))
+        self.assertEqual(list(indices[0]), list(range(beam_size)))
+
+
+if __name__ == '__main__':
+    unittest.main()
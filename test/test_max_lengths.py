@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import unittest
+
+import numpy
+import tensorflow as tf
+
+sys.path.append(os.path.abspath('../nematus'))
+from sampling_utils import SamplingUtils
+from settings import TranslationSettings
+
+class TestMaxLengths(unittest.TestCase):
+    """
+    Unit tests for the per-sentence maximum translation lengths
+    """
+
+    def max_lengths(self, source_lengths, translation_maxlen, a, b):
+        settings = TranslationSettings()
+        settings.max_len_a = a
+        settings.max_len_b = b
+        sampling_utils = SamplingUtils(settings)
+        # The mask includes <EOS> and is padded to the longest sentence.
+        x_mask = numpy.zeros((max(source_lengths) + 2, len(source_lengths)),
+                             dtype=numpy.float32)
+        for i, length in enumerate(source_lengths):
+            x_mask[:length+1, i] = 1.0
+        with tf.Graph().as_default(), tf.Session() as session:
+            return list(session.run(sampling_utils.get_max_lengths(
+                tf.constant(x_mask), translation_maxlen)))
+
+    def test_disabled(self):
+        self.assertEqual(self.max_lengths([1, 5, 9], 20, 0.0, 0), [20] * 3)
+
+    def test_linear_in_source_length(self):
+        # a * len + b, rounded down (len excludes <EOS>).
+        self.assertEqual(self.max_lengths([1, 5, 9], 100, 1.5, 2),
+                         [3, 9, 15])
+        self.assertEqual(self.max_lengths([4], 100, 0.0, 7), [7])
+
+    def test_capped_at_translation_maxlen(self):
+        self.assertEqual(self.max_lengths([2, 30], 20, 1.0, 5), [7, 20])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import unittest
+
+import numpy
+
+sys.path.append(os.path.abspath('../nematus'))
+from util import prepare_data, prepare_packed_data
+
+class TestPacking(unittest.TestCase):
+    """
+    Unit tests for packing sentence pairs into training minibatch rows
+    """
+
+    def setUp(self):
+        self.seqs_x = [[[3], [4], [5], [6]], [[7]], [[8], [9]], [[10]]]
+        self.seqs_y = [[11, 12, 13], [14], [15, 16], [17]]
+
+    def test_packing_reduces_rows(self):
+        x, x_mask, y, y_mask, x_segments, y_segments = \
+            prepare_packed_data(self.seqs_x, self.seqs_y, 1)
+        x_ref, x_mask_ref, y_ref, y_mask_ref = \
+            prepare_data(self.seqs_x, self.seqs_y, 1)
+        self.assertEqual(x.shape[:2], x_ref.shape[:2])
+        self.assertEqual(y.shape[0], y_ref.shape[0])
+        self.assertLess(x.shape[-1], x_ref.shape[-1])
+        self.assertEqual(numpy.sum(x_mask), numpy.sum(x_mask_ref))
+        self.assertEqual(numpy.sum(y_mask), numpy.sum(y_mask_ref))
+        numpy.testing.assert_array_equal(x_mask, x_segments > 0)
+        numpy.testing.assert_array_equal(y_mask, y_segments > 0)
+
+    def test_sentences_are_recoverable(self):
+        x, x_mask, y, y_mask, x_segments, y_segments = \
+            prepare_packed_data(self.seqs_x, self.seqs_y, 1)
+        pairs = []
+        for j in range(x.shape[-1]):
+            for segment in range(1, numpy.max(x_segments[:, j]) + 1):
+                # Drop the trailing <EOS> of each segment.
+                xx = x[0, x_segments[:, j] == segment, j][:-1]
+                yy = y[y_segments[:, j] == segment, j][:-1]
+                pairs.append((list(xx), list(yy)))
+        expected = [([w[0] for w in s_x], s_y)
+                    for s_x, s_y in zip(self.seqs_x, self.seqs_y)]
+        self.assertEqual(sorted(pairs), sorted(expected))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.append(os.path.abspath('../nematus'))
+import inference
+from settings import TranslationSettings
+
+class StubConfig(object):
+    translation_maxlen = 100
+
+class StubTranslator(object):
+    """
+    Stands in for MaxibatchTranslator: 'translates' by reversing each line.
+    """
+    # If set, format fails for maxibatches starting at this sentence.
+    fail_at = None
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def prepare(self, maxibatch):
+        return maxibatch
+
+    def translate(self, prepared, num_prev_translated):
+        return [line.strip()[::-1] for line in prepared]
+
+    def format(self, ordered_beams, num_prev_translated):
+        if self.fail_at is not None and num_prev_translated >= self.fail_at:
+            raise RuntimeError('interrupted')
+        return ['{} {}\n'.format(num_prev_translated + i, beam)
+                for i, beam in enumerate(ordered_beams)]
+
+class TestProgressFile(unittest.TestCase):
+    """
+    Unit tests for resuming translation with a progress file
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.input = os.path.join(self.tmp_dir, 'input')
+        with open(self.input, 'w') as f:
+            for i in range(7):
+                f.write('sentence {}\n'.format(i))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def translate(self, output, mode='w', progress_file=None, fail_at=None):
+        # Maxibatches of two sentences.
+        with open(self.input, 'r') as input_file, \
+             open(output, mode) as output_file, \
+             mock.patch.object(inference, 'MaxibatchTranslator',
+                               StubTranslator), \
+             mock.patch.object(StubTranslator, 'fail_at', fail_at):
+            inference.translate_file(input_file, output_file, session=None,
+                                     models=None, configs=[StubConfig()],
+                                     minibatch_size=2, maxibatch_size=1,
+                                     progress_file=progress_file)
+
+    def read(self, filename):
+        with open(filename, 'r') as f:
+            return f.read()
+
+    def test_resume_matches_uninterrupted_run(self):
+        reference = os.path.join(self.tmp_dir, 'reference')
+        self.translate(reference)
+
+        output = os.path.join(self.tmp_dir, 'output')
+        progress_file = os.path.join(self.tmp_dir, 'progress')
+        with self.assertRaises(RuntimeError):
+            self.translate(output, progress_file=progress_file, fail_at=2)
+        self.assertEqual(self.read(output), '0 0 ecnetnes\n1 1 ecnetnes\n')
+
+        self.translate(output, mode='r+', progress_file=progress_file)
+        self.assertEqual(self.read(output), self.read(reference))
+
+    def test_resume_discards_partial_output(self):
+        output = os.path.join(self.tmp_dir, 'output')
+        progress_file = os.path.join(self.tmp_dir, 'progress')
+        with self.assertRaises(RuntimeError):
+            self.translate(output, progress_file=progress_file, fail_at=4)
+        # Output that was written after the last recorded position.
+        with open(output, 'a') as f:
+            f.write('4 partial\n')
+        with open(self.input, 'r') as input_file, open(output, 'r+') as f:
+            self.assertEqual(inference.resume_translation(
+                progress_file, input_file, f), 4)
+            self.assertEqual(input_file.readline(), 'sentence 4\n')
+            self.assertEqual(f.read(), '')
+
+    def test_read_maxibatches_offsets(self):
+        with open(self.input, 'r') as input_file:
+            maxibatches = list(inference.read_maxibatches(
+                input_file, 3, with_offsets=True))
+            self.assertEqual([len(m) for m, _ in maxibatches], [3, 3, 1])
+            input_file.seek(maxibatches[0][1])
+            self.assertEqual(input_file.readline(), 'sentence 3\n')
+
+    def test_alignment_file_is_not_truncated(self):
+        output = os.path.join(self.tmp_dir, 'output')
+        alignment = os.path.join(self.tmp_dir, 'alignment')
+        progress_file = os.path.join(self.tmp_dir, 'progress')
+        for filename in [output, alignment, progress_file]:
+            with open(filename, 'w') as f:
+                f.write('previous run\n')
+        argv = ['translate.py', '-m', 'model', '-i', self.input, '-o', output,
+                '--progress_file', progress_file, '-a', alignment]
+        with mock.patch.object(sys, 'argv', argv), \
+             mock.patch('sys.stderr'), \
+             self.assertRaises(SystemExit):
+            TranslationSettings(from_console_arguments=True)
+        self.assertEqual(self.read(alignment), 'previous run\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import unittest
+
+import numpy
+
+sys.path.append(os.path.abspath('../nematus'))
+import util
+
+class TestSeqs2Words(unittest.TestCase):
+    """
+    Unit tests for the batched ID-to-word conversion
+    """
+
+    def setUp(self):
+        self.inverse_dictionary = {0: '<EOS>', 1: 'UNK', 2: 'a', 3: 'b',
+                                   5: 'c'}
+        self.inverse_vocab = util.inverse_vocab_array(self.inverse_dictionary)
+
+    def test_matches_seq2words(self):
+        seqs = [[2, 3, 0], [5, 4, 2], [], [0, 2], [7, 3, 0, 0, 2]]
+        expected = [util.seq2words(numpy.array(seq, dtype='int64'),
+                                   self.inverse_dictionary)
+                    for seq in seqs]
+        self.assertEqual(expected[0], 'a b ')
+        self.assertEqual(util.seqs2words(seqs, self.inverse_vocab), expected)
+
+    def test_padded_array(self):
+        seqs = numpy.array([[2, 3, 0, 0], [5, 5, 5, 2]])
+        self.assertEqual(util.seqs2words(seqs, self.inverse_vocab, join=False),
+                         [['a', 'b', ''], ['c', 'c', 'c', 'a']])
+
+    def test_factored(self):
+        factor_dictionary = {0: '<EOS>', 1: 'x', 2: 'y'}
+        inverse_vocabs = [self.inverse_vocab,
+                          util.inverse_vocab_array(factor_dictionary)]
+        seqs = numpy.array([[[2, 1], [3, 2], [5, 0]],
+                            [[5, 2], [0, 0], [0, 0]]])
+        expected = [util.factoredseq2words(seq, [self.inverse_dictionary,
+                                                 factor_dictionary])
+                    for seq in seqs]
+        self.assertEqual(expected, ['a|x b|y c', 'c|y '])
+        self.assertEqual(util.factoredseqs2words(seqs, inverse_vocabs),
+                         expected)
+
+if __name__ == '__main__':
+    unittest.main()
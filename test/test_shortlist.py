@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+sys.path.append(os.path.abspath('../nematus'))
+import util
+
+class StubConfig(object):
+    model_type = 'rnn'
+    target_vocab_size = 10
+
+class TestShortlist(unittest.TestCase):
+    """
+    Unit tests for the lexical shortlist
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        source_dict = {'<EOS>': 0, '<UNK>': 1, 'haus': 2, 'katze': 3}
+        target_dict = {'<EOS>': 0, '<GO>': 1, '<UNK>': 2, 'the': 3,
+                       'house': 4, 'home': 5, 'cat': 6, 'rare': 12}
+        self.config = StubConfig()
+        self.config.source_dicts = [os.path.join(self.tmp_dir, 'src.json')]
+        self.config.target_dict = os.path.join(self.tmp_dir, 'trg.json')
+        with open(self.config.source_dicts[0], 'w') as f:
+            json.dump(source_dict, f)
+        with open(self.config.target_dict, 'w') as f:
+            json.dump(target_dict, f)
+        self.shortlist_file = os.path.join(self.tmp_dir, 'shortlist')
+        with open(self.shortlist_file, 'w') as f:
+            f.write('haus house home unknown\n')
+            f.write('katze cat rare\n')
+            f.write('hund dog\n')
+            f.write('haus the\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_load_shortlist(self):
+        shortlist = util.load_shortlist(self.shortlist_file, self.config)
+        self.assertEqual(sorted(shortlist.keys()), [2, 3])
+        self.assertEqual(sorted(shortlist[2]), [3, 4, 5])
+        # 'rare' is outside of the model's target vocabulary.
+        self.assertEqual(list(shortlist[3]), [6])
+
+    def test_shortlist_ids(self):
+        shortlist = util.load_shortlist(self.shortlist_file, self.config)
+        vocab_size = self.config.target_vocab_size
+        rng = numpy.random.RandomState(1234)
+        for num_frequent in [0, 2, 5]:
+            for beam_size in [1, 4, 8]:
+                x = rng.randint(0, 4, size=(1, 6, 3))
+                # As in MaxibatchTranslator.prepare.
+                ids = util.get_shortlist_ids(
+                    shortlist, x, max(num_frequent, beam_size), vocab_size)
+                self.assertEqual(list(ids), sorted(set(ids)))
+                self.assertEqual(ids[0], 0)
+                for i in range(max(num_frequent, beam_size, 3)):
+                    self.assertIn(i, ids)
+                self.assertGreaterEqual(len(ids), beam_size)
+                for source_id in numpy.unique(x[0]):
+                    for i in shortlist.get(source_id, []):
+                        self.assertIn(i, ids)
+
+    def test_shortlist_ids_capped_at_vocab_size(self):
+        ids = util.get_shortlist_ids({}, numpy.zeros((1, 2, 2)), 100,
+                                     self.config.target_vocab_size)
+        self.assertEqual(list(ids), list(range(self.config.target_vocab_size)))
+
+
+if __name__ == '__main__':
+    unittest.main()
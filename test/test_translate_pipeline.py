@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import io
+import random
+import time
+import unittest
+from unittest import mock
+
+sys.path.append(os.path.abspath('../nematus'))
+import exception
+import inference
+
+class StubConfig(object):
+    translation_maxlen = 100
+
+class StubTranslator(object):
+    """
+    Stands in for MaxibatchTranslator: 'translates' by reversing each line,
+    with random delays in each stage to vary the threads' interleaving.
+    """
+    # Errors to raise from prepare and format.
+    prepare_error = None
+    format_error = None
+
+    def __init__(self, *args, **kwargs):
+        self._rng = random.Random(1234)
+
+    def _delay(self):
+        time.sleep(self._rng.uniform(0.0, 0.002))
+
+    def prepare(self, maxibatch):
+        self._delay()
+        if self.prepare_error is not None:
+            raise self.prepare_error
+        return maxibatch
+
+    def translate(self, prepared, num_prev_translated):
+        self._delay()
+        return [line.strip()[::-1] for line in prepared]
+
+    def format(self, ordered_beams, num_prev_translated):
+        self._delay()
+        if self.format_error is not None:
+            raise self.format_error
+        return ['{} {}\n'.format(num_prev_translated + i, beam)
+                for i, beam in enumerate(ordered_beams)]
+
+class FailingInput(io.StringIO):
+    """
+    An input file that fails after the given number of lines.
+    """
+    def __init__(self, lines, num_good_lines):
+        super().__init__(''.join(lines))
+        self._num_good_lines = num_good_lines
+
+    def readline(self, *args):
+        if self._num_good_lines == 0:
+            raise OSError('bad input')
+        self._num_good_lines -= 1
+        return super().readline(*args)
+
+class TestTranslatePipeline(unittest.TestCase):
+    """
+    Unit tests for the reader / writer threads of translate_file
+    """
+
+    def translate(self, lines, prepare_error=None, format_error=None,
+                  input_file=None, stream_window=0.0):
+        if input_file is None:
+            input_file = io.StringIO(''.join(lines))
+        output_file = io.StringIO()
+        with mock.patch.object(inference, 'MaxibatchTranslator',
+                               StubTranslator), \
+             mock.patch.multiple(StubTranslator, prepare_error=prepare_error,
+                                 format_error=format_error):
+            inference.translate_file(input_file, output_file, session=None,
+                                     models=None, configs=[StubConfig()],
+                                     minibatch_size=3, maxibatch_size=1,
+                                     stream_window=stream_window)
+        return output_file.getvalue()
+
+    def test_output_order(self):
+        lines = ['sentence {}\n'.format(i) for i in range(50)]
+        expected = ''.join('{} {}\n'.format(i, line.strip()[::-1])
+                           for i, line in enumerate(lines))
+        self.assertEqual(self.translate(lines), expected)
+
+    def test_reader_error(self):
+        lines = ['sentence\n'] * 10
+        with self.assertRaises(RuntimeError):
+            self.translate(lines, prepare_error=RuntimeError('reader'))
+        # Input errors are reported and end the program.
+        with self.assertRaises(SystemExit):
+            self.translate(lines, prepare_error=exception.Error('factors'))
+
+    def test_streaming_input_error(self):
+        lines = ['sentence\n'] * 10
+        # Must not hang waiting for the streaming reader thread.
+        with self.assertRaises(OSError):
+            self.translate(lines, input_file=FailingInput(lines, 4),
+                           stream_window=0.01)
+
+    def test_writer_error(self):
+        lines = ['sentence\n'] * 10
+        with self.assertRaises(RuntimeError):
+            self.translate(lines, format_error=RuntimeError('writer'))
+
+
+if __name__ == '__main__':
+    unittest.main()
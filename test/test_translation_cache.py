@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import shutil
+import tempfile
+import unittest
+
+sys.path.append(os.path.abspath('../nematus'))
+from translation_cache import TranslationCache, model_checksum
+
+class TestTranslationCache(unittest.TestCase):
+    """
+    Unit tests for the persistent translation cache
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.model = os.path.join(self.tmp_dir, 'model')
+        with open(self.model + '.json', 'w') as f:
+            f.write('{}')
+        self.filename = os.path.join(self.tmp_dir, 'cache.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_round_trip(self):
+        cache = TranslationCache(self.filename, [self.model], {'beam_size': 5})
+        self.assertEqual(cache.get(['a b', 'c']), [None, None])
+        cache.put(['a b'], [[([3, 4, 0], 1.5), ([3, 0], 2.0)]])
+        # Reopen the file.
+        cache = TranslationCache(self.filename, [self.model], {'beam_size': 5})
+        self.assertEqual(cache.get(['c', 'a b']),
+                         [None, [([3, 4, 0], 1.5), ([3, 0], 2.0)]])
+
+    def test_keys_depend_on_settings_and_models(self):
+        cache = TranslationCache(self.filename, [self.model], {'beam_size': 5})
+        cache.put(['a'], [[([3, 0], 1.0)]])
+        other = TranslationCache(self.filename, [self.model], {'beam_size': 4})
+        self.assertEqual(other.get(['a']), [None])
+        with open(self.model + '.json', 'w') as f:
+            f.write('{"changed": true}')
+        other = TranslationCache(self.filename, [self.model], {'beam_size': 5})
+        self.assertEqual(other.get(['a']), [None])
+
+    def test_model_checksum_ignores_other_files(self):
+        checksum = model_checksum([self.model])
+        # Other checkpoints and the training progress file share the prefix.
+        for suffix in ['.progress.json', '.best-valid-script.index',
+                       '.best-valid-script.data-00000-of-00001', '-1000.meta']:
+            with open(self.model + suffix, 'w') as f:
+                f.write('x')
+        self.assertEqual(model_checksum([self.model]), checksum)
+        with open(self.model + '.data-00000-of-00001', 'w') as f:
+            f.write('x')
+        self.assertNotEqual(model_checksum([self.model]), checksum)
+
+if __name__ == '__main__':
+    unittest.main()